@@ -0,0 +1,78 @@
+# BenchCommon.py
+# -*- coding: utf-8 -*-
+
+"""
+BenchPadding / BenchPrecision / BenchMerged 共用的部分：
+- 固定的一批输入（PERSONA / TOPIC / SCENE / UTTERANCES）
+- disable_score_caches()：关掉 scene 分数缓存和 persona 前缀缓存，每轮都真正跑三路前向
+- run_scoring()：只打分的计时循环，infer_batch(with_insert=False)，触发的条目也不调用 ChatGPT
+"""
+
+import statistics
+
+import Core
+
+HEADS = ("persona", "scene", "topic")
+
+PERSONA = {
+    "background": "传播学大四学生，正在准备申研，最近压力很大",
+    "personality_traits": ["内向", "认真"],
+    "speaking_style": "简短",
+    "values": "重视效率",
+}
+TOPIC = "Preparing graduate school applications while balancing coursework and part-time work."
+SCENE = Core.build_scene_prompt_from_fields({
+    "time_of_day": "晚上",
+    "formality": "非正式",
+    "domain": "学习",
+    "relationship": "同学",
+    "participants": "4",
+})
+UTTERANCES = [
+    "好的",
+    "哈哈",
+    "对",
+    "我觉得这个方案还可以再想想",
+    "今天的文书又被导师打回来了，感觉自己写的东西完全没有逻辑，不知道从哪里开始改。",
+    "我们要不要先把截止日期排个序？有三所学校是下周就截止的，剩下的还有一个月左右。",
+    "说实话我已经连续熬了三个晚上了，白天还要去实习，晚上改文书，周末还要准备语言考试，真的有点撑不住了，大家都是怎么安排时间的？",
+]
+
+
+def disable_score_caches():
+    """对比的是前向本身：scene 头不走分数缓存，persona 头不走前缀缓存（否则比较的是缓存路径）。"""
+    Core.SCENE_SCORE_CACHE = False
+    Core.PERSONA_PREFIX_CACHE = False
+
+
+def run_scoring(rounds: int) -> dict:
+    """预热一次后跑 rounds 轮 infer_batch，返回耗时和最后一轮的分数。"""
+    jobs = [{
+        "persona_profile": PERSONA,
+        "topic_en": TOPIC,
+        "scene_system": SCENE,
+        "scene_user": "",
+        "utterance": u,
+    } for u in UTTERANCES]
+
+    Core.infer_batch(jobs, with_insert=False)  # 预热
+    ms, results = [], None
+    for _ in range(rounds):
+        t0 = Core._now_ms()
+        results = Core.infer_batch(jobs, with_insert=False)
+        ms.append(Core._now_ms() - t0)
+    return {
+        "ms_median": round(statistics.median(ms), 2),
+        "ms_min": round(min(ms), 2),
+        "sub_scores": [r["sub_scores"] for r in results],
+        "final": [r["final_willingness"] for r in results],
+    }
+
+
+def max_sub_score_diff(a: dict, b: dict) -> float:
+    """两次 run_scoring 结果里三路 sub_scores 的最大绝对差。"""
+    max_diff = 0.0
+    for x, y in zip(a["sub_scores"], b["sub_scores"]):
+        for head in HEADS:
+            max_diff = max(max_diff, abs(x[head] - y[head]))
+    return max_diff
@@ -0,0 +1,359 @@
+# BenchLoad.py
+# -*- coding: utf-8 -*-
+
+"""
+Websocket.py 的协议级压测（模拟几百个前端客户端）：
+- 每个客户端：连接 -> join（nickname + intro + room_id）-> user_number -> 按 --rate 发 chat_line（泊松间隔）
+- 统计：
+  - ack_ms：发出 chat_line 到收到自己那条 chat_ack
+  - done_ms：收到 chat_ack 到收到最终 chat_update（done / rejected / superseded / skipped / cancelled）
+  - 各终态条数，rejected 按 reason 分（queue_full = 原来的 gpu_queue_full）
+  - 广播偏差 skew_ms：同一条 chat_ack / chat_update 在同房间各客户端之间的到达时间差（max - min）
+- 默认在本进程里起一个 mock 服务：往 sys.modules 注入假的 Core（infer_batch / generate_insert 只 sleep），
+  不需要模型、不访问网络；--url 则压外部已启动的服务（例如真实的 python Websocket.py）
+  （本进程模式下客户端和服务端共用事件循环，客户端开销会算进延迟；客户端很多时可用 --serve 单独起 mock 服务再 --url 压）
+用法：
+  python BenchLoad.py --clients 300 --rooms 10 --rate 0.5 --duration 30
+  python BenchLoad.py --serve --port 8766            # 另一个终端：python BenchLoad.py --url ws://127.0.0.1:8766
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+import types
+
+import websockets
+
+FINAL_STATUSES = {"done", "rejected", "superseded", "skipped", "cancelled"}
+
+MOCK = {
+    "batch_ms": 20.0,     # 每次 infer_batch 固定耗时
+    "item_ms": 5.0,       # 批内每条额外耗时
+    "insert_ms": 300.0,   # 每次 generate_insert（ChatGPT 插话）耗时
+    "trigger_rate": 0.2,  # 触发插话的发言比例
+}
+
+
+# ================== mock Core ==================
+def _mock_core() -> types.ModuleType:
+    """Websocket 从 Core 导入的函数的假实现：打分按发言文本的哈希决定，耗时只是 sleep。"""
+    core = types.ModuleType("Core")
+    threshold = 0.60
+
+    def _score(utterance: str) -> float:
+        rng = random.Random(utterance)
+        return 0.9 if rng.random() < MOCK["trigger_rate"] else 0.1
+
+    def infer_batch(jobs: list, with_insert: bool = True) -> list:
+        ms = MOCK["batch_ms"] + MOCK["item_ms"] * len(jobs)
+        time.sleep(ms / 1000.0)
+        out = []
+        for job in jobs:
+            final = _score(job["utterance"])
+            triggered = final > threshold
+            res = {
+                "type": "agent_utterance",
+                "final_willingness": final,
+                "threshold": threshold,
+                "topic_en": job["topic_en"],
+                "strategy": "disabled",
+                "text": "",
+                "sub_scores": {"persona": final, "scene": final, "topic": final},
+                "debug_timing": {"ms_total": round(ms, 2), "batch_size": len(jobs), "mock": True},
+                "debug_inputs": None,
+            }
+            if triggered:
+                if with_insert:
+                    ins = generate_insert(job["persona_profile"], job["topic_en"], job["utterance"],
+                                          job["scene_system"], job["scene_user"])
+                    res["strategy"], res["text"] = ins["strategy"], ins["insert"]
+                else:
+                    res["strategy"] = "pending"
+            out.append(res)
+        return out
+
+    def infer_once(persona_profile, topic_en, scene_system, scene_user, utterance) -> dict:
+        return infer_batch([{
+            "persona_profile": persona_profile,
+            "topic_en": topic_en,
+            "scene_system": scene_system,
+            "scene_user": scene_user,
+            "utterance": utterance,
+        }])[0]
+
+    def generate_insert(persona_profile, topic_en, utterance, scene_system, scene_user) -> dict:
+        time.sleep(MOCK["insert_ms"] / 1000.0)
+        return {"strategy": "mock", "insert": f"(mock) {utterance[:20]}", "ms_strategy": MOCK["insert_ms"]}
+
+    core.infer_batch = infer_batch
+    core.infer_once = infer_once
+    core.generate_insert = generate_insert
+    core.build_scene_prompt_from_fields = lambda fields: json.dumps(fields, ensure_ascii=False)
+    core.init_models = lambda: None
+    core.invalidate_persona_prefix = lambda persona_profile: None
+    return core
+
+
+def _import_mock_server():
+    if "Core" in sys.modules and not getattr(sys.modules["Core"], "__mock__", False):
+        raise RuntimeError("real Core already imported; mock server must be set up first")
+    core = _mock_core()
+    core.__mock__ = True
+    sys.modules["Core"] = core
+    import Websocket
+    Websocket.WS_LOG = False
+    return Websocket
+
+
+async def _start_mock_server(host: str, port: int):
+    Websocket = _import_mock_server()
+    tasks = [asyncio.create_task(Websocket.gpu_worker()), asyncio.create_task(Websocket.loop_lag_monitor())]
+    server = await websockets.serve(Websocket.handler, host, port, max_size=None)
+    return Websocket, server, tasks
+
+
+# ================== 统计 ==================
+def _pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q / 100.0 * (len(s) - 1)))))
+    return round(s[k], 2)
+
+
+def _latency(values: list) -> dict:
+    return {
+        "n": len(values),
+        "p50": _pct(values, 50),
+        "p95": _pct(values, 95),
+        "p99": _pct(values, 99),
+        "mean": round(statistics.fmean(values), 2) if values else 0.0,
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+def _new_stats() -> dict:
+    return {
+        "connected": 0,
+        "join_ok": 0,
+        "disconnected": 0,      # 服务端提前断开（例如慢客户端被踢）
+        "close_reasons": {},    # "code reason" -> 条数
+        "errors": [],
+        "sent": 0,
+        "acked": 0,
+        "ack_ms": [],
+        "done_ms": [],
+        "status": {},           # 终态 -> 条数
+        "rejected": {},         # reason -> 条数
+        "arrivals": {},         # (room_id, type, seq, status) -> [到达时间]
+    }
+
+
+# ================== 客户端 ==================
+async def _client(i: int, url: str, room_id: str, args, stats: dict, stop: asyncio.Event):
+    rng = random.Random(args.seed * 100003 + i)
+    mine = {}     # text -> 发送时间
+    acks = {}     # seq -> ack 到达时间
+    pending = set()
+    joined = asyncio.Event()
+    uid = None
+
+    await asyncio.sleep(rng.uniform(0, args.ramp_s))
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=30) as ws:
+            stats["connected"] += 1
+
+            async def reader():
+                nonlocal uid
+                async for message in ws:
+                    now = time.perf_counter()
+                    data = json.loads(message)
+                    dtype = data.get("type")
+                    if dtype == "join_ok":
+                        uid = data.get("user_id")
+                        joined.set()
+                    elif dtype in ("chat_ack", "chat_update"):
+                        seq = data.get("seq")
+                        key = (room_id, dtype, seq, data.get("status"))
+                        stats["arrivals"].setdefault(key, []).append(now)
+                        if dtype == "chat_ack" and data.get("user", {}).get("user_id") == uid:
+                            sent_at = mine.pop(data.get("text"), None)
+                            if sent_at is not None:
+                                stats["acked"] += 1
+                                stats["ack_ms"].append((now - sent_at) * 1000.0)
+                                acks[seq] = now
+                                pending.add(seq)
+                        elif dtype == "chat_update" and seq in pending and data.get("status") in FINAL_STATUSES:
+                            pending.discard(seq)
+                            status = data.get("status")
+                            stats["status"][status] = stats["status"].get(status, 0) + 1
+                            if status == "rejected":
+                                reason = data.get("reason", "")
+                                stats["rejected"][reason] = stats["rejected"].get(reason, 0) + 1
+                            stats["done_ms"].append((now - acks.pop(seq)) * 1000.0)
+
+            read_task = asyncio.create_task(reader())
+            await ws.send(json.dumps({
+                "type": "join",
+                "nickname": f"bot{i}",
+                "intro": f"压测客户端 {i}",
+                "room_id": room_id,
+            }))
+            await asyncio.wait_for(joined.wait(), 30)
+            stats["join_ok"] += 1
+            await ws.send(json.dumps({"type": "user_number", "user_number": str(i + 1), "user_id": uid}))
+
+            n = 0
+            while not stop.is_set() and (not args.lines or n < args.lines):
+                if args.rate > 0:
+                    await asyncio.sleep(rng.expovariate(args.rate))
+                if stop.is_set():
+                    break
+                n += 1
+                text = f"bot{i}#{n} 我觉得这个问题还可以再讨论一下"
+                mine[text] = time.perf_counter()
+                await ws.send(json.dumps({"type": "chat_line", "text": text}))
+                stats["sent"] += 1
+
+            # 等自己发出的发言都有终态（或超时）
+            deadline = time.perf_counter() + args.drain_s
+            while (mine or pending) and time.perf_counter() < deadline and not read_task.done():
+                await asyncio.sleep(0.05)
+            read_task.cancel()
+    except websockets.ConnectionClosed as e:
+        stats["disconnected"] += 1
+        rcvd = e.rcvd
+        reason = f"{rcvd.code} {rcvd.reason}".strip() if rcvd else "no close frame"
+        stats["close_reasons"][reason] = stats["close_reasons"].get(reason, 0) + 1
+    except Exception as e:
+        if len(stats["errors"]) < 20:
+            stats["errors"].append(f"client{i}: {repr(e)}")
+
+
+def _skew(arrivals: dict, dtype: str) -> dict:
+    return _latency([
+        (max(times) - min(times)) * 1000.0
+        for (_, t, _, _), times in arrivals.items()
+        if t == dtype and len(times) > 1
+    ])
+
+
+async def run(args) -> dict:
+    ws_mod, server, server_tasks = None, None, []
+    url = args.url
+    if not url:
+        ws_mod, server, server_tasks = await _start_mock_server(args.host, args.port)
+        url = f"ws://{args.host}:{args.port}"
+
+    stats = _new_stats()
+    stop = asyncio.Event()
+    rooms = [f"load{r}" for r in range(args.rooms)]
+    t0 = time.perf_counter()
+    clients = [
+        asyncio.create_task(_client(i, url, rooms[i % len(rooms)], args, stats, stop))
+        for i in range(args.clients)
+    ]
+    if args.duration > 0:
+        await asyncio.wait(clients, timeout=args.ramp_s + args.duration)
+        stop.set()
+    await asyncio.gather(*clients)
+    wall = time.perf_counter() - t0
+
+    report = {
+        "url": url,
+        "mock": dict(MOCK) if ws_mod else None,
+        "config": {
+            "clients": args.clients,
+            "rooms": args.rooms,
+            "rate_per_client": args.rate,
+            "duration_s": args.duration,
+            "lines_per_client": args.lines,
+        },
+        "wall_s": round(wall, 3),
+        "connected": stats["connected"],
+        "join_ok": stats["join_ok"],
+        "disconnected": stats["disconnected"],
+        "close_reasons": stats["close_reasons"],
+        "sent": stats["sent"],
+        "acked": stats["acked"],
+        "completed": sum(stats["status"].values()),
+        "status": stats["status"],
+        "rejected": stats["rejected"],
+        "dropped_queue_full": stats["rejected"].get("queue_full", 0),
+        "lines_per_s": round(sum(stats["status"].values()) / wall, 2) if wall > 0 else 0.0,
+        "ack_ms": _latency(stats["ack_ms"]),
+        "ack_to_done_ms": _latency(stats["done_ms"]),
+        "broadcast_skew_ms": {
+            "chat_ack": _skew(stats["arrivals"], "chat_ack"),
+            "chat_update": _skew(stats["arrivals"], "chat_update"),
+        },
+        "errors": stats["errors"],
+    }
+    if ws_mod:
+        report["server"] = {
+            "queue": {k: v for k, v in ws_mod.GPU_QUEUE.stats().items() if k != "rooms"},
+            "cancel_stats": dict(ws_mod.CANCEL_STATS),
+            "outbox": dict(ws_mod.OUTBOX_STATS),
+            "loop_lag": ws_mod._loop_lag_summary(),
+        }
+        server.close()
+        await server.wait_closed()
+        for task in server_tasks:
+            task.cancel()
+    return report
+
+
+async def serve(args):
+    _, server, _ = await _start_mock_server(args.host, args.port)
+    print(f"[bench] mock server ws://{args.host}:{args.port} mock={MOCK}")
+    await server.wait_closed()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", help="压测外部服务（不填则在本进程起 mock 服务）")
+    ap.add_argument("--serve", action="store_true", help="只起 mock 服务，不压测")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8766)
+    ap.add_argument("--clients", type=int, default=200)
+    ap.add_argument("--rooms", type=int, default=10)
+    ap.add_argument("--rate", type=float, default=0.5, help="每个客户端每秒 chat_line 数（泊松）")
+    ap.add_argument("--duration", type=float, default=20.0, help="发送时长（秒，0 = 按 --lines 发完为止）")
+    ap.add_argument("--lines", type=int, default=0, help="每个客户端最多发多少条（0 = 不限）")
+    ap.add_argument("--ramp-s", type=float, default=2.0, help="客户端在这段时间内陆续连上")
+    ap.add_argument("--drain-s", type=float, default=30.0, help="停止发送后等结果的最长时间")
+    ap.add_argument("--mock-batch-ms", type=float, default=MOCK["batch_ms"])
+    ap.add_argument("--mock-item-ms", type=float, default=MOCK["item_ms"])
+    ap.add_argument("--mock-insert-ms", type=float, default=MOCK["insert_ms"])
+    ap.add_argument("--trigger-rate", type=float, default=MOCK["trigger_rate"])
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="JSON 输出路径（默认只打印）")
+    args = ap.parse_args()
+    if args.duration <= 0 and args.lines <= 0:
+        ap.error("--duration 和 --lines 至少要设一个")
+
+    MOCK.update({
+        "batch_ms": args.mock_batch_ms,
+        "item_ms": args.mock_item_ms,
+        "insert_ms": args.mock_insert_ms,
+        "trigger_rate": args.trigger_rate,
+    })
+
+    if args.serve:
+        asyncio.run(serve(args))
+        return
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# BenchMerged.py
+# -*- coding: utf-8 -*-
+
+"""
+对比两种跑三路 LoRA 的方式（同一批输入、同一份模型）：
+- lora  ：当前做法，base 权重 + 运行时 LoRA 旁路（mixed-adapter batch / set_adapter）
+- merged：build_merged_heads() 后每个头换成自己的合并权重，前向不再有 LoRA matmul
+输出两种方式的耗时、三路 sub_scores 的最大差值，以及 merged_memory_report() 的参数内存对比。
+用法：python BenchMerged.py [--rounds 5]
+"""
+
+import argparse
+import json
+
+import Core
+from BenchCommon import UTTERANCES, disable_score_caches, run_scoring, max_sub_score_diff
+
+TOLERANCE = 1e-3  # 合并时 W + delta 的舍入与旁路计算顺序不同，允许极小差异
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    disable_score_caches()
+    Core.MERGED_HEADS = False
+    Core.init_models()
+
+    lora = run_scoring(args.rounds)
+    mem_lora = Core.merged_memory_report()
+
+    Core.build_merged_heads()
+    merged = run_scoring(args.rounds)
+    mem_merged = Core.merged_memory_report()
+
+    max_diff = max_sub_score_diff(lora, merged)
+
+    report = {
+        "utterances": len(UTTERANCES),
+        "rounds": args.rounds,
+        "lora_ms_median": lora["ms_median"],
+        "merged_ms_median": merged["ms_median"],
+        "speedup": round(lora["ms_median"] / max(merged["ms_median"], 1e-6), 2),
+        "max_abs_diff": max_diff,
+        "within_tolerance": max_diff <= TOLERANCE,
+        "memory_lora": mem_lora,
+        "memory_merged": mem_merged,
+        "memory_overhead_mb": round(mem_merged["total_mb"] - mem_lora["total_mb"], 1),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# BenchPadding.py
+# -*- coding: utf-8 -*-
+
+"""
+对比 Core 两种编码方式（同一批输入、同一份模型）：
+- fixed  ：PAD_TO_MAX_LENGTH=True，每行补齐到 MAX_LENGTH
+- dynamic：PAD_TO_MAX_LENGTH=False，按 batch 最长补齐 + LENGTH_BUCKETS 分桶
+
+输出两种方式的耗时，以及三路 sub_scores 的最大差值（超过 TOLERANCE 视为不一致）。
+用法：python BenchPadding.py [--rounds 5]
+"""
+
+import argparse
+import json
+
+import Core
+from BenchCommon import UTTERANCES, disable_score_caches, run_scoring, max_sub_score_diff
+
+TOLERANCE = 1e-3  # fp16 下不同 padding 长度会带来极小的数值差异
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    disable_score_caches()
+    Core.init_models()
+
+    Core.PAD_TO_MAX_LENGTH = True
+    fixed = run_scoring(args.rounds)
+    Core.PAD_TO_MAX_LENGTH = False
+    dynamic = run_scoring(args.rounds)
+
+    max_diff = max_sub_score_diff(fixed, dynamic)
+
+    report = {
+        "utterances": len(UTTERANCES),
+        "rounds": args.rounds,
+        "length_buckets": Core.LENGTH_BUCKETS,
+        "fixed_ms_median": fixed["ms_median"],
+        "dynamic_ms_median": dynamic["ms_median"],
+        "speedup": round(fixed["ms_median"] / max(dynamic["ms_median"], 1e-6), 2),
+        "max_abs_diff": max_diff,
+        "within_tolerance": max_diff <= TOLERANCE,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
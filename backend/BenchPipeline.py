@@ -0,0 +1,356 @@
+# BenchPipeline.py
+# -*- coding: utf-8 -*-
+
+"""
+willingness 流水线基准（不需要真实 7B）：
+- --make-tiny DIR：生成一个随机初始化的小号 Qwen2 分类模型 + 3 个随机 LoRA adapter（persona/scene/topic）
+  （tokenizer 用合成语料训练的小 byte-level BPE，按 Qwen2Tokenizer / Qwen2TokenizerFast 保存，走真实的 Qwen 预分词）
+- 把 Core.BASE_MODEL / *_LORA 指到 DIR，回放合成的多用户聊天语料：
+  - core：逐条调用 Core.infer_once
+  - ws  ：按 --rate 把发言送进 Websocket 的推理队列（submit_infer_job + gpu_worker，含攒批 / 公平调度）
+- 输出 p50/p95/p99 延迟、utterances/s、debug_timing 各阶段耗时，写成 JSON 便于跨 commit 对比
+用法：
+  python BenchPipeline.py --make-tiny bench_model
+  python BenchPipeline.py --model-dir bench_model --mode core ws --out bench.json
+默认 --threshold 1.01（只打分，不调用 ChatGPT）；要连插话一起测，设 OPENAI_BASE_URL 指向 OpenAIStub.py 并调低阈值。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")  # Core / CoreChatgpt 在 import 时创建 OpenAI client
+
+import Core
+
+HEADS = ("persona", "scene", "topic")
+HEAD_TARGETS = {  # 覆盖范围各不相同，合并模式（MERGED_HEADS）下也能测到部分覆盖的模块
+    "persona": ["q_proj", "v_proj"],
+    "scene": ["q_proj", "v_proj"],
+    "topic": ["q_proj", "k_proj", "v_proj", "o_proj"],
+}
+TIMING_KEYS = ("ms_total", "ms_init_models", "ms_build_inputs", "ms_persona", "ms_scene", "ms_topic", "ms_strategy")
+
+# ================== 合成语料 ==================
+BACKGROUNDS = [
+    "传播学大四学生，正在准备申研，最近压力很大",
+    "软件工程师，刚换工作，喜欢跑步和咖啡",
+    "研究生一年级，研究方向是人机交互",
+    "中学老师，周末在社区做志愿者",
+    "自由设计师，经常熬夜赶稿",
+    "大二学生，社团负责人，很外向",
+]
+TRAITS = ["内向", "外向", "认真", "随和", "幽默", "谨慎", "急躁", "乐观"]
+STYLES = ["简短", "啰嗦", "正式", "口语化"]
+TOPICS = [
+    "Preparing graduate school applications while balancing coursework and part-time work.",
+    "Planning a weekend group trip on a tight budget and deciding who books what.",
+    "Discussing whether remote work makes teams more or less productive.",
+]
+OPENERS = ["我觉得", "说实话", "哈哈", "对啊", "其实", "等等", "那个", "嗯"]
+BODIES = [
+    "这个方案还可以再想想",
+    "今天的文书又被导师打回来了，感觉完全没有逻辑",
+    "我们要不要先把截止日期排个序？有三所学校下周就截止",
+    "周末去哪里都行，只要别太贵",
+    "远程办公确实省通勤，但沟通成本高了很多",
+    "我已经连续熬了三个晚上了，白天还要实习，真的有点撑不住",
+    "有没有人用过那个排期工具？",
+    "好的",
+]
+
+
+def make_corpus(n_users: int, n_lines: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    users = []
+    for i in range(n_users):
+        users.append({
+            "user_id": f"u{i}",
+            "persona_profile": {
+                "background": rng.choice(BACKGROUNDS),
+                "personality_traits": rng.sample(TRAITS, 2),
+                "speaking_style": rng.choice(STYLES),
+                "values": "",
+            },
+        })
+    lines = []
+    for _ in range(n_lines):
+        body = rng.choice(BODIES)
+        text = body if rng.random() < 0.3 else f"{rng.choice(OPENERS)}，{body}"
+        if rng.random() < 0.2:
+            text += "。" + rng.choice(BODIES)
+        lines.append({"user": rng.randrange(n_users), "text": text})
+    scene = Core.build_scene_prompt_from_fields({
+        "time_of_day": "晚上",
+        "formality": "非正式",
+        "domain": "学习",
+        "relationship": "同学",
+        "participants": str(n_users),
+    })
+    return {"users": users, "lines": lines, "topic_en": rng.choice(TOPICS), "scene_system": scene}
+
+
+def _corpus_texts() -> list:
+    texts = BACKGROUNDS + TRAITS + STYLES + TOPICS + OPENERS + BODIES + [Core.SCENE_WILLINGNESS_SUFFIX]
+    texts += ["[PROFILE] [UTTERANCE] [TOPIC_EN] [PERSONA_RAW] {\"background\": \"personality_traits\": [], \"speaking_style\": \"values\"}"]
+    return texts * 4
+
+
+# ================== 小号模型 ==================
+def make_tiny(out_dir: str, seed: int = 0, hidden: int = 64, layers: int = 2, vocab: int = 2000):
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import Qwen2Config, Qwen2ForSequenceClassification, Qwen2Tokenizer, Qwen2TokenizerFast
+    from peft import LoraConfig, TaskType, get_peft_model
+
+    torch.manual_seed(seed)
+    base_dir = os.path.join(out_dir, "base")
+    os.makedirs(base_dir, exist_ok=True)
+
+    # tokenizer：byte-level BPE，词表/merges 交给 Qwen2Tokenizer(Fast)，分词时用的是 Qwen 的预分词正则
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    bpe.train_from_iterator(_corpus_texts(), trainer)
+    vocab_file, merges_file = bpe.model.save(base_dir)
+    Qwen2Tokenizer(vocab_file, merges_file).save_pretrained(base_dir)
+    tok = Qwen2TokenizerFast(vocab_file=vocab_file, merges_file=merges_file)
+    tok.save_pretrained(base_dir)
+
+    config = Qwen2Config(
+        vocab_size=len(tok),
+        hidden_size=hidden,
+        intermediate_size=hidden * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=Core.MAX_LENGTH * 2,
+        num_labels=1,
+        pad_token_id=tok.pad_token_id,
+    )
+    Qwen2ForSequenceClassification(config).save_pretrained(base_dir)
+
+    paths = {}
+    for head in HEADS:
+        model = Qwen2ForSequenceClassification.from_pretrained(base_dir, num_labels=1)
+        model = get_peft_model(model, LoraConfig(
+            task_type=TaskType.SEQ_CLS, r=8, lora_alpha=16, target_modules=HEAD_TARGETS[head],
+        ))
+        with torch.no_grad():
+            for name, p in model.named_parameters():
+                if "lora_B" in name or "modules_to_save" in name:
+                    p.normal_(0.0, 0.05)  # lora_B 默认全 0，随机化后三个头的分数才各不相同
+        paths[head] = os.path.join(out_dir, head)
+        model.save_pretrained(paths[head])
+
+    with open(os.path.join(out_dir, "tiny.json"), "w", encoding="utf-8") as f:
+        json.dump({"hidden": hidden, "layers": layers, "vocab": len(tok), "seed": seed, "targets": HEAD_TARGETS}, f, indent=2)
+    print(f"[bench] tiny model written to {out_dir}")
+
+
+def use_model_dir(model_dir: str):
+    Core.BASE_MODEL = os.path.join(model_dir, "base")
+    Core.PERSONA_LORA = os.path.join(model_dir, "persona")
+    Core.SCENE_LORA = os.path.join(model_dir, "scene")
+    Core.TOPIC_LORA = os.path.join(model_dir, "topic")
+
+
+# ================== 统计 ==================
+def _pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q / 100.0 * (len(s) - 1)))))
+    return round(s[k], 2)
+
+
+def _latency(values: list) -> dict:
+    return {
+        "p50": _pct(values, 50),
+        "p95": _pct(values, 95),
+        "p99": _pct(values, 99),
+        "mean": round(statistics.fmean(values), 2) if values else 0.0,
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+def _stages(results: list) -> dict:
+    out = {}
+    for key in TIMING_KEYS:
+        vals = [r["debug_timing"][key] for r in results if isinstance(r.get("debug_timing"), dict) and key in r["debug_timing"]]
+        if vals:
+            out[key] = {"p50": _pct(vals, 50), "p95": _pct(vals, 95), "mean": round(statistics.fmean(vals), 2)}
+    for key in ("scene_cached", "persona_prefix", "batch_size"):
+        counts = {}
+        for r in results:
+            v = (r.get("debug_timing") or {}).get(key)
+            if v is not None:
+                counts[str(v)] = counts.get(str(v), 0) + 1
+        if counts:
+            out[key] = counts
+    return out
+
+
+def _summary(latencies: list, results: list, wall_s: float) -> dict:
+    return {
+        "utterances": len(latencies),
+        "wall_s": round(wall_s, 3),
+        "utterances_per_s": round(len(latencies) / wall_s, 2) if wall_s > 0 else 0.0,
+        "latency_ms": _latency(latencies),
+        "stages": _stages(results),
+    }
+
+
+# ================== 回放 ==================
+def _job(corpus: dict, line: dict, history: list) -> dict:
+    user = corpus["users"][line["user"]]
+    return {
+        "persona_profile": user["persona_profile"],
+        "topic_en": corpus["topic_en"],
+        "scene_system": corpus["scene_system"],
+        "scene_user": "[HISTORY]\n" + "\n".join(history[-12:]) if history else "",
+        "utterance": line["text"],
+    }
+
+
+def run_core(corpus: dict) -> dict:
+    latencies, results, history = [], [], []
+    t_start = time.perf_counter()
+    for line in corpus["lines"]:
+        job = _job(corpus, line, history)
+        t0 = time.perf_counter()
+        results.append(Core.infer_once(**job))
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        history.append(f'{corpus["users"][line["user"]]["user_id"]}: {line["text"]}')
+    return _summary(latencies, results, time.perf_counter() - t_start)
+
+
+async def _run_ws(corpus: dict, rate: float, rooms: int) -> dict:
+    import Websocket
+    Websocket.WS_LOG = False
+    worker = asyncio.create_task(Websocket.gpu_worker())
+    latencies, results, waits, rejected = [], [], [], 0
+    history = []
+
+    async def one(i: int, line: dict):
+        nonlocal rejected
+        job = _job(corpus, line, history)
+        job.update({
+            "room_id": f"bench{line['user'] % rooms}",
+            "user_id": corpus["users"][line["user"]]["user_id"],
+            "seq": i,
+        })
+        t0 = time.perf_counter()
+        try:
+            res = await Websocket.submit_infer_job(job)
+        except Websocket.QueueRejected:
+            rejected += 1
+            return
+        ms = (time.perf_counter() - t0) * 1000.0
+        latencies.append(ms)
+        results.append(res)
+        waits.append(Websocket._span_summary(job["span"]).get("ms_queue_wait", 0.0))
+
+    interval = 1.0 / rate if rate > 0 else 0.0
+    tasks = []
+    t_start = time.perf_counter()
+    for i, line in enumerate(corpus["lines"]):
+        tasks.append(asyncio.create_task(one(i, line)))
+        history.append(f'{corpus["users"][line["user"]]["user_id"]}: {line["text"]}')
+        if interval:
+            await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - t_start
+    worker.cancel()
+
+    out = _summary(latencies, results, wall)
+    out.update({
+        "rate": rate,
+        "rooms": rooms,
+        "queue_wait_ms": _latency(waits),
+        "rejected": rejected,
+        "cancel_stats": dict(Websocket.CANCEL_STATS),
+    })
+    return out
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return ""
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--make-tiny", metavar="DIR", help="生成小号随机模型和 adapter 后退出")
+    ap.add_argument("--model-dir", default="bench_model", help="--make-tiny 生成的目录")
+    ap.add_argument("--mode", nargs="+", default=["core", "ws"], choices=["core", "ws"])
+    ap.add_argument("--users", type=int, default=8)
+    ap.add_argument("--lines", type=int, default=200)
+    ap.add_argument("--rate", type=float, default=50.0, help="ws 模式每秒送入的发言数（0 = 一次全部送入）")
+    ap.add_argument("--rooms", type=int, default=2, help="ws 模式把用户分到几个房间")
+    ap.add_argument("--threshold", type=float, default=1.01)
+    ap.add_argument("--persona-prefix-cache", action="store_true", help="开启 Core.PERSONA_PREFIX_CACHE（默认关闭）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="JSON 输出路径（默认只打印）")
+    args = ap.parse_args()
+
+    if args.make_tiny:
+        make_tiny(args.make_tiny, seed=args.seed)
+        return
+
+    use_model_dir(args.model_dir)
+    Core.THRESHOLD = args.threshold
+    Core.PERSONA_PREFIX_CACHE = args.persona_prefix_cache
+    t0 = time.perf_counter()
+    Core.init_models()
+    ms_load = (time.perf_counter() - t0) * 1000.0
+    Core.infer_once({}, "", "", "", "warmup")  # 预热
+
+    corpus = make_corpus(args.users, args.lines, args.seed)
+    report = {
+        "git": _git_rev(),
+        "ts": int(time.time()),
+        "model_dir": args.model_dir,
+        "device": str(Core.DEVICE),
+        "config": {
+            "users": args.users,
+            "lines": args.lines,
+            "threshold": args.threshold,
+            "batch_heads": Core.BATCH_HEADS,
+            "merged_heads": Core.MERGED_HEADS,
+            "pad_to_max_length": Core.PAD_TO_MAX_LENGTH,
+            "length_buckets": Core.LENGTH_BUCKETS,
+            "scene_score_cache": Core.SCENE_SCORE_CACHE,
+            "persona_prefix_cache": Core.PERSONA_PREFIX_CACHE,
+            "token_segment_cache": Core.TOKEN_SEGMENT_CACHE,
+            "tokenizer_fast": bool(getattr(Core.tokenizer, "is_fast", False)),
+            "cpu_precision": Core.CPU_PRECISION,
+        },
+        "ms_load": round(ms_load, 1),
+    }
+    if "core" in args.mode:
+        report["core"] = run_core(corpus)
+    if "ws" in args.mode:
+        report["ws"] = asyncio.run(_run_ws(corpus, args.rate, args.rooms))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
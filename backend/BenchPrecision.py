@@ -0,0 +1,77 @@
+# BenchPrecision.py
+# -*- coding: utf-8 -*-
+
+"""
+CPU 推理精度对比（同一批输入，依次用不同 CPU_PRECISION 重新加载模型 + 3 个 LoRA）：
+- fp32（基准）/ bf16 / int8_dynamic / int8_weight_only
+输出每种模式的耗时，以及三路 sub_scores、final_willingness 相对 fp32 的最大 / 平均差值，
+和以 THRESHOLD 判定是否插话时与 fp32 不一致的条数。
+用法：python BenchPrecision.py [--modes bf16 int8_dynamic] [--rounds 3]
+"""
+
+import argparse
+import gc
+import json
+
+import Core
+from BenchCommon import HEADS, UTTERANCES, disable_score_caches, run_scoring
+
+
+def _run(mode: str, rounds: int) -> dict:
+    Core.unload_models()
+    gc.collect()
+    Core.CPU_PRECISION = mode
+    t0 = Core._now_ms()
+    Core.init_models()
+    ms_load = Core._now_ms() - t0
+    return {"ms_load": round(ms_load, 1), **run_scoring(rounds)}
+
+
+def _compare(base: dict, other: dict) -> dict:
+    report = {}
+    for head in HEADS:
+        diffs = [abs(a[head] - b[head]) for a, b in zip(base["sub_scores"], other["sub_scores"])]
+        report[head] = {"max_abs_diff": round(max(diffs), 5), "mean_abs_diff": round(sum(diffs) / len(diffs), 5)}
+    diffs = [abs(a - b) for a, b in zip(base["final"], other["final"])]
+    report["final"] = {"max_abs_diff": round(max(diffs), 5), "mean_abs_diff": round(sum(diffs) / len(diffs), 5)}
+    report["decision_flips"] = sum(
+        (a > Core.THRESHOLD) != (b > Core.THRESHOLD) for a, b in zip(base["final"], other["final"])
+    )
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--modes", nargs="+", default=["bf16", "int8_dynamic", "int8_weight_only"])
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+
+    if Core.DEVICE.type == "cuda":
+        print("[bench] CUDA 可用：CPU_PRECISION 只在 CPU 上生效，请在 CPU 节点上运行（CUDA_VISIBLE_DEVICES=）")
+        return
+
+    disable_score_caches()
+
+    base = _run("fp32", args.rounds)
+    report = {
+        "utterances": len(UTTERANCES),
+        "rounds": args.rounds,
+        "fp32": {"ms_load": base["ms_load"], "ms_median": base["ms_median"]},
+    }
+    for mode in args.modes:
+        try:
+            res = _run(mode, args.rounds)
+        except ImportError as e:
+            report[mode] = {"error": str(e)}
+            continue
+        report[mode] = {
+            "ms_load": res["ms_load"],
+            "ms_median": res["ms_median"],
+            "speedup": round(base["ms_median"] / max(res["ms_median"], 1e-6), 2),
+            **_compare(base, res),
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# ChatHistory.py
+# -*- coding: utf-8 -*-
+
+"""
+房间聊天历史（两个 WebSocket 服务共用）：
+- 有界 deque 保存最近 MAX_HISTORY 条 {seq,user_id,nickname,text,ts}
+- append 时增量维护最近 context_n 句的 "[HISTORY]" 文本，chat_line 直接取缓存，不再每次重拼
+- window()：在 context_n 句里从最新往前取，总长度不超过 char_budget
+  （ChatGPT 插话 prompt 会把 scene_user 截到 800 字符；从头截会丢掉最新的几句，这里改为丢最旧的）
+"""
+
+from collections import deque
+
+HISTORY_HEADER = "[HISTORY]"
+HISTORY_CHAR_BUDGET = 800  # 与 CoreChatgpt 插话 / fused prompt 里 scene_user[-800:] 保持一致
+
+
+def format_line(item: dict) -> str:
+    return f'{item.get("nickname","anon")}: {item.get("text","")}'
+
+
+class ChatHistory:
+    def __init__(self, maxlen: int, context_n: int, char_budget: int = HISTORY_CHAR_BUDGET):
+        self.context_n = context_n
+        self.char_budget = char_budget
+        self._items = deque(maxlen=maxlen)
+        self._lines = deque(maxlen=context_n)  # 最近 context_n 句的格式化行
+        self._context = ""
+        self._window = ""
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def append(self, item: dict):
+        self._items.append(item)
+        self._lines.append(format_line(item))
+        self._context = "\n".join((HISTORY_HEADER, *self._lines)) if self._lines else ""
+        self._window = self._fit(self.char_budget)
+
+    def clear(self):
+        self._items.clear()
+        self._lines.clear()
+        self._context = ""
+        self._window = ""
+
+    def _fit(self, budget: int) -> str:
+        # 从最新一句往前累加，超出预算就停（header 和换行都计入）
+        used = len(HISTORY_HEADER)
+        keep = []
+        for line in reversed(self._lines):
+            used += 1 + len(line)
+            if used > budget:
+                break
+            keep.append(line)
+        if not keep:
+            # 最新一句本身就超预算：保留它的开头，和原来 [:budget] 的效果一致
+            if not self._lines:
+                return ""
+            return "\n".join((HISTORY_HEADER, self._lines[-1]))[:budget]
+        keep.reverse()
+        return "\n".join((HISTORY_HEADER, *keep))
+
+    def context(self, n: int = None) -> str:
+        """最近 n 句（默认 context_n）拼成的 [HISTORY] 文本；n == context_n 时直接返回缓存，n <= 0 返回空串。"""
+        if n is None or n == self.context_n:
+            return self._context
+        if n <= 0 or not self._items:
+            return ""
+        tail = list(self._items)[-n:]
+        return "\n".join((HISTORY_HEADER, *(format_line(it) for it in tail)))
+
+    def window(self, char_budget: int = None) -> str:
+        """最近 context_n 句中、总长不超过 char_budget 的最新若干句；默认预算直接返回缓存。"""
+        if char_budget is None or char_budget == self.char_budget:
+            return self._window
+        return self._fit(char_budget)
@@ -4,24 +4,30 @@
 """
 ✅ 与 Connection2Unity1203.py 的 LoRA 调用方式完全一致（关键点）：
 - tokenizer = AutoTokenizer.from_pretrained
-- base_model = AutoModelForSequenceClassification(num_labels=1, fp16)
+- base_model = AutoModelForSequenceClassification(num_labels=1, fp16)（CPU 上按 CPU_PRECISION：fp32 / bf16 / int8）
 - reg_model = PeftModel.from_pretrained(base_model, PERSONA_LORA, adapter_name="persona")
 - reg_model.load_adapter(scene/topic)
 - willingness 推理：logits.squeeze(-1).item() -> clamp 到 [0,1]（不做 sigmoid）
 
 本文件额外提供：
 - build_scene_prompt_from_fields：给 Websocket 的 scene_fields 消息用（不会影响 LoRA 计算）
-- infer_once：跑 persona/scene/topic 三路 willingness，final>THRESHOLD 时调用 ChatGPT 给 strategy + insert（不加载第二个 7B）
+- infer_once / infer_batch：跑 persona/scene/topic 三路 willingness（默认合并为一次 mixed-adapter 前向），final>THRESHOLD 时调用 ChatGPT 给 strategy + insert（不加载第二个 7B）
+- generate_insert：触发后的 ChatGPT strategy + insert；infer_batch(with_insert=False) 时由 Websocket 在 GPU 之外单独调用
+- build_merged_heads（MERGED_HEADS=True 时自动调用）：每个头预合并 LoRA 覆盖的权重，前向换指针而不跑 LoRA 旁路
 - debug_inputs 回传给前端（方便你在 UI 里看三路 LoRA 实际吃到的文本）
 """
 
 import json
 import time
 import re
+import hashlib
+import threading
+from collections import OrderedDict
 import torch
 
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from peft import PeftModel
+from peft.tuners.lora import LoraLayer
 from openai import OpenAI
 
 # ================== 路径配置（按你项目实际路径） ==================
@@ -32,9 +38,38 @@ SCENE_LORA   = r"D:\Task_design\Scene\outputs\qwen7b-lora-will_half_fp16_v2\chec
 TOPIC_LORA   = r"D:\Task_design\Topic\willingness_train\outputs\qwen7b-lora-topic_willingness\checkpoint-2500"
 
 MAX_LENGTH = 256
+# False：按 batch 内最长序列动态 padding（分数与 max_length padding 一致，对比见 BenchPadding.py）
+PAD_TO_MAX_LENGTH = False
+# 动态 padding 时按 token 长度分桶，同一桶的行一起前向（短句不再陪长句补齐）；None 则整批一次前向
+LENGTH_BUCKETS = (32, 64, 128, MAX_LENGTH)
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# CPU 上的推理精度（CUDA 上始终 fp16），准确率对比见 BenchPrecision.py：
+# "fp32" / "bf16" / "int8_dynamic"（torch 动态量化 Linear）/ "int8_weight_only"（torchao，可选依赖）
+# 量化只作用于 base 模型的 Linear；LoRA A/B、score 头保持原精度
+CPU_PRECISION = "fp32"
 THRESHOLD = 0.60
 
+# persona/scene/topic 三路合并为一次前向（PEFT mixed-adapter batch，每行走自己的 LoRA）
+# False 则回到逐路 set_adapter + 前向的旧流程
+BATCH_HEADS = True
+# scene 头分数按场景文本缓存（场景不变时每条发言只需跑 persona/topic 两路），LRU 上限 SCENE_SCORE_CACHE_MAX 个场景
+SCENE_SCORE_CACHE = True
+SCENE_SCORE_CACHE_MAX = 256
+# persona 头复用每个用户 profile 前缀的 KV（只跑 [UTTERANCE] 后缀），LRU 上限 PERSONA_PREFIX_CACHE_MAX 个用户
+# 默认关闭：开启后 persona 头不再并进 BATCH_HEADS 的合并前向，每条发言多一次串行后缀前向；
+# 是否更快取决于负载，先用 BenchPipeline.py --persona-prefix-cache 在批量负载下对比后再开
+PERSONA_PREFIX_CACHE = False
+PERSONA_PREFIX_CACHE_MAX = 64
+# 每个头预先算好合并后的权重（W + B·A·scaling，仅 LoRA 覆盖、权重未量化的 Linear），前向时换指针，不再跑 LoRA 旁路 matmul；
+# 其余权重三头共用。合并模式下不走 mixed-adapter batch，按头分组前向。内存开销见 BenchMerged.py
+MERGED_HEADS = False
+# Rust tokenizer：init 时在探测文本上与慢速 tokenizer 逐 token 对比，不一致就退回慢速
+TOKENIZER_FAST = True
+# 按 "\n\n" 边界切段分词并缓存每段的 token id（scene suffix / topic / profile JSON 每轮都一样，只有发言是新的）
+# "\n\n" 后接非空白字符处必是 Qwen 预分词边界，拼接结果与整句分词一致（init 时同样用探测文本验证）
+TOKEN_SEGMENT_CACHE = True
+TOKEN_SEGMENT_CACHE_MAX = 4096
+
 # ChatGPT 侧模型
 OPENAI_MODEL = "gpt-4o-mini-2024-07-18"
 client = OpenAI()
@@ -93,13 +128,68 @@ def build_scene_prompt_from_fields(fields: dict) -> str:
 # ================== 模型（只加载一次） ==================
 tokenizer = None
 reg_model = None  # PeftModel with adapters: persona/scene/topic
+_MIXED_BATCH_OK = True  # 当前 PEFT 版本是否支持 forward(adapter_names=...)；首次失败或 init 时校验不一致后置 False
+MIXED_BATCH_TOLERANCE = 1e-3  # mixed-adapter batch 与逐 adapter 前向的 willingness 允许的最大差值（fp16 舍入）
+_MIXED_BATCH_PROBES = (
+    "好的",
+    "我觉得这个方案还可以再想想",
+    "[PROFILE] {\"background\": \"传播学大四学生\"}\n\n[UTTERANCE] 我们要不要先把截止日期排个序？",
+)
 
 def _now_ms() -> float:
     return time.perf_counter() * 1000.0
 
+def _precision() -> str:
+    return "fp16" if DEVICE.type == "cuda" else CPU_PRECISION
+
+def _base_dtype():
+    if DEVICE.type == "cuda":
+        return torch.float16
+    if CPU_PRECISION == "bf16":
+        return torch.bfloat16
+    if CPU_PRECISION in ("fp32", "int8_dynamic", "int8_weight_only"):
+        return torch.float32
+    raise ValueError(f"unknown CPU_PRECISION: {CPU_PRECISION!r}")
+
+def _quantizable_linear(name: str, module) -> bool:
+    # 只量化 base 权重：LoRA 的 A/B、分类头（score / modules_to_save）保持原精度
+    if not isinstance(module, torch.nn.Linear):
+        return False
+    return not any(k in name for k in ("lora_", "modules_to_save", "original_module", "score"))
+
+def _quantize_cpu(model):
+    """在 adapter 加载完之后量化（PEFT 加载 LoRA 需要原始 nn.Linear）。"""
+    if CPU_PRECISION == "int8_dynamic":
+        names = {name for name, m in model.named_modules() if _quantizable_linear(name, m)}
+        torch.ao.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8, inplace=True)
+        return len(names)
+
+    if CPU_PRECISION == "int8_weight_only":
+        try:
+            from torchao.quantization import quantize_
+        except ImportError as e:
+            raise ImportError("CPU_PRECISION='int8_weight_only' 需要 torchao（pip install torchao）") from e
+        try:
+            from torchao.quantization import Int8WeightOnlyConfig
+            config = Int8WeightOnlyConfig()
+        except ImportError:
+            from torchao.quantization import int8_weight_only
+            config = int8_weight_only()
+        names = []
+        def _filter(module, fqn):
+            ok = _quantizable_linear(fqn, module)
+            if ok:
+                names.append(fqn)
+            return ok
+        quantize_(model, config, filter_fn=_filter)
+        return len(names)
+
+    return 0
+
 def init_models():
     """
     ✅ 与 Connection2Unity1203.py 完全一致的加载流程。
+    CPU 上按 CPU_PRECISION 选择 dtype / 量化（adapter 加载完之后再量化）。
     """
     global tokenizer, reg_model
     if tokenizer is not None and reg_model is not None:
@@ -107,16 +197,17 @@ def init_models():
 
     if DEBUG_LOG:
         print("Loading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=False)
+    tokenizer = _load_tokenizer()
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
+    _verify_segment_cache()
 
     if DEBUG_LOG:
         print("Loading base regression model...")
     base_model = AutoModelForSequenceClassification.from_pretrained(
         BASE_MODEL,
         num_labels=1,
-        torch_dtype=torch.float16 if DEVICE.type == "cuda" else torch.float32,
+        torch_dtype=_base_dtype(),
     )
     base_model.config.pad_token_id = tokenizer.pad_token_id
 
@@ -147,23 +238,222 @@ def init_models():
 
     if DEVICE.type == "cuda":
         assert next(reg_model.parameters()).is_cuda, "[device_check] reg_model not on CUDA"
+    else:
+        n_quant = _quantize_cpu(reg_model)
+        if DEBUG_LOG and n_quant:
+            print(f"Quantized {n_quant} base Linear layers ({CPU_PRECISION})")
+
+    _verify_mixed_batch()
+
+    if MERGED_HEADS:
+        build_merged_heads()
 
     if DEBUG_LOG:
-        print("Regression model with 3 LoRA heads loaded on:", DEVICE)
+        print("Regression model with 3 LoRA heads loaded on:", DEVICE, _precision())
+
+def unload_models():
+    """释放模型和依赖模型输出的缓存（切换 CPU_PRECISION 后重新 init_models 用，见 BenchPrecision.py）。"""
+    global tokenizer, reg_model, _MIXED_BATCH_OK, _MERGED_ACTIVE, _MERGED_MODULES
+    tokenizer = None
+    reg_model = None
+    _MIXED_BATCH_OK = True
+    _MERGED.clear()
+    _BASE_WEIGHTS.clear()
+    _MERGED_ACTIVE = None
+    _MERGED_MODULES = []
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.clear()
+    invalidate_scene_cache()
+    with _PERSONA_PREFIX_LOCK:
+        _PERSONA_PREFIX.clear()
+
+# ================== 按头合并的权重 ==================
+HEAD_ADAPTERS = ("persona", "scene", "topic")
+_MERGED = {}        # adapter -> {module_name: 合并后的 weight Parameter}
+_BASE_WEIGHTS = {}  # module_name -> 原始 weight（只保留还有头没覆盖到的模块）
+_MERGED_ACTIVE = None
+_MERGED_MODULES = []  # build_merged_heads 时缓存的 _lora_modules()，切头时不再遍历整个模型
+
+def _mergeable_base(m) -> bool:
+    # 只合并权重是普通浮点 Tensor 的 Linear：int8_dynamic 换掉了 Linear 本身，
+    # torchao int8_weight_only 仍是 nn.Linear 但 weight 是量化张量子类，W + delta 没有意义
+    base = m.get_base_layer()
+    if not isinstance(base, torch.nn.Linear):
+        return False
+    w = base.weight
+    return type(w.data) is torch.Tensor and w.dtype.is_floating_point
+
+def _lora_modules() -> list:
+    # 量化过的 base_layer 不合并，仍按普通 LoRA 旁路跑
+    return [(name, m) for name, m in reg_model.named_modules()
+            if isinstance(m, LoraLayer) and _mergeable_base(m)]
+
+@torch.inference_mode()
+def build_merged_heads():
+    """为每个头算 W + delta（只算该头 LoRA 覆盖的模块）；三个头都覆盖的模块不再保留原始 W。"""
+    global _MERGED_ACTIVE, _MERGED_MODULES
+    _MERGED.clear()
+    _BASE_WEIGHTS.clear()
+    _MERGED_MODULES = _lora_modules()
+    n_skipped = sum(isinstance(m, LoraLayer) for _, m in reg_model.named_modules()) - len(_MERGED_MODULES)
+    if n_skipped:
+        print(f"[merged] {n_skipped} 个 LoRA 模块的 base 权重不是浮点 Tensor（CPU_PRECISION={CPU_PRECISION}），"
+              f"不合并，仍走 LoRA 旁路")
+    for name, m in _MERGED_MODULES:
+        base = m.get_base_layer()
+        w = base.weight
+        covered = [a for a in HEAD_ADAPTERS if a in m.lora_A]
+        for a in covered:
+            merged = (w.data + m.get_delta_weight(a).to(w.dtype)).contiguous()
+            _MERGED.setdefault(a, {})[name] = torch.nn.Parameter(merged, requires_grad=False)
+        if len(covered) < len(HEAD_ADAPTERS):
+            _BASE_WEIGHTS[name] = w
+    _MERGED_ACTIVE = None
+    _use_adapter(HEAD_ADAPTERS[0])  # 换掉模块上的原始 W 引用，三头都覆盖的原始 W 随之释放
+    # 前缀 KV 是旧权重路径算的（数值上等价，但不混用）
+    with _PERSONA_PREFIX_LOCK:
+        _PERSONA_PREFIX.clear()
+    if DEBUG_LOG:
+        print(f"[merged] heads={list(_MERGED)} modules={sum(len(v) for v in _MERGED.values())} kept_base={len(_BASE_WEIGHTS)}")
+
+def _activate_merged(adapter_name: str):
+    """把每个 LoRA 模块的 base weight 指到该头的合并权重，并标记为 merged（PEFT 前向只跑 base_layer）。"""
+    global _MERGED_ACTIVE
+    if _MERGED_ACTIVE == adapter_name:
+        return
+    modules = _MERGED_MODULES
+    # 先清掉 merged 标记再 set_adapter：LoraModel.set_adapter 遇到 merged 模块会 unmerge（原地减 delta）
+    for _, m in modules:
+        m.merged_adapters = []
+    reg_model.set_adapter(adapter_name)  # score 头（modules_to_save）仍按 adapter 切换
+    head = _MERGED.get(adapter_name, {})
+    for name, m in modules:
+        w = head.get(name)
+        if w is not None:
+            m.get_base_layer().weight = w
+            m.merged_adapters = [adapter_name]
+        else:
+            m.get_base_layer().weight = _BASE_WEIGHTS[name]
+    _MERGED_ACTIVE = adapter_name
+
+def _use_adapter(adapter_name: str):
+    if _MERGED:
+        _activate_merged(adapter_name)
+    else:
+        reg_model.set_adapter(adapter_name)
+
+def merged_memory_report() -> dict:
+    """
+    参数内存（MB）：
+    - shared：LoRA 没覆盖的权重（三头共用）
+    - lora_base：LoRA 覆盖模块的原始 W（合并模式下只剩还有头没覆盖的）
+    - lora：LoRA A/B（未合并时每次前向都要多跑的旁路）
+    - merged：各头的合并权重
+    """
+    mb = lambda n: round(n / 2**20, 1)
+    nbytes = lambda t: t.numel() * t.element_size()
+    modules = _lora_modules()
+    module_weights = {id(m.get_base_layer().weight) for _, m in modules}
+    shared = sum(nbytes(p) for n, p in reg_model.named_parameters()
+                 if "lora_" not in n and id(p) not in module_weights)
+    lora = sum(nbytes(p) for n, p in reg_model.named_parameters() if "lora_" in n)
+    if _MERGED:
+        lora_base = sum(nbytes(w) for w in _BASE_WEIGHTS.values())
+    else:
+        lora_base = sum(nbytes(m.get_base_layer().weight) for _, m in modules)
+    merged = sum(nbytes(w) for head in _MERGED.values() for w in head.values())
+    return {
+        "merged_heads": bool(_MERGED),
+        "shared_mb": mb(shared),
+        "lora_base_mb": mb(lora_base),
+        "lora_mb": mb(lora),
+        "merged_mb": mb(merged),
+        "total_mb": mb(shared + lora_base + lora + merged),
+    }
+
+# ================== tokenizer ==================
+_SEGMENT_SPLIT = re.compile(r"(?<=\n\n)(?=\S)")  # 一段空行之后、下一段正文之前
+_TOKEN_CACHE = OrderedDict()  # 段文本 -> token ids（不含特殊 token），LRU
+_TOKEN_CACHE_LOCK = threading.Lock()
+TOKEN_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def _tokenizer_probes() -> list:
+    profile = {"background": "传播学大四学生，正在准备申研", "personality_traits": ["内向", "认真"], "speaking_style": "简短", "values": ""}
+    scene = build_scene_prompt_from_fields({"time_of_day": "晚上", "formality": "非正式", "domain": "学习", "participants": "4"})
+    utterances = ["好的", "哈哈哈😂 真的吗？？", "I think we should   sort the deadlines first.\n\n然后再说", "a.\n\n\n  [b]\t(c)"]
+    probes = [SCENE_WILLINGNESS_SUFFIX, build_scene_text(scene, ""), build_persona_prefix("", profile)]
+    for u in utterances:
+        probes.append(build_persona_text("", profile, u))
+        probes.append(build_topic_text("Preparing graduate school applications while balancing coursework.", u))
+    return probes
+
+def _load_tokenizer():
+    slow = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=False)
+    if not TOKENIZER_FAST:
+        return slow
+    try:
+        fast = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=True)
+    except Exception as e:
+        # 模型没有 Rust tokenizer 是正常配置，慢速 tokenizer 本来就是默认路径
+        if DEBUG_LOG:
+            print("[tokenizer] fast tokenizer unavailable, using slow:", repr(e))
+        return slow
+    if not getattr(fast, "is_fast", False):
+        if DEBUG_LOG:
+            print("[tokenizer] no fast tokenizer for this model, using slow")
+        return slow
+    # ids 不一致的回退（和 _verify_segment_cache / _verify_mixed_batch 一样）说明探测到了结果差异，始终打印
+    for text in _tokenizer_probes():
+        if fast(text)["input_ids"] != slow(text)["input_ids"]:
+            print(f"[tokenizer] fast/slow token ids differ on {text[:40]!r}, using slow")
+            return slow
+    if DEBUG_LOG:
+        print("[tokenizer] using fast tokenizer (ids verified)")
+    return fast
+
+def _segment_ids(seg: str) -> list:
+    with _TOKEN_CACHE_LOCK:
+        ids = _TOKEN_CACHE.get(seg)
+        if ids is not None:
+            _TOKEN_CACHE.move_to_end(seg)
+            TOKEN_CACHE_STATS["hits"] += 1
+            return ids
+    ids = tokenizer(seg, add_special_tokens=False)["input_ids"]
+    with _TOKEN_CACHE_LOCK:
+        TOKEN_CACHE_STATS["misses"] += 1
+        _TOKEN_CACHE[seg] = ids
+        while len(_TOKEN_CACHE) > TOKEN_SEGMENT_CACHE_MAX:
+            _TOKEN_CACHE.popitem(last=False)
+    return ids
+
+def _token_ids(text: str) -> list:
+    """按段拼接缓存的 token id，再按 MAX_LENGTH 截断、加特殊 token（与 tokenizer(text, truncation=True) 一致）。"""
+    ids = []
+    for seg in _SEGMENT_SPLIT.split(text):
+        ids.extend(_segment_ids(seg))
+    ids = ids[:MAX_LENGTH - tokenizer.num_special_tokens_to_add(False)]
+    return tokenizer.build_inputs_with_special_tokens(ids)
+
+def _verify_segment_cache():
+    global TOKEN_SEGMENT_CACHE
+    if not TOKEN_SEGMENT_CACHE:
+        return
+    for text in _tokenizer_probes():
+        if _token_ids(text) != tokenizer(text, truncation=True, max_length=MAX_LENGTH)["input_ids"]:
+            print(f"[tokenizer] segmented ids differ on {text[:40]!r}, segment cache disabled")
+            TOKEN_SEGMENT_CACHE = False
+            break
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.clear()
+
+def _padding_kwargs() -> dict:
+    if PAD_TO_MAX_LENGTH:
+        return {"padding": "max_length", "max_length": MAX_LENGTH}
+    return {"padding": "longest"}
 
 @torch.inference_mode()
 def _encode(text: str) -> dict:
-    enc = tokenizer(
-        text,
-        return_tensors="pt",
-        padding="max_length",
-        truncation=True,
-        max_length=MAX_LENGTH,
-    )
-    enc = {k: v.to(DEVICE) for k, v in enc.items()}
-    if DEVICE.type == "cuda":
-        assert enc["input_ids"].is_cuda and enc["attention_mask"].is_cuda, "[device_check] inputs not on CUDA"
-    return enc
+    return _pad_batch(_tokenize_batch([text]))
 
 @torch.inference_mode()
 def _run_willingness(adapter_name: str, text: str) -> float:
@@ -178,7 +468,7 @@ def _run_willingness(adapter_name: str, text: str) -> float:
     if not text:
         return 0.0
 
-    reg_model.set_adapter(adapter_name)
+    _use_adapter(adapter_name)
     enc = _encode(text)
 
     logits = reg_model(**enc).logits.squeeze(-1).item()
@@ -197,10 +487,114 @@ def _run_willingness(adapter_name: str, text: str) -> float:
     return val
 
 
+def _tokenize_batch(texts: list) -> list:
+    """只分词 + 截断，不 padding；返回每行的 input_ids 列表（用于按长度分桶）。"""
+    if not TOKEN_SEGMENT_CACHE:
+        return tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]
+    return [_token_ids(t) for t in texts]
+
+@torch.inference_mode()
+def _pad_batch(ids_list: list) -> dict:
+    enc = tokenizer.pad({"input_ids": ids_list}, return_tensors="pt", **_padding_kwargs())
+    enc = {k: v.to(DEVICE) for k, v in enc.items()}
+    if DEVICE.type == "cuda":
+        assert enc["input_ids"].is_cuda and enc["attention_mask"].is_cuda, "[device_check] inputs not on CUDA"
+    return enc
+
+def _bucket_by_length(lengths: list) -> list:
+    """
+    按 LENGTH_BUCKETS 把行号分组：每行进入第一个上界 >= 其长度的桶。
+    固定 padding 或未配置分桶时整批一组。
+    """
+    if PAD_TO_MAX_LENGTH or not LENGTH_BUCKETS:
+        return [list(range(len(lengths)))]
+    groups = {}
+    for i, n in enumerate(lengths):
+        bound = next((b for b in LENGTH_BUCKETS if n <= b), MAX_LENGTH)
+        groups.setdefault(bound, []).append(i)
+    return [groups[b] for b in sorted(groups)]
+
+@torch.inference_mode()
+def _forward_logits(adapter_names: list, ids_list: list) -> torch.Tensor:
+    """
+    一次前向算出多行 logits，每行使用 adapter_names 中对应的 LoRA。
+    优先走 PEFT mixed-adapter batch；不支持时按 adapter 分组，每组一次前向。
+    """
+    global _MIXED_BATCH_OK
+    enc = _pad_batch(ids_list)
+
+    if _MIXED_BATCH_OK and not _MERGED:
+        try:
+            return reg_model(**enc, adapter_names=adapter_names).logits.squeeze(-1)
+        except (TypeError, ValueError) as e:
+            _MIXED_BATCH_OK = False
+            if DEBUG_LOG:
+                print("[batch] mixed-adapter batch unsupported, fallback to grouped:", repr(e))
+
+    logits = torch.empty(len(ids_list), device=DEVICE)
+    for name in dict.fromkeys(adapter_names):
+        idx = [i for i, a in enumerate(adapter_names) if a == name]
+        _use_adapter(name)
+        sub = {k: v[idx] for k, v in enc.items()}
+        logits[idx] = reg_model(**sub).logits.squeeze(-1).to(logits.dtype)
+    return logits
+
+@torch.inference_mode()
+def _verify_mixed_batch():
+    """
+    init 时用固定输入对比 mixed-adapter batch 与按 adapter 分组的前向（三头 × 探针句同一批）。
+    有的 PEFT 版本接受 adapter_names 却不按行路由 modules_to_save 的 score 头（所有行都用同一个头打分），
+    不会报错；差值超过 MIXED_BATCH_TOLERANCE 时关闭 mixed batch，之后都走分组前向。
+    """
+    global _MIXED_BATCH_OK
+    if not _MIXED_BATCH_OK:
+        return
+    names = [a for a in HEAD_ADAPTERS for _ in _MIXED_BATCH_PROBES]
+    ids_list = _tokenize_batch(list(_MIXED_BATCH_PROBES) * len(HEAD_ADAPTERS))
+    mixed = torch.sigmoid(_forward_logits(names, ids_list).float())
+    if not _MIXED_BATCH_OK:  # 前向时已因不支持 adapter_names 回退
+        return
+    _MIXED_BATCH_OK = False
+    grouped = torch.sigmoid(_forward_logits(names, ids_list).float())
+    diff = (mixed - grouped).abs().max().item()
+    _MIXED_BATCH_OK = diff <= MIXED_BATCH_TOLERANCE
+    if not _MIXED_BATCH_OK:
+        print(f"[batch] mixed-adapter batch differs from grouped forward (max diff {diff:.5f}), disabled")
+    elif DEBUG_LOG:
+        print(f"[batch] mixed-adapter batch verified (max diff {diff:.5f})")
+
+@torch.inference_mode()
+def _run_willingness_batch(items: list) -> list:
+    """
+    items: [(adapter_name, text), ...]，所有行合并打分（动态 padding 时按长度分桶，每桶一次前向）。
+    返回与 items 对齐的 willingness 列表；与 _run_willingness 相同：
+    空文本记 0.0，其余 sigmoid 后 clamp 到 [0,1]。整批只在最后同步一次（.tolist()）。
+    """
+    vals = [0.0] * len(items)
+    rows = [(i, a, (t or "").strip()) for i, (a, t) in enumerate(items)]
+    rows = [r for r in rows if r[2]]
+    if not rows:
+        return vals
+
+    ids_list = _tokenize_batch([t for _, _, t in rows])
+    logits = torch.empty(len(rows), device=DEVICE)
+    for group in _bucket_by_length([len(ids) for ids in ids_list]):
+        logits[group] = _forward_logits(
+            [rows[j][1] for j in group],
+            [ids_list[j] for j in group],
+        ).to(logits.dtype)
+    probs = torch.sigmoid(logits).clamp(0.0, 1.0).tolist()
+
+    for (i, a, _), v in zip(rows, probs):
+        vals[i] = v
+        if DEBUG_LOG:
+            print(f"[{a}] sigmoid={v:.4f} (batched)")
+    return vals
+
+
 # ================== 输入拼接（对齐 Connection2Unity1203.py） ==================
-def build_persona_text(persona_raw: str, profile_json, utterance: str) -> str:
+def _persona_prefix_parts(persona_raw: str, profile_json) -> list:
     persona_raw = (persona_raw or "").strip()
-    utterance = (utterance or "").strip()
 
     profile = ""
     if isinstance(profile_json, dict):
@@ -218,10 +612,25 @@ def build_persona_text(persona_raw: str, profile_json, utterance: str) -> str:
         parts.append(f"[PERSONA_RAW] {persona_raw}")
     if profile:
         parts.append(f"[PROFILE] {profile}")
+    return parts
+
+def build_persona_text(persona_raw: str, profile_json, utterance: str) -> str:
+    utterance = (utterance or "").strip()
+    parts = _persona_prefix_parts(persona_raw, profile_json)
     if utterance:
         parts.append(f"[UTTERANCE] {utterance}")
     return "\n\n".join(parts)
 
+def build_persona_prefix(persona_raw: str, profile_json) -> str:
+    """
+    build_persona_text 里 [UTTERANCE] 之前的部分（含分隔空行）；同一用户每条发言都相同。
+    没有 persona/profile 时返回空串。
+    """
+    parts = _persona_prefix_parts(persona_raw, profile_json)
+    if not parts:
+        return ""
+    return "\n\n".join(parts) + "\n\n"
+
 def build_scene_text(scene_system: str, scene_user: str) -> str:
     sys = (scene_system or "").strip()
     usr = (scene_user or "").strip()
@@ -256,6 +665,116 @@ def build_topic_text(topic_en: str, utterance: str) -> str:
     return "\n\n".join(parts)
 
 
+# ================== scene 分数缓存 ==================
+# scene 头输入 = build_scene_text(scene_system, "")，不含历史和发言：
+# 分数只取决于场景文本，按 (scene 文本, adapter checkpoint) 内容寻址：场景改了自然换 key，
+# 不需要在 scene_prompt / scene_fields 更新时清空（多个房间的场景可以同时留在缓存里），旧 key 由 LRU 淘汰。
+_SCENE_SCORES = OrderedDict()  # sha1 -> willingness，LRU
+_SCENE_SCORES_LOCK = threading.Lock()
+
+def _scene_cache_key(scene_text: str) -> str:
+    return hashlib.sha1(f"{SCENE_LORA}\n{scene_text}".encode("utf-8")).hexdigest()
+
+def _scene_cache_get(scene_text: str):
+    if not SCENE_SCORE_CACHE:
+        return None
+    key = _scene_cache_key(scene_text)
+    with _SCENE_SCORES_LOCK:
+        val = _SCENE_SCORES.get(key)
+        if val is not None:
+            _SCENE_SCORES.move_to_end(key)
+    return val
+
+def _scene_cache_put(scene_text: str, val: float):
+    if not SCENE_SCORE_CACHE:
+        return
+    with _SCENE_SCORES_LOCK:
+        _SCENE_SCORES[_scene_cache_key(scene_text)] = val
+        while len(_SCENE_SCORES) > SCENE_SCORE_CACHE_MAX:
+            _SCENE_SCORES.popitem(last=False)
+
+def invalidate_scene_cache():
+    """丢弃全部 scene 分数（unload_models 换模型时用；场景文本变化不需要调用）。"""
+    with _SCENE_SCORES_LOCK:
+        _SCENE_SCORES.clear()
+
+
+# ================== persona 前缀 KV 缓存 ==================
+# persona 头输入 = [PROFILE] <json> + [UTTERANCE] <发言>，同一用户的 profile 部分每条都一样：
+# profile 前缀的 past_key_values 每个 (profile 文本, adapter checkpoint) 只算一次，之后只跑发言后缀。
+# 仅当“前缀单独分词”恰好是“整句分词”的前缀时才走缓存，因此后缀 token 与整句路径完全一致。
+_PERSONA_PREFIX = OrderedDict()  # sha1 -> (prefix_ids, past_key_values)，LRU
+_PERSONA_PREFIX_LOCK = threading.Lock()
+
+def _persona_prefix_key(prefix: str) -> str:
+    return hashlib.sha1(f"{PERSONA_LORA}\n{prefix}".encode("utf-8")).hexdigest()
+
+def invalidate_persona_prefix(persona_profile):
+    """Websocket 收到 persona_profile 更新时调用：丢弃该用户旧 profile 的前缀缓存。"""
+    key = _persona_prefix_key(build_persona_prefix("", persona_profile))
+    with _PERSONA_PREFIX_LOCK:
+        _PERSONA_PREFIX.pop(key, None)
+
+@torch.inference_mode()
+def _run_persona_with_prefix(persona_profile, persona_text: str):
+    """
+    返回 (willingness, 状态)。状态：hit / miss（本次新算前缀）/ skip（不适用，willingness 为 None，
+    调用方走普通路径：没有前缀、分词边界对不上、或截断后没有后缀）。
+    """
+    if not PERSONA_PREFIX_CACHE:
+        return None, "off"
+    prefix = build_persona_prefix("", persona_profile)
+    persona_text = (persona_text or "").strip()
+    if not prefix or not persona_text:
+        return None, "skip"
+
+    full_ids = _tokenize_batch([persona_text])[0]
+    key = _persona_prefix_key(prefix)
+    with _PERSONA_PREFIX_LOCK:
+        entry = _PERSONA_PREFIX.get(key)
+        if entry is not None:
+            _PERSONA_PREFIX.move_to_end(key)
+    status = "hit"
+
+    _use_adapter("persona")
+    if entry is None:
+        prefix_ids = _tokenize_batch([prefix])[0]
+        if len(full_ids) <= len(prefix_ids) or full_ids[:len(prefix_ids)] != prefix_ids:
+            return None, "skip"
+        ids = torch.tensor([prefix_ids], device=DEVICE)
+        out = reg_model(input_ids=ids, attention_mask=torch.ones_like(ids), use_cache=True)
+        entry = (prefix_ids, out.past_key_values)
+        status = "miss"
+        with _PERSONA_PREFIX_LOCK:
+            _PERSONA_PREFIX[key] = entry
+            while len(_PERSONA_PREFIX) > PERSONA_PREFIX_CACHE_MAX:
+                _PERSONA_PREFIX.popitem(last=False)
+
+    prefix_ids, past = entry
+    n = len(prefix_ids)
+    if len(full_ids) <= n or full_ids[:n] != prefix_ids:
+        return None, "skip"
+
+    suffix = torch.tensor([full_ids[n:]], device=DEVICE)
+    mask = torch.ones((1, len(full_ids)), dtype=torch.long, device=DEVICE)
+    try:
+        logits = reg_model(
+            input_ids=suffix,
+            attention_mask=mask,
+            past_key_values=past,
+            use_cache=True,
+        ).logits.squeeze(-1)
+    finally:
+        # DynamicCache 会把后缀追加进去，裁回前缀长度以便下次复用
+        if hasattr(past, "crop"):
+            past.crop(n)
+
+    val = torch.sigmoid(logits.float()).clamp(0.0, 1.0).item()
+    if DEBUG_LOG:
+        print(f"[persona] prefix={status} prefix_len={n} suffix_len={len(full_ids) - n} sigmoid={val:.4f}")
+    return val, status
+
+
 # ================== ChatGPT strategy + insert ==================
 def _extract_json_block(s: str):
     if not s:
@@ -406,14 +925,8 @@ Return JSON only:
     return {"strategy": strategy, "insert": insert, "raw": raw}
 
 
-# ================== 主推理：infer_once ==================
-def infer_once(
-    persona_profile: dict,
-    topic_en: str,
-    scene_system: str,
-    scene_user: str,
-    utterance: str,
-) -> dict:
+# ================== 主推理：infer_once / infer_batch ==================
+def _prepare_job(job: dict) -> dict:
     """
     ✅ 关键行为（按你的要求）：
     1) 三路 LoRA willingness 计算时：只使用“固定场景 scene_system”，不引入对话历史
@@ -422,53 +935,65 @@ def infer_once(
     2) 只有当 final > THRESHOLD 需要 agent 响应时，才把对话历史 scene_user 传给 ChatGPT 作为参考
        （history 不会影响 LoRA willingness）
     """
-    t0 = _now_ms()
-    init_models()
-    t_after_init = _now_ms()
-
-    utterance = (utterance or "").strip()
-    topic_en = topic_en or ""
-    scene_system = scene_system or ""
-    history_ctx = (scene_user or "").strip()  # ✅ 仅供 ChatGPT 参考，不参与 LoRA 评分
-
-    # ===== build inputs (LoRA heads) =====
-    t_build0 = _now_ms()
-
-    persona_text = build_persona_text("", persona_profile, utterance)
-
-    # ✅ scene 头：不吃历史
-    scene_text_for_heads = build_scene_text(scene_system, "")
-
-    # ✅ topic 头：不吃历史（只看 topic + 当前 utterance）
-    topic_text = build_topic_text(topic_en, utterance)
+    persona_profile = job.get("persona_profile")
+    utterance = (job.get("utterance") or "").strip()
+    topic_en = job.get("topic_en") or ""
+    scene_system = job.get("scene_system") or ""
+    return {
+        "persona_profile": persona_profile,
+        "topic_en": topic_en,
+        "scene_system": scene_system,
+        "history_ctx": (job.get("scene_user") or "").strip(),  # ✅ 仅供 ChatGPT 参考，不参与 LoRA 评分
+        "utterance": utterance,
+        "persona_text": build_persona_text("", persona_profile, utterance),
+        "scene_text": build_scene_text(scene_system, ""),      # ✅ scene 头：不吃历史
+        "topic_text": build_topic_text(topic_en, utterance),   # ✅ topic 头：不吃历史（只看 topic + 当前 utterance）
+    }
 
-    t_build1 = _now_ms()
+def generate_insert(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> dict:
+    """
+    触发后的 ChatGPT strategy + insert（含失败兜底），返回 {"strategy", "insert", "ms_strategy"}。
+    infer_batch(with_insert=False) 时由调用方在 GPU 之外单独调用。
+    """
+    ts0 = _now_ms()
+    try:
+        res = ask_chatgpt_for_insert_and_strategy(
+            persona_profile=persona_profile,
+            topic_en=topic_en or "",
+            utterance=(utterance or "").strip(),
+            scene_system=scene_system or "",
+            scene_user=(scene_user or "").strip(),
+        )
+        strategy = res.get("strategy", "unspecified")
+        insert_text = res.get("insert", "")
+    except Exception as e:
+        if DEBUG_LOG:
+            print("[agent_core] ChatGPT failed:", repr(e))
+        strategy = "fallback"
+        insert_text = "我理解你现在很难受，我们先稳住情绪，再把事情按优先级一点点推进。"
+    return {"strategy": strategy, "insert": insert_text, "ms_strategy": _now_ms() - ts0}
+
+def _finish_job(p: dict, t0: float, ms_init: float, ms_build: float, batch_size: int, with_insert: bool) -> dict:
+    p_val, s_val, t_val = p["scores"]
+    ms_p, ms_s, ms_t = p["ms_heads"]
+    final = (p_val + s_val + t_val) / 3.0
 
     # ===== debug inputs =====
     debug_inputs = None
     if EMIT_DEBUG_INPUTS:
         debug_inputs = {
-            "persona_text": persona_text[:DEBUG_INPUT_TRUNC],
-            "scene_text": scene_text_for_heads[:DEBUG_INPUT_TRUNC],   # ✅ 固定不变（除非你手动更新 scene_fields）
-            "topic_text": topic_text[:DEBUG_INPUT_TRUNC],
-            "history_ctx": history_ctx[:DEBUG_INPUT_TRUNC],           # ✅ 仅展示，不进 heads
+            "persona_text": p["persona_text"][:DEBUG_INPUT_TRUNC],
+            "scene_text": p["scene_text"][:DEBUG_INPUT_TRUNC],     # ✅ 固定不变（除非你手动更新 scene_fields）
+            "topic_text": p["topic_text"][:DEBUG_INPUT_TRUNC],
+            "history_ctx": p["history_ctx"][:DEBUG_INPUT_TRUNC],   # ✅ 仅展示，不进 heads
         }
 
-    # ===== persona / scene / topic =====
-    t_p0 = _now_ms()
-    p_val = _run_willingness("persona", persona_text)
-    t_p1 = _now_ms()
-
-    t_s0 = _now_ms()
-    s_val = _run_willingness("scene", scene_text_for_heads)
-    t_s1 = _now_ms()
-
-    t_t0 = _now_ms()
-    t_val = _run_willingness("topic", topic_text)
-    t_t1 = _now_ms()
-
-    final = (p_val + s_val + t_val) / 3.0
-
     # ===== only when triggered, call ChatGPT with history =====
     did_strategy = False
     strategy = "update"
@@ -477,45 +1002,51 @@ def infer_once(
 
     if final > THRESHOLD:
         did_strategy = True
-        ts0 = _now_ms()
-        try:
-            res = ask_chatgpt_for_insert_and_strategy(
-                persona_profile=persona_profile,
-                topic_en=topic_en,
-                utterance=utterance,
-                scene_system=scene_system,
-                scene_user=history_ctx,  # ✅ 仅此处传历史
+        if with_insert:
+            res = generate_insert(
+                persona_profile=p["persona_profile"],
+                topic_en=p["topic_en"],
+                utterance=p["utterance"],
+                scene_system=p["scene_system"],
+                scene_user=p["history_ctx"],  # ✅ 仅此处传历史
             )
-            strategy = res.get("strategy", "unspecified")
-            insert_text = res.get("insert", "")
-        except Exception as e:
-            if DEBUG_LOG:
-                print("[agent_core] ChatGPT failed:", repr(e))
-            strategy = "fallback"
-            insert_text = "我理解你现在很难受，我们先稳住情绪，再把事情按优先级一点点推进。"
-        ts1 = _now_ms()
-        ms_strategy = ts1 - ts0
+            strategy = res["strategy"]
+            insert_text = res["insert"]
+            ms_strategy = res["ms_strategy"]
+        else:
+            # 插话交给调用方的 LLM 阶段异步生成（见 Websocket._insert_stage）
+            strategy = "pending"
 
     t_end = _now_ms()
 
     debug_timing = {
         "ms_total": round(t_end - t0, 2),
-        "ms_init_models": round(t_after_init - t0, 2),
-        "ms_build_inputs": round(t_build1 - t_build0, 2),
-        "ms_persona": round(t_p1 - t_p0, 2),
-        "ms_scene": round(t_s1 - t_s0, 2),
-        "ms_topic": round(t_t1 - t_t0, 2),
+        "ms_init_models": round(ms_init, 2),
+        "ms_build_inputs": round(ms_build, 2),
+        "ms_persona": round(ms_p, 2),
+        "ms_scene": round(ms_s, 2),
+        "ms_topic": round(ms_t, 2),
+        "heads_batched": BATCH_HEADS,
+        "mixed_batch": _MIXED_BATCH_OK,
+        "merged_heads": bool(_MERGED),
+        "scene_cached": p["scene_cached"],
+        "persona_prefix": p["persona_prefix"],
+        "batch_size": batch_size,
         "triggered_strategy": did_strategy,
         "ms_strategy": round(ms_strategy, 2),
         "device_reg": str(DEVICE),
+        "tokenizer_fast": bool(getattr(tokenizer, "is_fast", False)),
+        "token_segment_cache": TOKEN_SEGMENT_CACHE,
+        "precision": _precision(),
         "max_length": MAX_LENGTH,
+        "pad_to_max_length": PAD_TO_MAX_LENGTH,
     }
 
     return {
         "type": "agent_utterance",
         "final_willingness": float(final),
         "threshold": THRESHOLD,
-        "topic_en": topic_en,
+        "topic_en": p["topic_en"],
         "strategy": strategy if did_strategy else "disabled",
         "text": insert_text if did_strategy else "",
         "sub_scores": {
@@ -525,4 +1056,108 @@ def infer_once(
         },
         "debug_timing": debug_timing,
         "debug_inputs": debug_inputs,
-    }
\ No newline at end of file
+    }
+
+def _score_heads(prepared: list) -> None:
+    """
+    给每条 prepared 填上 scores=(persona, scene, topic) 与 ms_heads。
+    - persona 先尝试前缀 KV 缓存（逐条跑短后缀），不适用时并入普通路径
+    - scene 分数先查缓存；同一批里相同的 scene 文本只算一行
+    """
+    scene_todo = {}  # scene_text -> 行号（BATCH_HEADS）或分数（串行）
+    for p in prepared:
+        p["scene_score"] = _scene_cache_get(p["scene_text"])
+        p["scene_cached"] = p["scene_score"] is not None
+        th0 = _now_ms()
+        p["persona_score"], p["persona_prefix"] = _run_persona_with_prefix(p["persona_profile"], p["persona_text"])
+        p["ms_persona_prefix"] = _now_ms() - th0
+
+    if BATCH_HEADS:
+        # 整批一次前向：每条的 ms_* 字段都记这一次前向的耗时（同时出分）；
+        # scene 命中缓存记 0，persona 走前缀缓存记它自己的耗时
+        rows = []
+        for p in prepared:
+            if p["persona_score"] is None:
+                p["row_persona"] = len(rows)
+                rows.append(("persona", p["persona_text"]))
+            p["row_topic"] = len(rows)
+            rows.append(("topic", p["topic_text"]))
+            if not p["scene_cached"] and p["scene_text"] not in scene_todo:
+                scene_todo[p["scene_text"]] = len(rows)
+                rows.append(("scene", p["scene_text"]))
+        th0 = _now_ms()
+        vals = _run_willingness_batch(rows)
+        ms_heads = _now_ms() - th0
+        for text, row in scene_todo.items():
+            _scene_cache_put(text, vals[row])
+        for p in prepared:
+            p_val, ms_p = p["persona_score"], p["ms_persona_prefix"]
+            if p_val is None:
+                p_val, ms_p = vals[p["row_persona"]], ms_heads
+            s_val = p["scene_score"]
+            if s_val is None:
+                s_val = vals[scene_todo[p["scene_text"]]]
+            p["scores"] = (p_val, s_val, vals[p["row_topic"]])
+            p["ms_heads"] = (ms_p, 0.0 if p["scene_cached"] else ms_heads, ms_heads)
+    else:
+        for p in prepared:
+            th0 = _now_ms()
+            p_val = p["persona_score"]
+            if p_val is None:
+                p_val = _run_willingness("persona", p["persona_text"])
+            th1 = _now_ms()
+            s_val = p["scene_score"]
+            if s_val is None:
+                s_val = scene_todo.get(p["scene_text"])
+            if s_val is None:
+                s_val = _run_willingness("scene", p["scene_text"])
+                scene_todo[p["scene_text"]] = s_val
+                _scene_cache_put(p["scene_text"], s_val)
+            th2 = _now_ms()
+            t_val = _run_willingness("topic", p["topic_text"])
+            th3 = _now_ms()
+            p["scores"] = (p_val, s_val, t_val)
+            p["ms_heads"] = (p["ms_persona_prefix"] + th1 - th0, th2 - th1, th3 - th2)
+
+def infer_batch(jobs: list, with_insert: bool = True) -> list:
+    """
+    多条发言一起打分（Websocket 的 gpu_worker 攒批后调用）：
+    jobs 每项是 infer_once 的 5 个参数组成的 dict，返回与 jobs 对齐的结果列表。
+    BATCH_HEADS 时 N 条发言的 persona/topic（及未命中缓存的 scene）合并为一次前向。
+    with_insert=True 时触发的条目在打分后依次调用 ChatGPT；
+    False 时只打分，触发的条目 strategy="pending"，由调用方另行 generate_insert。
+    """
+    t0 = _now_ms()
+    init_models()
+    t_after_init = _now_ms()
+
+    # ===== build inputs (LoRA heads) =====
+    t_build0 = _now_ms()
+    prepared = [_prepare_job(job) for job in jobs]
+    t_build1 = _now_ms()
+
+    # ===== persona / scene / topic =====
+    _score_heads(prepared)
+
+    return [
+        _finish_job(p, t0, t_after_init - t0, t_build1 - t_build0, len(jobs), with_insert)
+        for p in prepared
+    ]
+
+def infer_once(
+    persona_profile: dict,
+    topic_en: str,
+    scene_system: str,
+    scene_user: str,
+    utterance: str,
+) -> dict:
+    """
+    单条发言推理（见 _prepare_job 的关键行为说明），等价于只含一条的 infer_batch。
+    """
+    return infer_batch([{
+        "persona_profile": persona_profile,
+        "topic_en": topic_en,
+        "scene_system": scene_system,
+        "scene_user": scene_user,
+        "utterance": utterance,
+    }])[0]
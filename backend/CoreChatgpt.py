@@ -7,19 +7,52 @@
 - ChatGPT 返回 0-1 之间的数值表示插入意愿
 - 如果意愿 > 0.6，调用 ChatGPT 生成插话内容
 - 使用相同的 prompt 内容进行插话生成
+- FUSED_MODE：一次结构化 JSON 请求同时拿 willingness / strategy / insert（意愿 <= 阈值时丢弃 insert），
+  同样走 willingness 缓存（命中且不触发时不发请求）
+- infer_once_async：AsyncOpenAI + 连接池 + 并发上限（OPENAI_MAX_CONCURRENCY），多个房间的请求可以重叠
 """
 
 import json
+import os
 import time
 import re
-from openai import OpenAI
+import asyncio
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+import httpx
+from openai import OpenAI, AsyncOpenAI
 
 # ================== 配置 ==================
 THRESHOLD = 0.60
 
 # ChatGPT 模型
 OPENAI_MODEL = "gpt-4o-mini-2024-07-18"
-client = OpenAI()
+WILLINGNESS_TEMPERATURE = 0.3
+
+# willingness 结果缓存：同场景/话题/persona 下重复的短句（“哈哈”“对”“好的”）不再重复请求
+WILLINGNESS_CACHE = True
+WILLINGNESS_CACHE_MAX = 2048             # LRU 条数上限
+WILLINGNESS_CACHE_TTL_S = 600            # 过期时间（秒）
+WILLINGNESS_CACHE_FILE = None            # 设为路径则持久化到磁盘（JSON lines，后台线程追加，加载时压缩），重启后仍可命中
+WILLINGNESS_CACHE_MAX_TEMPERATURE = 0.3  # WILLINGNESS_TEMPERATURE 高于此值时自动绕过缓存
+# key 默认只用 模型+温度+场景+话题+persona+发言，不含对话历史：历史里已经包含当前这句，
+# 带历史做 key 每条发言都不一样，几乎不会命中。代价是结果是近似的（同一句在不同上下文下复用分数，TTL 内有效）。
+# True 则把历史也算进 key（结果精确，但基本只有重放同一段对话时才命中）
+WILLINGNESS_CACHE_INCLUDE_HISTORY = False
+
+# True：一次请求同时返回 willingness + strategy + insert（触发时省掉第二次往返和重复的上下文 token）
+FUSED_MODE = False
+OPENAI_TIMEOUT_S = 20.0          # 单次请求超时（秒），同步/异步两条路径都用
+OPENAI_MAX_RETRIES = 2
+OPENAI_MAX_CONCURRENCY = 16      # 异步路径同时在途的请求上限
+OPENAI_MAX_CONNECTIONS = 32      # 异步路径 HTTP 连接池上限（keep-alive 复用）
+client = OpenAI(timeout=OPENAI_TIMEOUT_S, max_retries=OPENAI_MAX_RETRIES)
+
+# 异步 client 与 semaphore 需要在事件循环里创建，首次调用时懒加载
+aclient = None
+_ASYNC_SEM = None
 
 # ===== Debug 控制 =====
 DEBUG_LOG = True           # True 才打印控制台日志
@@ -73,12 +106,230 @@ def _now_ms() -> float:
 
 def init_models():
     """
-    空函数，保留接口兼容性（不再加载模型）
+    保留接口兼容性（不再加载模型）；首次调用时加载持久化的 willingness 缓存（WILLINGNESS_CACHE_FILE），
+    之后再调用不做 I/O。服务启动时先调用一次，事件循环里的打分路径就不会碰磁盘。
     """
+    with _WCACHE_LOCK:
+        if not _WCACHE_LOADED:
+            _wcache_load()
     if DEBUG_LOG:
         print("[init_models] ChatGPT-only mode, no local models needed")
     pass
 
+def _get_async_client() -> AsyncOpenAI:
+    """AsyncOpenAI（共享 httpx 连接池）+ 并发 semaphore，只创建一次。"""
+    global aclient, _ASYNC_SEM
+    if aclient is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+            ),
+            timeout=OPENAI_TIMEOUT_S,
+        )
+        aclient = AsyncOpenAI(
+            timeout=OPENAI_TIMEOUT_S,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=http_client,
+        )
+        _ASYNC_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return aclient
+
+def _chat(messages: list, temperature: float, max_tokens: int, **kwargs) -> str:
+    """同步 chat.completions；返回去掉首尾空白的文本。"""
+    resp = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=OPENAI_TIMEOUT_S,
+        **kwargs,
+    )
+    return (resp.choices[0].message.content or "").strip()
+
+async def _chat_async(messages: list, temperature: float, max_tokens: int, **kwargs) -> str:
+    """异步 chat.completions，受 OPENAI_MAX_CONCURRENCY 限流；返回去掉首尾空白的文本。"""
+    ac = _get_async_client()
+    async with _ASYNC_SEM:
+        resp = await ac.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=OPENAI_TIMEOUT_S,
+            **kwargs,
+        )
+    return (resp.choices[0].message.content or "").strip()
+
+
+# ================== 同步 / 异步共用的请求流程 ==================
+# 每个流程写成一个生成器：要请求 ChatGPT 时 yield (messages, temperature, max_tokens, 额外参数)，
+# 驱动函数发完请求把返回文本 send 回去（请求失败时 send 回异常对象），生成器 return 最终结果。
+# 同步入口用 _run_flow，异步入口用 _run_flow_async；prompt、触发判断、结果组装都只有一份。
+def _run_flow(flow):
+    try:
+        req = next(flow)
+        while True:
+            messages, temperature, max_tokens, kwargs = req
+            try:
+                reply = _chat(messages, temperature, max_tokens, **kwargs)
+            except Exception as e:
+                reply = e
+            req = flow.send(reply)
+    except StopIteration as stop:
+        return stop.value
+
+async def _run_flow_async(flow):
+    try:
+        req = next(flow)
+        while True:
+            messages, temperature, max_tokens, kwargs = req
+            try:
+                reply = await _chat_async(messages, temperature, max_tokens, **kwargs)
+            except Exception as e:
+                reply = e
+            req = flow.send(reply)
+    except StopIteration as stop:
+        return stop.value
+
+def _reply_text(reply) -> str:
+    """请求失败时驱动函数 send 回的是异常，在流程里原样抛出。"""
+    if isinstance(reply, Exception):
+        raise reply
+    return reply
+
+# ================== willingness 结果缓存 ==================
+# key = 规范化后的 prompt 输入（模型、温度、场景、话题、persona、发言；可选历史）的 sha1；
+# TTL + 条数上限的 LRU；可选持久化到 WILLINGNESS_CACHE_FILE（JSON lines，在 init_models 里加载）。
+# 写盘不在调用方（事件循环）里做：_wcache_put 只把条目放进 _WCACHE_PERSIST_QUEUE，由后台线程追加；
+# 加载时把过期/重复/超出上限的条目丢掉并整体重写文件，文件大小不会无限增长。
+_WCACHE = OrderedDict()  # key -> (willingness, 写入时间 time.time())
+_WCACHE_LOCK = threading.Lock()
+_WCACHE_STATS = {"hits": 0, "misses": 0, "bypass": 0}
+_WCACHE_LOADED = False
+_WCACHE_PERSIST_QUEUE = queue.Queue()  # ("put", {"k","v","t"}) / ("compact", [entry, ...])
+_WCACHE_PERSIST_THREAD = None
+
+def _norm_text(x) -> str:
+    return " ".join(_norm_str(x).split())
+
+def _wcache_lookup_key(persona_profile, topic_en, utterance, scene_system, scene_user,
+                       prompt: str = "willingness") -> tuple:
+    """
+    返回 (key, 状态)。缓存关闭或温度过高时 key 为 None（状态 off / bypass），否则状态为 miss，
+    调用方命中后自行改为 hit。prompt 区分打分用的 prompt（willingness / fused），两者的分数不混用。
+    """
+    if not WILLINGNESS_CACHE:
+        return None, "off"
+    if WILLINGNESS_TEMPERATURE > WILLINGNESS_CACHE_MAX_TEMPERATURE:
+        with _WCACHE_LOCK:
+            _WCACHE_STATS["bypass"] += 1
+        return None, "bypass"
+    parts = [
+        OPENAI_MODEL,
+        prompt,
+        f"{WILLINGNESS_TEMPERATURE:.3f}",
+        _norm_text(scene_system),
+        _norm_text(scene_user) if WILLINGNESS_CACHE_INCLUDE_HISTORY else "",
+        _norm_text(topic_en),
+        json.dumps(persona_profile or {}, ensure_ascii=False, sort_keys=True),
+        _norm_text(utterance),
+    ]
+    key = hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+    return key, "miss"
+
+def _wcache_persist_loop():
+    path, fh = None, None
+    while True:
+        kind, payload = _WCACHE_PERSIST_QUEUE.get()
+        try:
+            if kind == "compact":
+                # 先写临时文件再替换，中途失败不会丢掉原文件
+                if fh is not None:
+                    fh.close()
+                    fh = None
+                tmp = WILLINGNESS_CACHE_FILE + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for it in payload:
+                        f.write(json.dumps(it) + "\n")
+                os.replace(tmp, WILLINGNESS_CACHE_FILE)
+            else:
+                if fh is None or path != WILLINGNESS_CACHE_FILE:
+                    if fh is not None:
+                        fh.close()
+                    path = WILLINGNESS_CACHE_FILE
+                    fh = open(path, "a", encoding="utf-8")
+                fh.write(json.dumps(payload) + "\n")
+            if fh is not None and _WCACHE_PERSIST_QUEUE.empty():
+                fh.flush()
+        except Exception as e:
+            if DEBUG_LOG:
+                print(f"[wcache] persist failed: {repr(e)}")
+
+def _wcache_persist(kind: str, payload):
+    global _WCACHE_PERSIST_THREAD
+    if _WCACHE_PERSIST_THREAD is None or not _WCACHE_PERSIST_THREAD.is_alive():
+        _WCACHE_PERSIST_THREAD = threading.Thread(target=_wcache_persist_loop, name="wcache_writer", daemon=True)
+        _WCACHE_PERSIST_THREAD.start()
+    _WCACHE_PERSIST_QUEUE.put((kind, payload))
+
+def _wcache_load():
+    """只在 init_models 里调用（持有 _WCACHE_LOCK）。"""
+    global _WCACHE_LOADED
+    _WCACHE_LOADED = True
+    if not WILLINGNESS_CACHE_FILE or not os.path.exists(WILLINGNESS_CACHE_FILE):
+        return
+    now = time.time()
+    lines = 0
+    try:
+        with open(WILLINGNESS_CACHE_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    it = json.loads(line)
+                except Exception:
+                    continue
+                if now - it.get("t", 0) <= WILLINGNESS_CACHE_TTL_S:
+                    _WCACHE[it["k"]] = (float(it["v"]), it["t"])
+                    _WCACHE.move_to_end(it["k"])
+        while len(_WCACHE) > WILLINGNESS_CACHE_MAX:
+            _WCACHE.popitem(last=False)
+        if DEBUG_LOG:
+            print(f"[wcache] loaded {len(_WCACHE)} entries ({lines} lines) from {WILLINGNESS_CACHE_FILE}")
+    except Exception as e:
+        if DEBUG_LOG:
+            print(f"[wcache] load failed: {repr(e)}")
+        return
+    if lines > len(_WCACHE):
+        _wcache_persist("compact", [{"k": k, "v": v, "t": t} for k, (v, t) in _WCACHE.items()])
+
+def _wcache_get(key: str):
+    with _WCACHE_LOCK:
+        it = _WCACHE.get(key)
+        if it is not None and time.time() - it[1] > WILLINGNESS_CACHE_TTL_S:
+            _WCACHE.pop(key, None)
+            it = None
+        if it is None:
+            _WCACHE_STATS["misses"] += 1
+            return None
+        _WCACHE.move_to_end(key)
+        _WCACHE_STATS["hits"] += 1
+        return it[0]
+
+def _wcache_put(key: str, val: float):
+    now = time.time()
+    with _WCACHE_LOCK:
+        _WCACHE[key] = (val, now)
+        _WCACHE.move_to_end(key)
+        while len(_WCACHE) > WILLINGNESS_CACHE_MAX:
+            _WCACHE.popitem(last=False)
+    if WILLINGNESS_CACHE_FILE:
+        _wcache_persist("put", {"k": key, "v": val, "t": now})
+
+def willingness_cache_stats() -> dict:
+    with _WCACHE_LOCK:
+        return dict(_WCACHE_STATS, size=len(_WCACHE))
+
 
 # ================== ChatGPT willingness 判断 ==================
 def _extract_number(text: str) -> float:
@@ -105,18 +356,13 @@ def _extract_number(text: str) -> float:
         pass
     return 0.0
 
-def ask_chatgpt_for_willingness(
+def _willingness_messages(
     persona_profile: dict,
     topic_en: str,
     utterance: str,
     scene_system: str,
     scene_user: str,
-) -> float:
-    """
-    使用 ChatGPT 判断插入意愿
-    输入：场景信息、个人信息、话题、当前发言
-    返回：0-1 之间的数值
-    """
+) -> list:
     system_msg = """你是一个判断 AI 助手是否应该在多人对话中插话的系统。
 
 你需要评估：在当前场景、话题、用户发言和对话历史的背景下，
@@ -149,26 +395,63 @@ AI 助手主动插话的"意愿"应该是多少？
 请评估 AI 助手在这个时刻主动插话的意愿（0.0-1.0），只返回数字：
 """.strip()
 
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
+
+def _willingness_flow(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+):
+    """返回 (willingness, 缓存状态)；只有请求成功的结果才写入缓存。"""
+    key, status = _wcache_lookup_key(persona_profile, topic_en, utterance, scene_system, scene_user)
+    if key is not None:
+        cached = _wcache_get(key)
+        if cached is not None:
+            return cached, "hit"
+
+    messages = _willingness_messages(persona_profile, topic_en, utterance, scene_system, scene_user)
     try:
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_msg},
-            ],
-            temperature=0.3,
-            max_tokens=20,
-        )
-        raw = (resp.choices[0].message.content or "").strip()
-        willingness = _extract_number(raw)
-        if DEBUG_LOG:
-            print(f"[willingness] ChatGPT returned: {raw} -> {willingness}")
-        return willingness
+        raw = _reply_text((yield messages, WILLINGNESS_TEMPERATURE, 20, {}))
     except Exception as e:
         if DEBUG_LOG:
             print(f"[willingness] ChatGPT error: {repr(e)}")
-        return 0.0
+        return 0.0, "error"
+    willingness = _extract_number(raw)
+    if DEBUG_LOG:
+        print(f"[willingness] ChatGPT returned: {raw} -> {willingness}")
+    if key is not None:
+        _wcache_put(key, willingness)
+    return willingness, status
+
+def ask_chatgpt_for_willingness(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> float:
+    """
+    使用 ChatGPT 判断插入意愿
+    输入：场景信息、个人信息、话题、当前发言
+    返回：0-1 之间的数值（相同输入命中 willingness 缓存时不发请求）
+    """
+    return _run_flow(_willingness_flow(persona_profile, topic_en, utterance, scene_system, scene_user))[0]
 
+async def ask_chatgpt_for_willingness_async(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> float:
+    """ask_chatgpt_for_willingness 的异步版本（共享连接池，受并发上限约束）"""
+    flow = _willingness_flow(persona_profile, topic_en, utterance, scene_system, scene_user)
+    return (await _run_flow_async(flow))[0]
 
 # ================== ChatGPT strategy + insert ==================
 def _extract_json_block(s: str):
@@ -225,13 +508,13 @@ def _sanitize_insert(insert: str, utterance: str) -> str:
         return ""
     return insert
 
-def ask_chatgpt_for_insert_and_strategy(
+def _insert_messages(
     persona_profile: dict,
     topic_en: str,
     utterance: str,
     scene_system: str,
     scene_user: str,
-) -> dict:
+) -> list:
     system_msg = (
         "You are speaking because the system has already decided that intervening is necessary.\n\n"
 
@@ -263,7 +546,7 @@ Scene (system context):
 {(scene_system or '')[:800]}
 
 Recent conversation (for reference only):
-{(scene_user or '')[:800]}
+{(scene_user or '')[-800:]}
 
 Persona profile (JSON):
 {json.dumps(persona_profile or {}, ensure_ascii=False)[:1200]}
@@ -296,16 +579,12 @@ Return JSON only:
 {{"strategy":"...","insert":"..."}}
 """.strip()
 
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": user_msg},
-        ],
-        temperature=0.4,
-        max_tokens=140,
-    )
-    raw = (resp.choices[0].message.content or "").strip()
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
+
+def _parse_insert(raw: str, utterance: str) -> dict:
     data = _extract_json_block(raw) or {}
 
     strategy = str(data.get("strategy", "")).strip() or "unspecified"
@@ -319,33 +598,286 @@ Return JSON only:
 
     return {"strategy": strategy, "insert": insert, "raw": raw}
 
+def _insert_flow(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+):
+    messages = _insert_messages(persona_profile, topic_en, utterance, scene_system, scene_user)
+    raw = _reply_text((yield messages, 0.4, 140, {}))
+    return _parse_insert(raw, utterance)
 
-# ================== 主推理：infer_once ==================
-def infer_once(
+def ask_chatgpt_for_insert_and_strategy(
     persona_profile: dict,
     topic_en: str,
+    utterance: str,
     scene_system: str,
     scene_user: str,
+) -> dict:
+    return _run_flow(_insert_flow(persona_profile, topic_en, utterance, scene_system, scene_user))
+
+async def ask_chatgpt_for_insert_and_strategy_async(
+    persona_profile: dict,
+    topic_en: str,
     utterance: str,
+    scene_system: str,
+    scene_user: str,
 ) -> dict:
+    """ask_chatgpt_for_insert_and_strategy 的异步版本"""
+    return await _run_flow_async(_insert_flow(persona_profile, topic_en, utterance, scene_system, scene_user))
+
+# ================== 单次请求：willingness + strategy + insert ==================
+def _fused_messages(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> list:
+    system_msg = (
+        "You judge whether an AI participant should speak now in a multi-person conversation, "
+        "and if so, what it should say.\n\n"
+
+        "Willingness scale (0.0-1.0):\n"
+        "- 0.0-0.3: should not speak (conversation flows normally, speaking would interrupt)\n"
+        "- 0.3-0.6: may speak (conversation stalls a bit or needs clarification)\n"
+        "- 0.6-1.0: should speak (deadlock, needs guidance, or a misunderstanding to clear up)\n\n"
+
+        f"Only when willingness > {THRESHOLD:.2f}, also write the message. When you speak:\n"
+        "- You are a real participant, not a chatbot, assistant, or moderator\n"
+        "- Improve the quality of the discussion: clarify, point out a hidden problem, reframe, or propose a next step\n"
+        "- Avoid generic empathy, reassurance, or vague encouragement\n"
+        "- Do not repeat or summarize what others have said\n"
+        "- Be concise, natural, and slightly opinionated\n\n"
+
+        "Output MUST be valid JSON only."
+    )
+    user_msg = f"""
+Scene (system context):
+{(scene_system or '')[:800]}
+
+Recent conversation (for reference only):
+{(scene_user or '')[-800:]}
+
+Persona profile (JSON):
+{json.dumps(persona_profile or {}, ensure_ascii=False)[:1200]}
+
+Topic (English):
+{topic_en or ''}
+
+Latest utterance:
+{utterance or ''}
+
+Constraints for "insert" (only when willingness > {THRESHOLD:.2f}, otherwise use ""):
+- ONE Chinese sentence, <= 25 Chinese characters preferred
+- Do NOT quote, repeat, or paraphrase the user's utterance
+- Do NOT include any consecutive 8+ characters copied from the user's utterance
+- Do not ask questions, do not use '?' or '？'
+
+Return JSON only:
+{{"willingness":0.00,"strategy":"...","insert":"..."}}
+""".strip()
+
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
+
+def _parse_fused(raw: str, utterance: str) -> dict:
     """
-    完全使用 ChatGPT 来判断插入意愿和生成插话内容：
-    1) 使用 ChatGPT 判断插入意愿（输入：场景、个人信息、话题、发言、历史）
-    2) 如果意愿 > 0.6，调用 ChatGPT 生成插话内容和策略
-    3) 使用相同的 prompt 内容进行插话生成
+    解析单次请求的 JSON；willingness 解析失败时退回 _extract_number。
+    willingness <= THRESHOLD 时丢弃 insert。
     """
-    t0 = _now_ms()
-    init_models()
+    data = _extract_json_block(raw) or {}
+    try:
+        willingness = max(0.0, min(1.0, float(data.get("willingness"))))
+    except (TypeError, ValueError):
+        willingness = _extract_number(raw)
+
+    if willingness <= THRESHOLD:
+        return {"willingness": willingness, "strategy": "disabled", "insert": "", "raw": raw}
+
+    strategy = str(data.get("strategy", "")).strip() or "unspecified"
+    insert = _sanitize_insert(str(data.get("insert", "")).strip(), utterance)
+    if not insert:
+        insert = "我理解你现在压力很大，我们先把最紧急的一件事拆小一点来处理。"
+    return {"willingness": willingness, "strategy": strategy, "insert": insert, "raw": raw}
+
+def _fused_flow(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+):
+    messages = _fused_messages(persona_profile, topic_en, utterance, scene_system, scene_user)
+    raw = _reply_text((yield messages, 0.3, 160, {"response_format": {"type": "json_object"}}))
+    return _parse_fused(raw, utterance)
+
+def ask_chatgpt_fused(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> dict:
+    return _run_flow(_fused_flow(persona_profile, topic_en, utterance, scene_system, scene_user))
+
+async def ask_chatgpt_fused_async(
+    persona_profile: dict,
+    topic_en: str,
+    utterance: str,
+    scene_system: str,
+    scene_user: str,
+) -> dict:
+    """ask_chatgpt_fused 的异步版本"""
+    return await _run_flow_async(_fused_flow(persona_profile, topic_en, utterance, scene_system, scene_user))
+
+# ================== 主推理：infer_once ==================
+def _build_result(
+    persona_profile: dict,
+    topic_en: str,
+    scene_system: str,
+    history_ctx: str,
+    utterance: str,
+    final_willingness: float,
+    did_strategy: bool,
+    strategy: str,
+    insert_text: str,
+    timing: dict,
+) -> dict:
+    # ===== debug inputs =====
+    debug_inputs = None
+    if EMIT_DEBUG_INPUTS:
+        debug_inputs = {
+            "persona_profile": json.dumps(persona_profile or {}, ensure_ascii=False)[:DEBUG_INPUT_TRUNC],
+            "scene_system": scene_system[:DEBUG_INPUT_TRUNC],
+            "topic_en": topic_en[:DEBUG_INPUT_TRUNC],
+            "utterance": utterance[:DEBUG_INPUT_TRUNC],
+            "history_ctx": history_ctx[:DEBUG_INPUT_TRUNC],
+        }
+
+    debug_timing = {
+        "ms_total": round(timing["t_end"] - timing["t0"], 2),
+        "ms_init_models": round(timing["t_after_init"] - timing["t0"], 2),
+        "ms_willingness": round(timing["ms_willingness"], 2),
+        "triggered_strategy": did_strategy,
+        "ms_strategy": round(timing["ms_strategy"], 2),
+        "model": OPENAI_MODEL,
+    }
+    if "willingness_cache" in timing:
+        debug_timing["willingness_cache"] = timing["willingness_cache"]
+        debug_timing["willingness_cache_stats"] = willingness_cache_stats()
+
+    return {
+        "type": "agent_utterance",
+        "final_willingness": float(final_willingness),
+        "threshold": THRESHOLD,
+        "topic_en": topic_en,
+        "strategy": strategy,
+        "text": insert_text if did_strategy else "",
+        "sub_scores": {
+            "persona": 0.0,  # 不再使用，保留兼容性
+            "scene": 0.0,    # 不再使用，保留兼容性
+            "topic": 0.0,    # 不再使用，保留兼容性
+        },
+        "debug_timing": debug_timing,
+        "debug_inputs": debug_inputs,
+    }
+
+def _build_fused_result(persona_profile, topic_en, scene_system, history_ctx, utterance,
+                        res: dict, t0: float, t_after_init: float, t_w0: float, wcache_status: str) -> dict:
+    """FUSED_MODE：请求耗时（命中缓存时为补发的 insert 请求）记在 ms_willingness，ms_strategy 为 0。"""
+    final_willingness = res["willingness"]
+    did_strategy = final_willingness > THRESHOLD
+    t_end = _now_ms()
+    result = _build_result(
+        persona_profile, topic_en, scene_system, history_ctx, utterance,
+        final_willingness, did_strategy,
+        res["strategy"] if did_strategy else "disabled",
+        res["insert"],
+        {
+            "t0": t0,
+            "t_after_init": t_after_init,
+            "t_end": t_end,
+            "ms_willingness": t_end - t_w0,
+            "ms_strategy": 0.0,
+            "willingness_cache": wcache_status,
+        },
+    )
+    result["debug_timing"]["fused"] = True
+    return result
+
+# insert 请求失败时的兜底插话
+_FALLBACK_INSERT = "我理解你现在很难受，我们先稳住情绪，再把事情按优先级一点点推进。"
+
+def _infer_flow(
+    persona_profile: dict,
+    topic_en: str,
+    scene_system: str,
+    scene_user: str,
+    utterance: str,
+    insert_scene_user: str,
+    t0: float,
+):
+    """infer_once / infer_once_async 共用的流程（init_models 由入口调用，t0 为入口开始时间）。"""
     t_after_init = _now_ms()
 
     utterance = (utterance or "").strip()
     topic_en = topic_en or ""
     scene_system = scene_system or ""
     history_ctx = (scene_user or "").strip()
+    insert_ctx = history_ctx if insert_scene_user is None else insert_scene_user.strip()
+
+    if FUSED_MODE:
+        # 一次请求里同时给插话内容，prompt 的历史用 insert_ctx（按字符预算保留最新的几句）；
+        # 分数缓存 key 与非 fused 路径相同（默认不含历史），只是 prompt 名不同
+        t_w0 = _now_ms()
+        key, wcache_status = _wcache_lookup_key(persona_profile, topic_en, utterance, scene_system, history_ctx,
+                                                prompt="fused")
+        cached = _wcache_get(key) if key is not None else None
+        if cached is not None:
+            wcache_status = "hit"
+            res = {"willingness": cached, "strategy": "disabled", "insert": ""}
+            if cached > THRESHOLD:
+                # 分数命中但要插话：只补一次 insert 请求
+                try:
+                    ins = yield from _insert_flow(
+                        persona_profile=persona_profile,
+                        topic_en=topic_en,
+                        utterance=utterance,
+                        scene_system=scene_system,
+                        scene_user=insert_ctx,
+                    )
+                    res.update(strategy=ins.get("strategy", "unspecified"), insert=ins.get("insert", ""))
+                except Exception as e:
+                    if DEBUG_LOG:
+                        print("[agent_core] ChatGPT insert generation failed:", repr(e))
+                    res.update(strategy="fallback", insert=_FALLBACK_INSERT)
+        else:
+            try:
+                res = yield from _fused_flow(
+                    persona_profile=persona_profile,
+                    topic_en=topic_en,
+                    utterance=utterance,
+                    scene_system=scene_system,
+                    scene_user=insert_ctx,
+                )
+                if key is not None:
+                    _wcache_put(key, res["willingness"])
+            except Exception as e:
+                if DEBUG_LOG:
+                    print(f"[fused] ChatGPT error: {repr(e)}")
+                res = {"willingness": 0.0, "strategy": "disabled", "insert": ""}
+                wcache_status = "error"
+        return _build_fused_result(persona_profile, topic_en, scene_system, history_ctx, utterance,
+                                   res, t0, t_after_init, t_w0, wcache_status)
 
     # ===== 使用 ChatGPT 判断插入意愿 =====
     t_willingness0 = _now_ms()
-    final_willingness = ask_chatgpt_for_willingness(
+    final_willingness, wcache_status = yield from _willingness_flow(
         persona_profile=persona_profile,
         topic_en=topic_en,
         utterance=utterance,
@@ -354,17 +886,6 @@ def infer_once(
     )
     t_willingness1 = _now_ms()
 
-    # ===== debug inputs =====
-    debug_inputs = None
-    if EMIT_DEBUG_INPUTS:
-        debug_inputs = {
-            "persona_profile": json.dumps(persona_profile or {}, ensure_ascii=False)[:DEBUG_INPUT_TRUNC],
-            "scene_system": scene_system[:DEBUG_INPUT_TRUNC],
-            "topic_en": topic_en[:DEBUG_INPUT_TRUNC],
-            "utterance": utterance[:DEBUG_INPUT_TRUNC],
-            "history_ctx": history_ctx[:DEBUG_INPUT_TRUNC],
-        }
-
     # ===== only when triggered, call ChatGPT for insert =====
     did_strategy = False
     strategy = "disabled"
@@ -375,12 +896,12 @@ def infer_once(
         did_strategy = True
         ts0 = _now_ms()
         try:
-            res = ask_chatgpt_for_insert_and_strategy(
+            res = yield from _insert_flow(
                 persona_profile=persona_profile,
                 topic_en=topic_en,
                 utterance=utterance,
                 scene_system=scene_system,
-                scene_user=history_ctx,
+                scene_user=insert_ctx,
             )
             strategy = res.get("strategy", "unspecified")
             insert_text = res.get("insert", "")
@@ -388,33 +909,61 @@ def infer_once(
             if DEBUG_LOG:
                 print("[agent_core] ChatGPT insert generation failed:", repr(e))
             strategy = "fallback"
-            insert_text = "我理解你现在很难受，我们先稳住情绪，再把事情按优先级一点点推进。"
+            insert_text = _FALLBACK_INSERT
         ts1 = _now_ms()
         ms_strategy = ts1 - ts0
 
-    t_end = _now_ms()
+    return _build_result(
+        persona_profile, topic_en, scene_system, history_ctx, utterance,
+        final_willingness, did_strategy, strategy, insert_text,
+        {
+            "t0": t0,
+            "t_after_init": t_after_init,
+            "t_end": _now_ms(),
+            "ms_willingness": t_willingness1 - t_willingness0,
+            "ms_strategy": ms_strategy,
+            "willingness_cache": wcache_status,
+        },
+    )
 
-    debug_timing = {
-        "ms_total": round(t_end - t0, 2),
-        "ms_init_models": round(t_after_init - t0, 2),
-        "ms_willingness": round(t_willingness1 - t_willingness0, 2),
-        "triggered_strategy": did_strategy,
-        "ms_strategy": round(ms_strategy, 2),
-        "model": OPENAI_MODEL,
-    }
+def infer_once(
+    persona_profile: dict,
+    topic_en: str,
+    scene_system: str,
+    scene_user: str,
+    utterance: str,
+    insert_scene_user: str = None,
+) -> dict:
+    """
+    完全使用 ChatGPT 来判断插入意愿和生成插话内容：
+    1) 使用 ChatGPT 判断插入意愿（输入：场景、个人信息、话题、发言、历史）
+    2) 如果意愿 > 0.6，调用 ChatGPT 生成插话内容和策略
+    3) 使用相同的 prompt 内容进行插话生成
+    insert_scene_user：只给插话 prompt 用的历史（例如按 800 字符预算裁过的），不传则与 scene_user 相同；
+    willingness 打分始终用完整的 scene_user。
+    """
+    t0 = _now_ms()
+    init_models()
+    return _run_flow(_infer_flow(persona_profile, topic_en, scene_system, scene_user, utterance,
+                                 insert_scene_user, t0))
 
-    return {
-        "type": "agent_utterance",
-        "final_willingness": float(final_willingness),
-        "threshold": THRESHOLD,
-        "topic_en": topic_en,
-        "strategy": strategy,
-        "text": insert_text if did_strategy else "",
-        "sub_scores": {
-            "persona": 0.0,  # 不再使用，保留兼容性
-            "scene": 0.0,    # 不再使用，保留兼容性
-            "topic": 0.0,    # 不再使用，保留兼容性
-        },
-        "debug_timing": debug_timing,
-        "debug_inputs": debug_inputs,
-    }
\ No newline at end of file
+async def infer_once_async(
+    persona_profile: dict,
+    topic_en: str,
+    scene_system: str,
+    scene_user: str,
+    utterance: str,
+    insert_scene_user: str = None,
+) -> dict:
+    """
+    infer_once 的异步版本（AsyncOpenAI），流程与返回结构完全相同（同一个 _infer_flow）；
+    多个调用可以在同一事件循环里并发，总在途请求数受 OPENAI_MAX_CONCURRENCY 限制。
+    """
+    t0 = _now_ms()
+    if _WCACHE_LOADED:
+        init_models()
+    else:
+        # 没有先调 init_models 时，首次加载缓存文件放到线程池里，不阻塞事件循环
+        await asyncio.get_running_loop().run_in_executor(None, init_models)
+    return await _run_flow_async(_infer_flow(persona_profile, topic_en, scene_system, scene_user, utterance,
+                                             insert_scene_user, t0))
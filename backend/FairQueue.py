@@ -0,0 +1,180 @@
+# FairQueue.py
+# -*- coding: utf-8 -*-
+
+"""
+推理队列的公平调度（替代 GPU_QUEUE 的单一 FIFO）：
+- 两级加权公平排队：先在房间之间、再在同一房间的用户之间按虚拟完成时间挑选
+  （每出队一条，房间 tag += 1/房间权重，用户 tag += 1/用户权重；空闲后重新活跃的租户从当前虚拟时间起步，不能攒额度）
+- 每个用户同时在推理中的条数上限（user_inflight_max），到上限的用户暂时跳过，不挡别人
+- 总队列 / 单用户排队上限，超过时 put_nowait 抛 QueueRejected（调用方据此给客户端明确的背压响应）
+- 可选合并：put_nowait(job, coalesce=True) 时，同一房间同一用户还在排队（未开始推理）的旧 job 被新 job 取代并返回给调用方
+- stats()：总体及每个房间 / 用户的排队数、推理中条数、拒绝 / 被取代次数
+job 需要带 "room_id" 和 "user_id"。
+"""
+
+import asyncio
+from collections import deque
+
+
+class QueueRejected(Exception):
+    """队列满：reason 为 "queue_full"（总量）或 "user_queue_full"（该用户排队过多）。"""
+
+    def __init__(self, reason: str, depth: dict):
+        super().__init__(reason)
+        self.reason = reason
+        self.depth = depth
+
+
+class JobSuperseded(Exception):
+    """合并模式下排队中的 job 被同一用户更新的发言取代；by_seq 为取代它的 job 的 seq。"""
+
+    def __init__(self, by_seq):
+        super().__init__(f"superseded by seq={by_seq}")
+        self.by_seq = by_seq
+
+
+def _new_tenant(tag: float) -> dict:
+    return {"tag": tag, "queued": 0, "inflight": 0}
+
+
+class FairQueue:
+    def __init__(self, maxsize: int, user_inflight_max: int = 2, user_queue_max: int = 0,
+                 room_weights: dict = None, user_weights: dict = None):
+        self.maxsize = maxsize
+        self.user_inflight_max = user_inflight_max    # 0 = 不限
+        self.user_queue_max = user_queue_max          # 0 = 不限
+        self.room_weights = room_weights if room_weights is not None else {}  # room_id -> weight（默认 1.0）
+        self.user_weights = user_weights if user_weights is not None else {}  # user_id -> weight（默认 1.0）
+        self._rooms = {}   # room_id -> {"tag","queued","inflight","vtime","users": {user_id -> {"tag","queued","inflight","jobs": deque}}}
+        self._vtime = 0.0  # 房间级虚拟时间（最近一次出队房间的 tag）
+        self._size = 0
+        self._wake = asyncio.Event()
+        self.rejected = {"queue_full": 0, "user_queue_full": 0}
+        self.superseded = 0
+
+    # ---------- 入队 ----------
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return self._size >= self.maxsize
+
+    def depth(self, room_id: str, user_id: str = None) -> dict:
+        room = self._rooms.get(room_id)
+        user = room["users"].get(user_id) if room and user_id is not None else None
+        return {
+            "total": self._size,
+            "room": room["queued"] if room else 0,
+            "user": user["queued"] if user else 0,
+        }
+
+    def _take_queued(self, room_id: str, user_id: str) -> list:
+        room = self._rooms.get(room_id)
+        user = room["users"].get(user_id) if room else None
+        if not user or not user["queued"]:
+            return []
+        old = list(user["jobs"])
+        user["jobs"].clear()
+        user["queued"] = 0
+        room["queued"] -= len(old)
+        self._size -= len(old)
+        self.superseded += len(old)
+        return old
+
+    def put_nowait(self, job: dict, coalesce: bool = False) -> list:
+        """入队；coalesce=True 时先取出该用户仍在排队的旧 job，作为返回值（调用方负责通知它们被取代）。"""
+        room_id, user_id = job["room_id"], job["user_id"]
+        superseded = self._take_queued(room_id, user_id) if coalesce else []
+        if self._size >= self.maxsize:
+            self.rejected["queue_full"] += 1
+            raise QueueRejected("queue_full", self.depth(room_id, user_id))
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = {**_new_tenant(self._vtime), "vtime": 0.0, "users": {}}
+        user = room["users"].get(user_id)
+        if user is None:
+            user = room["users"][user_id] = {**_new_tenant(room["vtime"]), "jobs": deque()}
+        if self.user_queue_max and user["queued"] >= self.user_queue_max:
+            self.rejected["user_queue_full"] += 1
+            raise QueueRejected("user_queue_full", self.depth(room_id, user_id))
+
+        # 空闲后重新活跃：从当前虚拟时间起步
+        if room["queued"] == 0:
+            room["tag"] = max(room["tag"], self._vtime)
+        if user["queued"] == 0:
+            user["tag"] = max(user["tag"], room["vtime"])
+        user["jobs"].append(job)
+        user["queued"] += 1
+        room["queued"] += 1
+        self._size += 1
+        self._wake.set()
+        return superseded
+
+    # ---------- 出队 ----------
+    def _eligible(self, user: dict) -> bool:
+        return user["queued"] > 0 and (not self.user_inflight_max or user["inflight"] < self.user_inflight_max)
+
+    def get_nowait(self):
+        """挑 tag 最小的房间里 tag 最小的可运行用户；没有可运行的 job 时返回 None。"""
+        best_room, best_user = None, None
+        for room in self._rooms.values():
+            if best_room is not None and room["tag"] >= best_room["tag"]:
+                continue
+            user = min((u for u in room["users"].values() if self._eligible(u)), key=lambda u: u["tag"], default=None)
+            if user is not None:
+                best_room, best_user = room, user
+        if best_user is None:
+            return None
+
+        job = best_user["jobs"].popleft()
+        best_user["queued"] -= 1
+        best_user["inflight"] += 1
+        best_room["queued"] -= 1
+        best_room["inflight"] += 1
+        self._size -= 1
+
+        self._vtime = best_room["tag"]
+        best_room["vtime"] = best_user["tag"]
+        best_room["tag"] += 1.0 / self.room_weights.get(job["room_id"], 1.0)
+        best_user["tag"] += 1.0 / self.user_weights.get(job["user_id"], 1.0)
+        return job
+
+    async def get(self) -> dict:
+        while True:
+            job = self.get_nowait()
+            if job is not None:
+                return job
+            self._wake.clear()
+            await self._wake.wait()
+
+    def task_done(self, job: dict):
+        """job 推理结束（成功或失败）后调用：释放该用户的推理中名额。"""
+        room = self._rooms.get(job["room_id"])
+        if room is None:
+            return
+        user = room["users"].get(job["user_id"])
+        room["inflight"] -= 1
+        if user is not None:
+            user["inflight"] -= 1
+            if user["queued"] == 0 and user["inflight"] == 0:
+                del room["users"][job["user_id"]]
+        if room["queued"] == 0 and room["inflight"] == 0:
+            del self._rooms[job["room_id"]]
+        self._wake.set()  # 可能有用户刚从 inflight 上限里解放出来
+
+    # ---------- 指标 ----------
+    def stats(self) -> dict:
+        return {
+            "queued": self._size,
+            "inflight": sum(r["inflight"] for r in self._rooms.values()),
+            "rejected": dict(self.rejected),
+            "superseded": self.superseded,
+            "rooms": {
+                room_id: {
+                    "queued": r["queued"],
+                    "inflight": r["inflight"],
+                    "users": {uid: {"queued": u["queued"], "inflight": u["inflight"]} for uid, u in r["users"].items()},
+                }
+                for room_id, r in self._rooms.items()
+            },
+        }
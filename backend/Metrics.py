@@ -0,0 +1,148 @@
+# Metrics.py
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus 文本格式的指标（只用标准库，不依赖 prometheus_client）：
+- Counter / Histogram：在事件循环线程里 inc / observe，抓取线程 render 时加锁读
+- Gauge：抓取时调用回调取当前值（队列深度、连接数等不用到处埋点维护）
+- serve(port)：单独端口的 HTTP 导出器（后台线程），GET /metrics 返回 text/plain; version=0.0.4
+单位沿用 debug_timing 的毫秒（指标名以 _ms 结尾）。
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_REGISTRY = []
+_LOCK = threading.Lock()
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{str(v)}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label 值元组 -> 计数
+        if not self.labelnames:
+            self._values[()] = 0
+        _REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(k, "") for k in self.labelnames)
+        with _LOCK:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _LOCK:
+            values = sorted(self._values.items())
+        for key, v in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_fmt(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = MS_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label 值元组 -> {"counts": [...], "sum", "count"}
+        _REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(k, "") for k in self.labelnames)
+        with _LOCK:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s["counts"][i] += 1
+                    break
+            s["sum"] += value
+            s["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _LOCK:
+            series = [(key, {**s, "counts": list(s["counts"])}) for key, s in sorted(self._series.items())]
+        for key, s in series:
+            cum = 0
+            for b, c in zip(self.buckets, s["counts"]):
+                cum += c
+                le = 'le="%s"' % _fmt(b)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cum}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {s['count']}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(round(s['sum'], 3))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {s['count']}")
+        return lines
+
+
+class Gauge:
+    """fn() 返回数值，或 {label 值元组: 数值}（配合 labelnames）。"""
+
+    def __init__(self, name: str, help_text: str, fn, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception:
+            return lines  # 抓取和事件循环并发，偶尔读到中间状态时本次跳过
+        values = value if isinstance(value, dict) else {(): value}
+        for key, v in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_fmt(v)}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in list(_REGISTRY):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
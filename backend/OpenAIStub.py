@@ -0,0 +1,137 @@
+# OpenAIStub.py
+# -*- coding: utf-8 -*-
+
+"""
+本地 OpenAI chat.completions 假服务（不联网、不计费），用来测 CoreChatgpt 的并发吞吐：
+- POST /v1/chat/completions：固定延迟 --delay-ms 后返回
+  - max_tokens <= 20（willingness 请求）：返回 --willingness 的数字
+  - 其他（insert / FUSED_MODE 请求）：返回 {"willingness": ..., "strategy": "...", "insert": "..."}
+- HTTP/1.1 keep-alive，便于验证连接池复用
+
+启动假服务：
+    python OpenAIStub.py --port 8900 --delay-ms 300
+让后端指向它（OpenAI SDK 会读取这两个环境变量）：
+    set OPENAI_BASE_URL=http://127.0.0.1:8900/v1
+    set OPENAI_API_KEY=stub
+压测 infer_once_async（同一进程内起假服务并发打 N 个请求）：
+    python OpenAIStub.py --bench 200 --delay-ms 300
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DELAY_MS = 300
+WILLINGNESS = "0.72"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            req = json.loads(self.rfile.read(length) or b"{}")
+        except Exception:
+            req = {}
+
+        time.sleep(DELAY_MS / 1000.0)
+
+        if (req.get("max_tokens") or 0) <= 20:
+            content = WILLINGNESS
+        else:
+            content = json.dumps({
+                "willingness": float(WILLINGNESS),
+                "strategy": "stub",
+                "insert": "我们先把最紧急的一件事定下来再说。",
+            }, ensure_ascii=False)
+
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": req.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }, ensure_ascii=False).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def _bench(n: int):
+    import CoreChatgpt
+
+    CoreChatgpt.DEBUG_LOG = False
+    profile = {"background": "stub user"}
+
+    async def one(i):
+        t0 = time.perf_counter()
+        await CoreChatgpt.infer_once_async(profile, "stub topic", "stub scene", "", f"utterance {i}")
+        return (time.perf_counter() - t0) * 1000.0
+
+    t0 = time.perf_counter()
+    lat = sorted(await asyncio.gather(*(one(i) for i in range(n))))
+    wall = time.perf_counter() - t0
+    print(json.dumps({
+        "requests": n,
+        "delay_ms": DELAY_MS,
+        "max_concurrency": CoreChatgpt.OPENAI_MAX_CONCURRENCY,
+        "wall_s": round(wall, 2),
+        "utterances_per_s": round(n / wall, 2),
+        "p50_ms": round(lat[len(lat) // 2], 1),
+        "p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))], 1),
+    }, indent=2))
+
+
+def main():
+    global DELAY_MS, WILLINGNESS
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--delay-ms", type=int, default=DELAY_MS)
+    ap.add_argument("--willingness", default=WILLINGNESS)
+    ap.add_argument("--bench", type=int, default=0, help="在本进程内起假服务，并发跑 N 次 infer_once_async")
+    args = ap.parse_args()
+    DELAY_MS = args.delay_ms
+    WILLINGNESS = args.willingness
+
+    server = serve(args.port)
+    print(f"[stub] OpenAI stub on http://127.0.0.1:{args.port}/v1 delay={DELAY_MS}ms")
+
+    if args.bench:
+        # 必须在 import CoreChatgpt（创建 OpenAI client）之前设置
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "stub")
+        asyncio.run(_bench(args.bench))
+        server.shutdown()
+        return
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,217 +2,718 @@
 # -*- coding: utf-8 -*-
 
 """
-公共房间多人版本（无 room_id）：
-- 多客户端加入同一房间
+多房间多人版本：
+- 多客户端按 join 时的 room_id 进入各自房间（不带 room_id 进入公共房间 "public"）；每个房间独立的状态 / 历史 / CSV
 - 必须先 join（nickname + intro），否则不允许发言
 - 每个用户独立 persona_profile（不共享）
-- chat_line：先广播 chat_ack(queued)，再串行推理，最后广播 chat_update(done)
-- 推理上下文：最近 N 句历史拼成 scene_user
-- 多人并发不抢 GPU：asyncio.Queue + 单 worker 串行 infer_once()
+- chat_line：先广播 chat_ack(queued)，再串行推理，最后广播 chat_update(done)；打分在每条发言的后台任务里进行，
+  接收循环不等待（每连接最多 CHAT_LINE_CONCURRENCY 条，断线时取消）
+  （触发插话时先广播 chat_update(scored)，ChatGPT 插话在 LLM 阶段并发生成后再补发 chat_update(done)）
+- 推理上下文：最近 N 句历史拼成 scene_user（ChatHistory 增量维护，按 800 字符预算保留最新的几句）
+- 多人并发不抢 GPU：FairQueue（房间/用户两级加权公平 + 每用户推理中上限）+ 单 worker；worker 攒批（最多 GPU_BATCH_MAX 条 / 等待 GPU_BATCH_WAIT_MS）后一次 infer_batch()
+- infer_batch 在专用推理线程（INFER_EXECUTOR）里跑，事件循环不被前向阻塞；loop_lag_monitor 记录事件循环延迟
+- 指标：METRICS_PORT 上的 HTTP 导出器（GET /metrics，Prometheus 文本格式），见 Metrics.py
+- 每条发言记录时间线（recv/ack/enqueue/dequeue/infer/llm/broadcast），随 chat_update 的 "span" 下发并写入 CSV
 """
 
 import json
 import time
 import uuid
 import asyncio
+import functools
 import websockets
 import csv
 import os
+import queue
+import threading
+from collections import deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from Core import infer_once, build_scene_prompt_from_fields, init_models
+import Metrics
+from ChatHistory import ChatHistory
+from FairQueue import FairQueue, QueueRejected, JobSuperseded
+from Core import (
+    infer_batch,
+    generate_insert,
+    build_scene_prompt_from_fields,
+    init_models,
+    invalidate_persona_prefix,
+)
 
 # ========= 参数 =========
 WS_LOG = True            # 服务端日志（建议 True，便于你看到 join / enqueue / done）
 HISTORY_N = 12           # 最近 N 句作为上下文
 MAX_HISTORY = 100        # 历史最多保留
 GPU_QUEUE_MAX = 300      # 推理队列上限（并发多时先排队）
+USER_INFLIGHT_MAX = 2    # 每个用户同时在推理中的条数上限（0 = 不限）
+USER_QUEUE_MAX = 20      # 每个用户最多排队条数，超过直接拒绝（0 = 不限）
+ROOM_WEIGHTS = {}        # room_id -> 调度权重（默认 1.0，越大分到的推理份额越多）
+USER_WEIGHTS = {}        # user_id -> 调度权重（默认 1.0）
+CHAT_LINE_CONCURRENCY = 4  # 每个连接同时在处理（排队/打分/插话）的发言数上限
+COALESCE_MODE = "off"    # 同一用户连发时还在排队的旧发言："off" 各自打分 / "replace" 只打最新一句 / "merge" 拼成一句打分
+OUTBOX_MAX = 64          # 每个连接待发送帧上限
+SEND_TIMEOUT_S = 5.0     # 单帧发送期限，超时视为慢客户端并断开
+SLOW_CLIENT_STRIKES = 3  # 出站队列满且无帧可丢的次数达到后断开
+DROPPABLE_FRAME_TYPES = {"state_update", "presence"}  # 积压时可被合并/丢弃的帧类型
+GPU_BATCH_MAX = 8        # worker 一次最多合并多少条发言一起推理
+GPU_BATCH_WAIT_MS = 5    # 拿到第一条后最多再等多久凑批（毫秒，0 = 只取队列里现成的）
+LOOP_LAG_INTERVAL_MS = 100  # 事件循环延迟采样间隔
+LOOP_LAG_WARN_MS = 200      # 延迟超过该值时打印告警（WS_LOG 开启时）
+METRICS_PORT = 9108         # Prometheus 指标导出端口（GET /metrics；0 = 不启动）
 
-# ========= 单公共房间状态 =========
-STATE = {
-    "topic_en": "",
-    "scene_system": "",
-    "scene_user": "",
-    "scene_fields": {},
-    "experiment_ended": False,  # 实验是否已结束
-    "end_time": None,  # 实验结束时间
-    "start_time": int(time.time()),  # 实验开始时间
-    "questionnaire_started": False,  # 问卷是否已开始
-    "questionnaire_completed": False,  # 问卷是否已全部完成
-}
+# ========= 房间 =========
+# 每个房间一套独立的实验状态、历史和 CSV；所有房间共用同一个模型和 GPU_QUEUE/gpu_worker。
+# join 时按 room_id 路由（不带 room_id 进入 DEFAULT_ROOM_ID，行为与原来的单公共房间一致）；
+# 未 join 的连接先挂在默认房间，收到它的广播。
+DEFAULT_ROOM_ID = "public"
+
+class Room:
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.state = {
+            "topic_en": "",
+            "scene_system": "",
+            "scene_user": "",
+            "scene_fields": {},
+            "experiment_ended": False,  # 实验是否已结束
+            "end_time": None,  # 实验结束时间
+            "start_time": int(time.time()),  # 实验开始时间
+            "questionnaire_started": False,  # 问卷是否已开始
+            "questionnaire_completed": False,  # 问卷是否已全部完成
+        }
+
+        # 问卷相关
+        self.questionnaire_answers = {}  # user_id -> {target_number: score} 每个用户对其他用户的评分
+        self.questionnaire_completed = set()  # 已完成问卷的用户ID集合
+        self.participant_numbers = {}  # user_id -> display_number 所有参与者的编号映射
+
+        self.users = {}   # user_id -> {"nickname": str, "persona_profile": dict}
+        self.conns = set()  # 本房间的连接
+
+        self.history = ChatHistory(MAX_HISTORY, HISTORY_N)  # [{seq,user_id,nickname,text,ts}]，缓存最近 N 句上下文
+        self.agent_responses = []  # [{seq,final_willingness,triggered,strategy,text,ts}] - 记录Agent响应
 
-# 问卷相关
-QUESTIONNAIRE_ANSWERS = {}  # user_id -> {target_number: score} 每个用户对其他用户的评分
-QUESTIONNAIRE_COMPLETED = set()  # 已完成问卷的用户ID集合
-PARTICIPANT_NUMBERS = {}  # user_id -> display_number 所有参与者的编号映射
+        # 实验日志
+        self.log_csv = None  # 本房间 CSV 文件路径（end_experiment 时创建）
+        self.log_room_id = None  # 写进 CSV 的房间ID
+        self.user_number_map = {}  # user_id -> display_number (前端传来的编号)
+        self.agent_number_map = {}  # seq -> agent_number (记录Agent编号，通过seq关联)
 
-USERS = {}        # user_id -> {"nickname": str, "persona_profile": dict}
+        self.seq = 0
+        self.seq_lock = asyncio.Lock()
+
+ROOMS = {}        # room_id -> Room
+CONN2ROOM = {}    # websocket -> Room
 CONN2UID = {}     # websocket -> user_id
 CONNS = set()     # all connections
 
-HISTORY = []      # [{seq,user_id,nickname,text,ts}]
-AGENT_RESPONSES = []  # [{seq,final_willingness,triggered,strategy,text,ts}] - 记录Agent响应
+def _get_room(room_id: str) -> Room:
+    room = ROOMS.get(room_id)
+    if room is None:
+        room = ROOMS[room_id] = Room(room_id)
+        if WS_LOG:
+            print(f"[room] created room_id={room_id} rooms={len(ROOMS)}")
+    return room
+
+def _move_conn(ws, room: Room):
+    old = CONN2ROOM.get(ws)
+    if old is not None:
+        old.conns.discard(ws)
+    room.conns.add(ws)
+    CONN2ROOM[ws] = room
+
+def _drop_conn(ws):
+    CONNS.discard(ws)
+    room = CONN2ROOM.get(ws)
+    if room is not None:
+        room.conns.discard(ws)
 
-SEQ = 0
-SEQ_LOCK = asyncio.Lock()
 
 # ========= 实验日志 CSV =========
 LOG_DIR = "experiment_logs"
 os.makedirs(LOG_DIR, exist_ok=True)
-LOG_CSV = None  # 当前实验的CSV文件路径（根据房间ID动态生成）
-CURRENT_ROOM_ID = None  # 当前实验的房间ID
-LOG_FILE_LOCK = asyncio.Lock()
-USER_NUMBER_MAP = {}  # user_id -> display_number (前端传来的编号)
-AGENT_NUMBER_MAP = {}  # seq -> agent_number (记录Agent编号，通过seq关联)
+
+LOG_FLUSH_ROWS = 50          # 后台写线程攒够多少行写盘一次
+LOG_FLUSH_INTERVAL_S = 1.0   # 或距上次写盘超过多少秒
+
+# ========= 后台 CSV 写线程 =========
+# 调用方只把行放进 _LOG_QUEUE（不阻塞事件循环）；写线程保持一个打开的文件句柄，
+# 按行数/时间阈值批量写盘，flush_csv_log / stop_csv_writer 时立即写完。
+_LOG_QUEUE = queue.Queue()   # ("header", path, rows) / ("row", path, row) / ("flush" | "stop", Future)
+_LOG_THREAD = None
+
+def _csv_writer_loop():
+    fh, fh_path, writer = None, None, None
+    pending = []  # [(path, row)]
+    last_flush = time.monotonic()
+
+    def _open(path, mode):
+        nonlocal fh, fh_path, writer
+        if fh is not None:
+            fh.close()
+        fh = open(path, mode, newline='', encoding='utf-8-sig')
+        fh_path, writer = path, csv.writer(fh)
+
+    def _write_pending():
+        nonlocal last_flush
+        try:
+            for path, row in pending:
+                if path != fh_path:
+                    _open(path, 'a')
+                writer.writerow(row)
+            if fh is not None:
+                fh.flush()
+        except Exception as e:
+            if WS_LOG:
+                print(f"[log] 写入CSV失败: {repr(e)}")
+        pending.clear()
+        last_flush = time.monotonic()
+
+    while True:
+        timeout = max(0.0, LOG_FLUSH_INTERVAL_S - (time.monotonic() - last_flush))
+        try:
+            item = _LOG_QUEUE.get(timeout=timeout if pending else None)
+        except queue.Empty:
+            _write_pending()
+            continue
+
+        kind = item[0]
+        if kind == "row":
+            pending.append((item[1], item[2]))
+            if len(pending) >= LOG_FLUSH_ROWS:
+                _write_pending()
+        elif kind == "header":
+            _write_pending()
+            try:
+                _open(item[1], 'w')
+                writer.writerows(item[2])
+                fh.flush()
+                if WS_LOG:
+                    print(f"[log] CSV日志文件已创建: {item[1]}")
+            except Exception as e:
+                print(f"[log] 创建CSV文件失败: {repr(e)}")
+        else:  # flush / stop
+            _write_pending()
+            if kind == "stop" and fh is not None:
+                fh.close()
+                fh, fh_path, writer = None, None, None
+            item[1].set_result(True)
+            if kind == "stop":
+                return
+
+def _ensure_csv_writer():
+    global _LOG_THREAD
+    if _LOG_THREAD is None or not _LOG_THREAD.is_alive():
+        _LOG_THREAD = threading.Thread(target=_csv_writer_loop, name="csv_writer", daemon=True)
+        _LOG_THREAD.start()
 
 # 初始化CSV文件（写入表头）
-def init_csv_log(room_id: str = None):
-    """初始化CSV日志文件，写入表头（包含房间ID和LoRA子分数）"""
-    global LOG_CSV, CURRENT_ROOM_ID
-    
+def init_csv_log(room: Room, room_id: str = None):
+    """初始化房间的CSV日志文件，写入表头（包含房间ID和LoRA子分数）；实际写盘由后台写线程完成"""
     if not room_id:
         room_id = f"room_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     
-    CURRENT_ROOM_ID = room_id
+    room.log_room_id = room_id
     # CSV文件名包含房间ID
-    LOG_CSV = os.path.join(LOG_DIR, f"lora_experiment_{room_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    room.log_csv = os.path.join(LOG_DIR, f"lora_experiment_{room_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
     
+    _ensure_csv_writer()
+    _LOG_QUEUE.put(("header", room.log_csv, [
+        # 表头第一列是房间ID
+        [
+            '房间ID', '时间戳', '序号', '发言者类型', '编号', '用户ID', '说话内容',
+            '最终Willingness', 'Persona分数', 'Scene分数', 'Topic分数',
+            '是否触发插话', 'Agent策略', 'Agent插话内容', 'Agent编号', '时间线(ms)'
+        ],
+        # 写入房间ID信息行
+        [
+            room_id,  # 房间ID
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "ROOM_INFO",
+            '房间信息',
+            "",
+            "system",
+            f"实验房间ID: {room_id}",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+        ],
+    ]))
+
+def write_csv_log(room: Room, row_data: list):
+    """把一行日志交给后台写线程（自动添加房间ID），不阻塞；CSV 尚未初始化时丢弃"""
+    if not room.log_csv:
+        return
+    _ensure_csv_writer()
+    # 在行数据前添加房间ID
+    _LOG_QUEUE.put(("row", room.log_csv, [room.log_room_id or ""] + row_data))
+
+async def flush_csv_log():
+    """等待后台写线程把已排队的行全部写盘"""
+    if _LOG_THREAD is None or not _LOG_THREAD.is_alive():
+        return
+    fut = concurrent.futures.Future()
+    _LOG_QUEUE.put(("flush", fut))
+    await asyncio.wrap_future(fut)
+
+def stop_csv_writer(timeout: float = 5.0):
+    """关闭时调用：写完剩余行并关闭文件句柄"""
+    if _LOG_THREAD is None or not _LOG_THREAD.is_alive():
+        return
+    fut = concurrent.futures.Future()
+    _LOG_QUEUE.put(("stop", fut))
     try:
-        with open(LOG_CSV, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.writer(f)
-            # 表头第一列是房间ID
-            writer.writerow([
-                '房间ID', '时间戳', '序号', '发言者类型', '编号', '用户ID', '说话内容',
-                '最终Willingness', 'Persona分数', 'Scene分数', 'Topic分数',
-                '是否触发插话', 'Agent策略', 'Agent插话内容', 'Agent编号'
-            ])
-            # 写入房间ID信息行
-            writer.writerow([
-                room_id,  # 房间ID
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                "ROOM_INFO",
-                '房间信息',
-                "",
-                "system",
-                f"实验房间ID: {room_id}",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-            ])
-        if WS_LOG:
-            print(f"[log] CSV日志文件已创建: {LOG_CSV} (房间ID: {room_id})")
+        fut.result(timeout=timeout)
     except Exception as e:
-        print(f"[log] 创建CSV文件失败: {repr(e)}")
-
-async def write_csv_log(row_data: list):
-    """异步写入CSV日志（自动添加房间ID）"""
-    async with LOG_FILE_LOCK:
-        try:
-            if LOG_CSV and os.path.exists(LOG_CSV):
-                # 在行数据前添加房间ID
-                row_with_room = [CURRENT_ROOM_ID or ""] + row_data
-                with open(LOG_CSV, 'a', newline='', encoding='utf-8-sig') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(row_with_room)
-        except Exception as e:
-            if WS_LOG:
-                print(f"[log] 写入CSV失败: {repr(e)}")
+        print(f"[log] 关闭CSV写线程超时: {repr(e)}")
 
 # 注意：不再自动初始化CSV，等收到房间ID后再初始化
 
 # ========= GPU 串行队列 =========
-GPU_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=GPU_QUEUE_MAX)
+# 房间之间、同房间用户之间加权公平；满了由 submit_infer_job 抛 QueueRejected
+GPU_QUEUE = FairQueue(
+    GPU_QUEUE_MAX,
+    user_inflight_max=USER_INFLIGHT_MAX,
+    user_queue_max=USER_QUEUE_MAX,
+    room_weights=ROOM_WEIGHTS,
+    user_weights=USER_WEIGHTS,
+)
+# 单线程执行器：前向始终串行，但不占用事件循环线程
+INFER_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer")
+
+# 断线 / 实验结束后还在队列里的 job 不再送进模型；gpu_ms_saved 按最近的每条平均耗时估算
+CANCEL_STATS = {"gpu_cancelled": 0, "gpu_room_ended": 0, "gpu_ms_saved": 0.0, "llm_skipped": 0}
+_GPU_MS_PER_JOB = 0.0  # 每条 job 前向耗时的滑动平均（ms）
+
+# ========= 指标（Metrics.serve 在 METRICS_PORT 上导出）=========
+M_QUEUE_WAIT = Metrics.Histogram("willingness_queue_wait_ms", "入队到被 gpu_worker 取出的等待时间")
+M_HEAD_MS = Metrics.Histogram("willingness_head_ms", "每条发言各 LoRA 头的前向耗时（debug_timing 的 ms_persona/ms_scene/ms_topic）", ("head",))
+M_STRATEGY_MS = Metrics.Histogram("willingness_strategy_ms", "ChatGPT 插话（strategy + insert）耗时")
+M_E2E_MS = Metrics.Histogram("willingness_e2e_ms", "收到 chat_line 到广播 chat_update(done) 的耗时")
+M_LINES = Metrics.Counter("willingness_chat_lines_total", "chat_line 按终态计数", ("status",))
+M_TRIGGERS = Metrics.Counter("willingness_triggers_total", "分数超过阈值、触发插话的发言数")
+M_FALLBACKS = Metrics.Counter("willingness_fallbacks_total", "走兜底的次数（infer = 打分失败按 0 分处理，insert = 插话用兜底文本）", ("stage",))
+M_REJECTED = Metrics.Counter("willingness_queue_rejected_total", "推理队列满被拒绝的发言数", ("reason",))
+Metrics.Gauge("willingness_gpu_queue_depth", "推理队列中排队的发言数", lambda: GPU_QUEUE.qsize())
+Metrics.Gauge("willingness_gpu_inflight", "已出队、正在推理的发言数", lambda: GPU_QUEUE.stats()["inflight"])
+Metrics.Gauge("willingness_connections", "当前 WebSocket 连接数", lambda: len(CONNS))
+Metrics.Gauge("willingness_users", "已 join 的在线用户数", lambda: len(CONN2UID))
+Metrics.Gauge("willingness_rooms", "房间数", lambda: len(ROOMS))
+
+# ========= 单条发言的时间线 =========
+# job["span"] 记录各阶段的 perf_counter 时间点，chat_update 的 "span" 和 CSV 里给出相对 recv 的毫秒数：
+# recv（收到 chat_line）-> ack（chat_ack 已广播）-> enqueue -> dequeue（被 worker 取出）-> infer_start/infer_end（所在批次前向）
+# -> llm_start/llm_end（触发插话时，含 LLM_EXECUTOR 排队）-> broadcast（开始广播最终 chat_update）
+SPAN_MARKS = ("recv", "ack", "enqueue", "dequeue", "infer_start", "infer_end", "llm_start", "llm_end", "broadcast")
+SPAN_DURATIONS = {  # 名称 -> (起点, 终点)
+    "ms_ack": ("recv", "ack"),
+    "ms_queue_wait": ("enqueue", "dequeue"),
+    "ms_batch_wait": ("dequeue", "infer_start"),
+    "ms_infer": ("infer_start", "infer_end"),
+    "ms_llm": ("llm_start", "llm_end"),
+    "ms_ack_to_update": ("ack", "broadcast"),
+    "ms_e2e": ("recv", "broadcast"),
+}
+
+def _mark(job: dict, name: str):
+    job.setdefault("span", {})[name] = time.perf_counter()
+
+def _span_summary(span: dict) -> dict:
+    """时间点换算成相对 recv（没有 recv 时用最早的时间点）的毫秒数，并算出各阶段耗时。"""
+    if not span:
+        return {}
+    base = span.get("recv", min(span.values()))
+    out = {f"t_{k}": round((span[k] - base) * 1000.0, 2) for k in SPAN_MARKS if k in span}
+    for name, (a, b) in SPAN_DURATIONS.items():
+        if a in span and b in span:
+            out[name] = round((span[b] - span[a]) * 1000.0, 2)
+    if "broadcast_end" in span:
+        out["ms_broadcast"] = round((span["broadcast_end"] - span["broadcast"]) * 1000.0, 2)
+    return out
+
+class JobSkipped(Exception):
+    """job 出队时房间实验已结束，未打分。"""
+
+def _closed(job: dict) -> bool:
+    """发言者的连接是否已断开（job["closed"] 是 handler 的每连接 Event；压测等直接提交的 job 没有）。"""
+    closed = job.get("closed")
+    return closed is not None and closed.is_set()
+
+def _runnable(job: dict) -> bool:
+    """出队时检查：发言者已断线（future 已取消或连接已关闭）或房间已结束的 job 直接丢弃并释放名额。"""
+    fut = job["future"]
+    room = ROOMS.get(job.get("room_id"))
+    if fut.cancelled() or _closed(job):
+        CANCEL_STATS["gpu_cancelled"] += 1
+        fut.cancel()  # 等待它的 _score_chat_line 收到 CancelledError，广播 cancelled
+    elif room is not None and room.state.get("experiment_ended"):
+        CANCEL_STATS["gpu_room_ended"] += 1
+        if not fut.done():
+            fut.set_exception(JobSkipped("experiment_ended"))
+    else:
+        _mark(job, "dequeue")
+        if "enqueue" in job["span"]:
+            M_QUEUE_WAIT.observe((job["span"]["dequeue"] - job["span"]["enqueue"]) * 1000.0)
+        return True
+    CANCEL_STATS["gpu_ms_saved"] += _GPU_MS_PER_JOB
+    GPU_QUEUE.task_done(job)
+    if WS_LOG:
+        print(f"[gpu_worker] skip room={job.get('room_id')} seq={job.get('seq')}")
+    return False
+
+async def _next_batch() -> list:
+    """阻塞等到第一条可运行的 job，然后在 GPU_BATCH_WAIT_MS 内继续收集，最多 GPU_BATCH_MAX 条。"""
+    loop = asyncio.get_running_loop()
+    jobs = []
+    while not jobs:
+        job = await GPU_QUEUE.get()
+        if _runnable(job):
+            jobs.append(job)
+    deadline = loop.time() + GPU_BATCH_WAIT_MS / 1000.0
+    while len(jobs) < GPU_BATCH_MAX:
+        job = GPU_QUEUE.get_nowait()
+        if job is not None:
+            if _runnable(job):
+                jobs.append(job)
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            job = await asyncio.wait_for(GPU_QUEUE.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if _runnable(job):
+            jobs.append(job)
+    return jobs
 
 async def gpu_worker():
+    global _GPU_MS_PER_JOB
     if WS_LOG:
         print("[gpu_worker] started")
     while True:
-        job = await GPU_QUEUE.get()
-        fut = job["future"]
+        jobs = await _next_batch()
+        t0 = time.perf_counter()
+        for job in jobs:
+            job["span"]["infer_start"] = t0
         try:
             if WS_LOG:
-                print(f"[gpu_worker] run seq={job.get('seq')}")
-            result = infer_once(
-                persona_profile=job["persona_profile"],
-                topic_en=job["topic_en"],
-                scene_system=job["scene_system"],
-                scene_user=job["scene_user"],
-                utterance=job["utterance"],
-            )
-            if not fut.cancelled():
-                fut.set_result(result)
+                print(f"[gpu_worker] run seqs={[(job.get('room_id'), job.get('seq')) for job in jobs]}")
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(INFER_EXECUTOR, infer_batch, [{
+                "persona_profile": job["persona_profile"],
+                "topic_en": job["topic_en"],
+                "scene_system": job["scene_system"],
+                "scene_user": job["scene_user"],
+                "utterance": job["utterance"],
+            } for job in jobs], False)  # 只打分；插话由 _insert_stage 另行生成
+            t1 = time.perf_counter()
+            for job in jobs:
+                job["span"]["infer_end"] = t1
+            ms_per_job = (t1 - t0) * 1000.0 / len(jobs)
+            _GPU_MS_PER_JOB = ms_per_job if not _GPU_MS_PER_JOB else 0.8 * _GPU_MS_PER_JOB + 0.2 * ms_per_job
+            for job, result in zip(jobs, results):
+                timing = result.get("debug_timing") or {}
+                for head in ("persona", "scene", "topic"):
+                    if f"ms_{head}" in timing:
+                        M_HEAD_MS.observe(timing[f"ms_{head}"], head=head)
+                if not job["future"].cancelled():
+                    job["future"].set_result(result)
         except Exception as e:
-            if not fut.cancelled():
-                fut.set_exception(e)
+            for job in jobs:
+                if not job["future"].cancelled():
+                    job["future"].set_exception(e)
         finally:
-            GPU_QUEUE.task_done()
+            for job in jobs:
+                GPU_QUEUE.task_done(job)
 
 async def submit_infer_job(job: dict) -> dict:
+    """入队并等待打分结果；队列满时抛 QueueRejected，合并模式下被新发言取代时抛 JobSuperseded。"""
     loop = asyncio.get_running_loop()
     fut = loop.create_future()
     job["future"] = fut
+    _mark(job, "enqueue")
     try:
-        GPU_QUEUE.put_nowait(job)
+        superseded = GPU_QUEUE.put_nowait(job, coalesce=COALESCE_MODE != "off")
+    except QueueRejected as e:
+        M_REJECTED.inc(reason=e.reason)
         if WS_LOG:
-            print(f"[queue] enqueue seq={job.get('seq')} qsize={GPU_QUEUE.qsize()}")
-    except asyncio.QueueFull:
+            print(f"[queue] REJECT room={job.get('room_id')} user={job.get('user_id')} reason={e.reason} depth={e.depth}")
+        raise
+    if superseded:
+        # 旧 job 还没开始推理：不再打分，由各自的 chat_line 回 chat_update(superseded)
+        if COALESCE_MODE == "merge":
+            job["utterance"] = "\n".join([old["utterance"] for old in superseded] + [job["utterance"]])
+        for old in superseded:
+            if not old["future"].done():
+                old["future"].set_exception(JobSuperseded(job.get("seq")))
         if WS_LOG:
-            print("[queue] FULL -> drop")
-        return {
-            "type": "agent_utterance",
-            "final_willingness": 0.0,
-            "threshold": 0.60,
-            "topic_en": job.get("topic_en", ""),
-            "strategy": "disabled",
-            "text": "",
-            "sub_scores": {"persona": 0.0, "scene": 0.0, "topic": 0.0},
-            "debug_timing": {"error": "gpu_queue_full"},
-            "debug_inputs": None,
-        }
+            print(f"[queue] coalesce seqs={[old.get('seq') for old in superseded]} -> seq={job.get('seq')} ({COALESCE_MODE})")
+    if WS_LOG:
+        print(f"[queue] enqueue room={job.get('room_id')} seq={job.get('seq')} qsize={GPU_QUEUE.qsize()}")
     return await fut
 
+# ========= LLM 插话阶段（与 GPU 打分解耦） =========
+LLM_CONCURRENCY = 8      # 同时进行的 ChatGPT 插话请求上限
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix="llm")
+
+async def _finish_chat_line(room: Room, seq: int, uid: str, user_number, text: str, agent_payload: dict, span: dict):
+    """一条发言的收尾：广播 chat_update(done，带时间线 span) -> 写用户行 CSV（含广播耗时）-> 有插话时写 Agent 行 CSV。"""
+    final_willingness = agent_payload.get("final_willingness", 0.0)
+    did_trigger = final_willingness > agent_payload.get("threshold", 0.6)
+    sub_scores = agent_payload.get("sub_scores", {})
+    persona_score = sub_scores.get("persona", 0.0)
+    scene_score = sub_scores.get("scene", 0.0)
+    topic_score = sub_scores.get("topic", 0.0)
+    agent_strategy = agent_payload.get("strategy", "disabled")
+    agent_text = agent_payload.get("text", "")
+
+    # 推理完成：广播 update（用 seq 对齐 ack）
+    span["broadcast"] = time.perf_counter()
+    await _broadcast(room, {
+        "type": "chat_update",
+        "seq": seq,
+        "agent": agent_payload,
+        "status": "done",
+        "span": _span_summary(span),
+        "ts": int(time.time()),
+    })
+    span["broadcast_end"] = time.perf_counter()
+
+    # 记录用户消息到CSV（包含LoRA子分数和时间线）
+    write_csv_log(room, [
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        seq,
+        '用户',
+        str(user_number),
+        uid,
+        text,
+        f"{final_willingness:.4f}",  # 最终Willingness
+        f"{persona_score:.4f}",  # Persona分数
+        f"{scene_score:.4f}",  # Scene分数
+        f"{topic_score:.4f}",  # Topic分数
+        "是" if did_trigger else "否",  # 是否触发插话
+        agent_strategy if did_trigger else "",  # Agent策略
+        agent_text if did_trigger else "",  # Agent插话内容
+        "",  # Agent编号（待前端补充）
+        json.dumps(_span_summary(span)),  # 时间线（ms）
+    ])
+
+    # 如果Agent有插话，记录Agent消息到CSV
+    # Agent编号可能会稍后由前端通过 agent_number 消息补充
+    agent_number = room.agent_number_map.get(seq, "")
+    if did_trigger and agent_text:
+        write_csv_log(room, [
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            f"{seq}-agent",
+            'Agent',
+            str(agent_number) if agent_number else "",  # Agent编号
+            "agent",
+            agent_text,
+            f"{final_willingness:.4f}",  # 最终Willingness
+            f"{persona_score:.4f}",  # Persona分数
+            f"{scene_score:.4f}",  # Scene分数
+            f"{topic_score:.4f}",  # Topic分数
+            "是",
+            agent_strategy,
+            agent_text,
+            str(agent_number) if agent_number else "",  # Agent编号
+        ])
+
+async def _insert_stage(room: Room, seq, uid, user_number, text, infer_job: dict, agent_payload: dict, response_record: dict):
+    """触发后的插话生成：在 LLM_EXECUTOR 里调用 ChatGPT，不占 GPU worker，完成后补发 chat_update(done)。
+    发言者已断线时不再调用 ChatGPT；断线时还在 LLM_EXECUTOR 里排队的调用由 handler 撤掉（见 handler 的 finally），
+    这两种情况这条都按“已打分、未插话”（strategy=skipped）收尾。"""
+    if room.state.get("experiment_ended") or _closed(infer_job):
+        CANCEL_STATS["llm_skipped"] += 1
+        res = {"strategy": "skipped", "insert": "", "ms_strategy": 0.0}
+    else:
+        _mark(infer_job, "llm_start")
+        cf = infer_job["llm_future"] = LLM_EXECUTOR.submit(functools.partial(
+            generate_insert,
+            persona_profile=infer_job["persona_profile"],
+            topic_en=infer_job["topic_en"],
+            utterance=infer_job["utterance"],
+            scene_system=infer_job["scene_system"],
+            scene_user=infer_job["scene_user"],
+        ))
+        try:
+            res = await asyncio.wrap_future(cf)
+            _mark(infer_job, "llm_end")
+            M_STRATEGY_MS.observe(res["ms_strategy"])
+        except asyncio.CancelledError:
+            # 还在 LLM_EXECUTOR 里排队（没发出请求）的调用被撤掉
+            if not (cf.cancel() or cf.cancelled()):
+                raise
+            CANCEL_STATS["llm_skipped"] += 1
+            if not _closed(infer_job):
+                raise
+            res = {"strategy": "skipped", "insert": "", "ms_strategy": 0.0}
+        except Exception as e:
+            if WS_LOG:
+                print(f"[insert] seq={seq} failed: {repr(e)}")
+            _mark(infer_job, "llm_end")
+            res = {"strategy": "fallback", "insert": "", "ms_strategy": 0.0}
+        if res["strategy"] == "fallback":  # generate_insert 内部 ChatGPT 失败也返回 fallback
+            M_FALLBACKS.inc(stage="insert")
+
+    agent_payload["strategy"] = res["strategy"]
+    agent_payload["text"] = res["insert"]
+    if isinstance(agent_payload.get("debug_timing"), dict):
+        agent_payload["debug_timing"]["ms_strategy"] = round(res["ms_strategy"], 2)
+    response_record["strategy"] = res["strategy"]
+    response_record["text"] = res["insert"]
+
+    if WS_LOG:
+        print(f"[insert] seq={seq} strategy={res['strategy']} ms={res['ms_strategy']:.1f}")
+    await _finish_chat_line(room, seq, uid, user_number, text, agent_payload, infer_job["span"])
+
+# ========= 事件循环延迟 =========
+LOOP_LAG = {"last_ms": 0.0, "max_ms": 0.0, "sum_ms": 0.0, "samples": 0}
+
+async def loop_lag_monitor():
+    """每 LOOP_LAG_INTERVAL_MS 睡一次，实际醒来时间比预期晚多少就是事件循环被阻塞的时长。"""
+    loop = asyncio.get_running_loop()
+    interval = LOOP_LAG_INTERVAL_MS / 1000.0
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - t0 - interval) * 1000.0)
+        LOOP_LAG["last_ms"] = lag_ms
+        LOOP_LAG["max_ms"] = max(LOOP_LAG["max_ms"], lag_ms)
+        LOOP_LAG["sum_ms"] += lag_ms
+        LOOP_LAG["samples"] += 1
+        if WS_LOG and lag_ms > LOOP_LAG_WARN_MS:
+            print(f"[loop_lag] event loop blocked {lag_ms:.1f}ms")
+
+def _loop_lag_summary() -> dict:
+    n = LOOP_LAG["samples"]
+    return {
+        "last_ms": round(LOOP_LAG["last_ms"], 2),
+        "max_ms": round(LOOP_LAG["max_ms"], 2),
+        "avg_ms": round(LOOP_LAG["sum_ms"] / n, 2) if n else 0.0,
+    }
+
+# ========= 出站队列（每个连接一个，广播并发扇出） =========
+# 每个连接有自己的有界待发队列和发送任务：广播只把同一份 json 字符串放进各队列就返回，
+# 慢客户端只拖慢它自己。队列满时先合并/丢弃旧的 state_update/presence 帧；
+# 若仍然满且该连接正卡在一次发送里，记一次 strike，累计 SLOW_CLIENT_STRIKES 次
+# （或单帧发送超过 SEND_TIMEOUT_S）就断开该客户端。
+OUTBOXES = {}  # websocket -> {"frames": deque[(type, msg)], "wake": Event, "task": Task, "sending": bool, "strikes": int, "closing": bool}
+OUTBOX_STATS = {"merged": 0, "dropped": 0, "slow_disconnects": 0}
+
+def _open_outbox(ws):
+    box = {"frames": deque(), "wake": asyncio.Event(), "task": None, "sending": False, "strikes": 0, "closing": False}
+    OUTBOXES[ws] = box
+    box["task"] = asyncio.create_task(_outbox_sender(ws, box))
+
+def _close_outbox(ws):
+    box = OUTBOXES.pop(ws, None)
+    if box and box["task"] and box["task"] is not asyncio.current_task():
+        box["task"].cancel()
+
+async def _disconnect_slow(ws, reason: str):
+    OUTBOX_STATS["slow_disconnects"] += 1
+    if WS_LOG:
+        print(f"[send] slow client {getattr(ws, 'remote_address', None)} -> disconnect ({reason})")
+    # 不再给它广播；handler 的 finally 负责 leave 广播等清理
+    _drop_conn(ws)
+    _close_outbox(ws)
+    try:
+        await asyncio.wait_for(ws.close(), SEND_TIMEOUT_S)
+    except Exception:
+        pass
+
+async def _outbox_sender(ws, box: dict):
+    frames, wake = box["frames"], box["wake"]
+    while True:
+        if not frames:
+            box["strikes"] = 0  # 积压清空，之前的慢记录作废
+            wake.clear()
+            await wake.wait()
+            continue
+        _, msg = frames.popleft()
+        box["sending"] = True
+        try:
+            await asyncio.wait_for(ws.send(msg), SEND_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            box["closing"] = True
+            await _disconnect_slow(ws, "send timeout")
+            return
+        except Exception as e:
+            if WS_LOG:
+                print("[send] failed:", repr(e))
+            _drop_conn(ws)
+            _close_outbox(ws)
+            return
+        finally:
+            box["sending"] = False
+
+def _enqueue_frame(ws, ftype: str, msg: str):
+    box = OUTBOXES.get(ws)
+    if box is None or box["closing"]:
+        return
+    frames = box["frames"]
+    if len(frames) >= OUTBOX_MAX:
+        # 1) 新的 state_update/presence 覆盖队列里同类型的旧帧
+        if ftype in DROPPABLE_FRAME_TYPES:
+            kept = deque(f for f in frames if f[0] != ftype)
+            OUTBOX_STATS["merged"] += len(frames) - len(kept)
+            frames.clear()
+            frames.extend(kept)
+        # 2) 仍然满：丢掉最旧的一帧可丢弃帧
+        if len(frames) >= OUTBOX_MAX:
+            for i, (t, _) in enumerate(frames):
+                if t in DROPPABLE_FRAME_TYPES:
+                    del frames[i]
+                    OUTBOX_STATS["dropped"] += 1
+                    break
+        # 3) 全是不可丢弃的帧，且连接正卡在发送上：记 strike，到阈值断开
+        #    （发送任务还没来得及跑的瞬时突发不算慢）
+        if len(frames) >= OUTBOX_MAX and box["sending"]:
+            box["strikes"] += 1
+            if box["strikes"] >= SLOW_CLIENT_STRIKES:
+                box["closing"] = True
+                asyncio.create_task(_disconnect_slow(ws, "outbox full"))
+                return
+    frames.append((ftype, msg))
+    box["wake"].set()
+
 # ========= 工具 =========
 async def _safe_send(ws, payload: dict):
-    try:
-        await ws.send(json.dumps(payload, ensure_ascii=False))
-    except Exception as e:
-        if WS_LOG:
-            print("[send] failed:", repr(e))
+    _enqueue_frame(ws, payload.get("type", ""), json.dumps(payload, ensure_ascii=False))
 
-async def _broadcast(payload: dict):
+async def _broadcast(room: Room, payload: dict):
+    # 只序列化一次，房间内各连接的发送任务并发发出
     msg = json.dumps(payload, ensure_ascii=False)
-    dead = []
-    for ws in list(CONNS):
-        try:
-            await ws.send(msg)
-        except Exception:
-            dead.append(ws)
-    for ws in dead:
-        CONNS.discard(ws)
-        CONN2UID.pop(ws, None)
-
-def _build_state_payload() -> dict:
+    ftype = payload.get("type", "")
+    for ws in list(room.conns):
+        _enqueue_frame(ws, ftype, msg)
+
+def _build_state_payload(room: Room) -> dict:
     return {
         "type": "state_update",
-        "topic_en": STATE["topic_en"],
-        "scene_system": STATE["scene_system"],
-        "scene_user": STATE["scene_user"],
-        "scene_fields": STATE["scene_fields"],
-        "experiment_ended": STATE.get("experiment_ended", False),
+        "topic_en": room.state["topic_en"],
+        "scene_system": room.state["scene_system"],
+        "scene_user": room.state["scene_user"],
+        "scene_fields": room.state["scene_fields"],
+        "experiment_ended": room.state.get("experiment_ended", False),
     }
 
 # ========= 实验统计功能 =========
-def generate_experiment_statistics() -> dict:
+def generate_experiment_statistics(room: Room) -> dict:
     """生成实验统计数据（LoRA系统版本）"""
     try:
         stats = {
-            "total_users": len(USERS),
-            "total_messages": len(HISTORY),
+            "total_users": len(room.users),
+            "total_messages": len(room.history),
             "agent_responses": 0,
             "agent_trigger_rate": 0.0,
             "average_willingness": 0.0,
@@ -223,30 +724,30 @@ def generate_experiment_statistics() -> dict:
         }
         
         # 计算实验持续时间
-        if STATE.get("end_time") and STATE.get("start_time"):
-            duration_seconds = STATE["end_time"] - STATE["start_time"]
+        if room.state.get("end_time") and room.state.get("start_time"):
+            duration_seconds = room.state["end_time"] - room.state["start_time"]
             duration_minutes = duration_seconds / 60
             stats["experiment_duration"] = f"{duration_minutes:.1f}分钟"
         
         # 统计Agent响应次数和意愿分数
-        if AGENT_RESPONSES:
-            triggered_count = sum(1 for r in AGENT_RESPONSES if r.get("triggered", False))
+        if room.agent_responses:
+            triggered_count = sum(1 for r in room.agent_responses if r.get("triggered", False))
             stats["agent_responses"] = triggered_count
             
             # 计算平均意愿分数（所有响应的final_willingness）
-            all_willingness = [r.get("final_willingness", 0.0) for r in AGENT_RESPONSES if r.get("final_willingness") is not None]
+            all_willingness = [r.get("final_willingness", 0.0) for r in room.agent_responses if r.get("final_willingness") is not None]
             if all_willingness:
                 stats["average_willingness"] = sum(all_willingness) / len(all_willingness)
             
             # 计算触发率（触发次数 / 总评估次数）
-            if len(AGENT_RESPONSES) > 0:
-                stats["agent_trigger_rate"] = triggered_count / len(AGENT_RESPONSES)
+            if len(room.agent_responses) > 0:
+                stats["agent_trigger_rate"] = triggered_count / len(room.agent_responses)
             
             # 计算子分数平均值（persona/scene/topic）
             persona_scores = []
             scene_scores = []
             topic_scores = []
-            for r in AGENT_RESPONSES:
+            for r in room.agent_responses:
                 sub_scores = r.get("sub_scores", {})
                 if sub_scores.get("persona") is not None:
                     persona_scores.append(sub_scores["persona"])
@@ -268,61 +769,248 @@ def generate_experiment_statistics() -> dict:
             print(f"[stats] 生成统计失败: {repr(e)}")
         return {}
 
-def _online_users():
-    return [{"user_id": uid, "nickname": u["nickname"]} for uid, u in USERS.items()]
+def _online_users(room: Room):
+    return [{"user_id": uid, "nickname": u["nickname"]} for uid, u in room.users.items()]
 
-def _format_history(n: int) -> str:
-    if not HISTORY:
-        return ""
-    tail = HISTORY[-n:]
-    lines = ["[HISTORY]"]
-    for it in tail:
-        lines.append(f'{it.get("nickname","anon")}: {it.get("text","")}')
-    return "\n".join(lines)
+async def _score_chat_line(room: Room, seq: int, uid: str, user_number, text: str, infer_job: dict):
+    """chat_line 的打分与收尾（每条发言一个后台任务，handler 的接收循环不等它）。
+    发言者断线时：还没入队 / 还在排队的发言广播 cancelled（没有打分）；已经在推理或插话阶段的照常收尾。"""
+    try:
+        if _closed(infer_job):
+            # 任务还没开始运行发言者就断线了
+            raise asyncio.CancelledError
+        # 串行推理（不会抢 GPU）：这里只打分，插话在 LLM 阶段另行生成
+        try:
+            agent_payload = await submit_infer_job(infer_job)
+        except QueueRejected as e:
+            # 背压：明确告诉房间这条没有被打分（不再伪装成 0 分结果），不计入 Agent 统计
+            M_LINES.inc(status="rejected")
+            await _broadcast(room, {
+                "type": "chat_update",
+                "seq": seq,
+                "agent": None,
+                "status": "rejected",
+                "reason": e.reason,  # queue_full / user_queue_full
+                "queue_depth": e.depth,
+                "span": _span_summary(infer_job["span"]),
+                "ts": int(time.time()),
+            })
+            write_csv_log(room, [
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                seq,
+                '用户',
+                str(user_number),
+                uid,
+                text,
+                "",
+                "",
+                "",
+                "",
+                "否",
+                f"rejected:{e.reason}",
+                "",
+                "",
+                json.dumps(_span_summary(infer_job["span"])),
+            ])
+            return
+        except JobSuperseded as e:
+            # 合并模式：这句还没打分就被同一用户更新的发言取代，只有最新那句决定 Agent 是否插话
+            M_LINES.inc(status="superseded")
+            await _broadcast(room, {
+                "type": "chat_update",
+                "seq": seq,
+                "agent": None,
+                "status": "superseded",
+                "superseded_by": e.by_seq,
+                "span": _span_summary(infer_job["span"]),
+                "ts": int(time.time()),
+            })
+            write_csv_log(room, [
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                seq,
+                '用户',
+                str(user_number),
+                uid,
+                text,
+                "",
+                "",
+                "",
+                "",
+                "否",
+                f"superseded:{e.by_seq}",
+                "",
+                "",
+                json.dumps(_span_summary(infer_job["span"])),
+            ])
+            return
+        except JobSkipped as e:
+            # 排队期间实验已结束：没有打分，也不再写 CSV（EXPERIMENT_END 之后）
+            M_LINES.inc(status="skipped")
+            await _broadcast(room, {
+                "type": "chat_update",
+                "seq": seq,
+                "agent": None,
+                "status": "skipped",
+                "reason": str(e),
+                "span": _span_summary(infer_job["span"]),
+                "ts": int(time.time()),
+            })
+            return
+        except Exception as e:
+            M_FALLBACKS.inc(stage="infer")
+            agent_payload = {
+                "type": "agent_utterance",
+                "final_willingness": 0.0,
+                "threshold": 0.60,
+                "topic_en": room.state["topic_en"],
+                "strategy": "disabled",
+                "text": "",
+                "sub_scores": {"persona": 0.0, "scene": 0.0, "topic": 0.0},
+                "debug_timing": {"error": repr(e)},
+                "debug_inputs": None,
+            }
 
-# ========= handler =========
-async def handler(ws):
-    # 声明全局变量（需要在函数开始处声明，不能在中间声明）
-    global PARTICIPANT_NUMBERS, QUESTIONNAIRE_ANSWERS, QUESTIONNAIRE_COMPLETED
-    
-    peer = getattr(ws, "remote_address", None)
-    CONNS.add(ws)
-    if WS_LOG:
-        print("[conn] client connected:", peer)
+        if isinstance(agent_payload.get("debug_timing"), dict):
+            agent_payload["debug_timing"]["loop_lag"] = _loop_lag_summary()
 
-    await _safe_send(ws, {"type": "status", "connected": True})
-    await _safe_send(ws, _build_state_payload())
+        final_willingness = agent_payload.get("final_willingness", 0.0)
+        did_trigger = final_willingness > agent_payload.get("threshold", 0.6)
+        if did_trigger:
+            M_TRIGGERS.inc()
+
+        # 获取LoRA子分数
+        sub_scores = agent_payload.get("sub_scores", {})
+        persona_score = sub_scores.get("persona", 0.0)
+        scene_score = sub_scores.get("scene", 0.0)
+        topic_score = sub_scores.get("topic", 0.0)
+
+        if WS_LOG:
+            print(f"[done] seq={seq} final={final_willingness} triggered={did_trigger}")
+            print(f"[lora_scores] persona={persona_score:.4f} scene={scene_score:.4f} topic={topic_score:.4f}")
+
+        # 记录Agent响应到统计列表（插话异步生成时，_insert_stage 会补上 strategy/text）
+        response_record = {
+            "seq": seq,
+            "final_willingness": final_willingness,
+            "triggered": did_trigger,
+            "strategy": agent_payload.get("strategy", "disabled"),
+            "text": agent_payload.get("text", ""),
+            "sub_scores": sub_scores,
+            "ts": int(time.time()),
+        }
+        room.agent_responses.append(response_record)
+
+        # 只保留最近N条Agent响应记录（避免内存溢出）
+        MAX_AGENT_RESPONSES = 1000
+        if len(room.agent_responses) > MAX_AGENT_RESPONSES:
+            room.agent_responses[:] = room.agent_responses[-MAX_AGENT_RESPONSES:]
+
+        if did_trigger and agent_payload.get("strategy") == "pending":
+            # 分数先广播（还没有插话文本，前端不会渲染 Agent 气泡），插话生成后再补发 chat_update(done)
+            await _broadcast(room, {
+                "type": "chat_update",
+                "seq": seq,
+                "agent": agent_payload,
+                "status": "scored",
+                "span": _span_summary(infer_job["span"]),
+                "ts": int(time.time()),
+            })
+            await _insert_stage(room, seq, uid, user_number, text, infer_job, agent_payload, response_record)
+        else:
+            await _finish_chat_line(room, seq, uid, user_number, text, agent_payload, infer_job["span"])
+        M_LINES.inc(status="done")
+        span = infer_job["span"]
+        M_E2E_MS.observe((span["broadcast"] - span["recv"]) * 1000.0)
+    except asyncio.CancelledError:
+        M_LINES.inc(status="cancelled")
+        # 发言者断线（排队中的 job 被撤掉）或服务关闭：告知房间这条不会再有结果
+        await _broadcast(room, {
+            "type": "chat_update",
+            "seq": seq,
+            "agent": None,
+            "status": "cancelled",
+            "span": _span_summary(infer_job["span"]),
+            "ts": int(time.time()),
+        })
+        raise
+    except Exception as e:
+        if WS_LOG:
+            print(f"[chat] room={room.room_id} seq={seq} failed: {repr(e)}")
+
+# ========= handler =========
+async def _send_room_snapshot(ws, room: Room):
+    """连接 / 进入房间时发给该客户端：房间当前 topic/scene，以及实验已结束时的问卷或统计状态。"""
+    await _safe_send(ws, _build_state_payload(room))
     # 如果实验已结束，发送结束状态
-    if STATE.get("experiment_ended"):
-        if STATE.get("questionnaire_completed"):
+    if room.state.get("experiment_ended"):
+        if room.state.get("questionnaire_completed"):
             # 问卷已完成，发送统计结果
-            stats = generate_experiment_statistics()
+            stats = generate_experiment_statistics(room)
             await _safe_send(ws, {
                 "type": "experiment_ended",
-                "end_time": STATE.get("end_time"),
-                "room_id": CURRENT_ROOM_ID or "",
+                "end_time": room.state.get("end_time"),
+                "room_id": room.log_room_id or "",
                 "stats": stats,
-                "csv_file": LOG_CSV,
+                "csv_file": room.log_csv,
             })
-        elif STATE.get("questionnaire_started"):
+        elif room.state.get("questionnaire_started"):
             # 问卷进行中，发送问卷状态
             participants = []
-            for uid, number in PARTICIPANT_NUMBERS.items():
+            for uid, number in room.participant_numbers.items():
                 participants.append({
                     "user_id": uid,
                     "number": number,
-                    "nickname": USERS[uid]["nickname"]
+                    "nickname": room.users[uid]["nickname"]
                 })
             await _safe_send(ws, {
                 "type": "experiment_ended",
-                "end_time": STATE.get("end_time"),
-                "room_id": CURRENT_ROOM_ID or "",
+                "end_time": room.state.get("end_time"),
+                "room_id": room.log_room_id or "",
                 "questionnaire_started": True,
                 "participants": participants,
                 "stats": None,
                 "csv_file": None,
             })
 
+async def _acquire_unless_closed(slots: asyncio.Semaphore, closed: asyncio.Event) -> bool:
+    """等 slots 名额，期间连接关闭则放弃并返回 False。"""
+    if not slots.locked():
+        await slots.acquire()
+        return True
+    acquire = asyncio.ensure_future(slots.acquire())
+    waiter = asyncio.ensure_future(closed.wait())
+    try:
+        await asyncio.wait({acquire, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+        if not acquire.done():
+            acquire.cancel()
+    if acquire.done() and not acquire.cancelled():
+        if closed.is_set():
+            slots.release()
+            return False
+        return True
+    return False
+
+async def handler(ws):
+    peer = getattr(ws, "remote_address", None)
+    chat_tasks = {}  # 本连接进行中的 _score_chat_line -> infer_job
+    chat_slots = asyncio.Semaphore(CHAT_LINE_CONCURRENCY)
+    # 连接关闭时置位：接收循环被 chat_slots 挡住、或还有缓冲帧没读完时也能立刻知道对端已断开
+    closed = asyncio.Event()
+    close_waiter = asyncio.ensure_future(ws.wait_closed())
+    close_waiter.add_done_callback(lambda _f: closed.set())
+    CONNS.add(ws)
+    _open_outbox(ws)
+    # 未 join 前挂在公共房间
+    room = _get_room(DEFAULT_ROOM_ID)
+    _move_conn(ws, room)
+    if WS_LOG:
+        print("[conn] client connected:", peer)
+
+    await _safe_send(ws, {"type": "status", "connected": True})
+    await _send_room_snapshot(ws, room)
+
     try:
         async for message in ws:
             if WS_LOG:
@@ -344,6 +1032,13 @@ async def handler(ws):
                     await _safe_send(ws, {"type": "join_fail", "msg": "nickname 和 intro 必填"})
                     continue
 
+                # 按 room_id 路由到对应房间（不带则留在公共房间）
+                room_id = (data.get("room_id") or "").strip() or DEFAULT_ROOM_ID
+                moved = room_id != room.room_id
+                if moved:
+                    room = _get_room(room_id)
+                    _move_conn(ws, room)
+
                 uid = "u_" + uuid.uuid4().hex[:8]
                 CONN2UID[ws] = uid
 
@@ -353,17 +1048,19 @@ async def handler(ws):
                     "speaking_style": data.get("speaking_style", ""),
                     "values": data.get("values", ""),
                 }
-                USERS[uid] = {"nickname": nickname, "persona_profile": persona_profile}
+                room.users[uid] = {"nickname": nickname, "persona_profile": persona_profile}
 
                 if WS_LOG:
-                    print(f"[join] ok uid={uid} nickname={nickname}")
+                    print(f"[join] ok uid={uid} nickname={nickname} room={room.room_id}")
 
-                await _safe_send(ws, {"type": "join_ok", "user_id": uid, "nickname": nickname})
-                await _broadcast({
+                await _safe_send(ws, {"type": "join_ok", "user_id": uid, "nickname": nickname, "room_id": room.room_id})
+                if moved:
+                    await _send_room_snapshot(ws, room)
+                await _broadcast(room, {
                     "type": "presence",
                     "event": "join",
                     "user": {"user_id": uid, "nickname": nickname},
-                    "online": _online_users(),
+                    "online": _online_users(room),
                     "ts": int(time.time()),
                 })
                 continue
@@ -376,40 +1073,42 @@ async def handler(ws):
 
             # ===== 公共状态：topic/scene =====
             if dtype == "topic":
-                STATE["topic_en"] = data.get("topic", "") or ""
-                await _broadcast(_build_state_payload())
+                room.state["topic_en"] = data.get("topic", "") or ""
+                await _broadcast(room, _build_state_payload(room))
                 continue
 
             if dtype == "scene_prompt":
-                STATE["scene_system"] = data.get("prompt", "") or ""
-                STATE["scene_user"] = ""
-                STATE["scene_fields"] = {}
-                await _broadcast(_build_state_payload())
+                room.state["scene_system"] = data.get("prompt", "") or ""
+                room.state["scene_user"] = ""
+                room.state["scene_fields"] = {}
+                await _broadcast(room, _build_state_payload(room))
                 continue
 
             if dtype == "scene_fields":
                 fields = data.get("fields", {}) or {}
                 if not isinstance(fields, dict):
                     fields = {}
-                STATE["scene_fields"] = fields
-                STATE["scene_system"] = build_scene_prompt_from_fields(fields)
-                STATE["scene_user"] = ""
-                await _broadcast(_build_state_payload())
+                room.state["scene_fields"] = fields
+                room.state["scene_system"] = build_scene_prompt_from_fields(fields)
+                room.state["scene_user"] = ""
+                await _broadcast(room, _build_state_payload(room))
                 continue
 
             # ===== 更新自己的 persona（可选）=====
             if dtype == "persona_profile":
                 persona = {
-                    "background": data.get("background", USERS[uid]["persona_profile"].get("background", "")),
-                    "personality_traits": data.get("personality_traits", USERS[uid]["persona_profile"].get("personality_traits", [])),
-                    "speaking_style": data.get("speaking_style", USERS[uid]["persona_profile"].get("speaking_style", "")),
-                    "values": data.get("values", USERS[uid]["persona_profile"].get("values", "")),
+                    "background": data.get("background", room.users[uid]["persona_profile"].get("background", "")),
+                    "personality_traits": data.get("personality_traits", room.users[uid]["persona_profile"].get("personality_traits", [])),
+                    "speaking_style": data.get("speaking_style", room.users[uid]["persona_profile"].get("speaking_style", "")),
+                    "values": data.get("values", room.users[uid]["persona_profile"].get("values", "")),
                 }
-                USERS[uid]["persona_profile"] = persona
-                await _broadcast({
+                if persona != room.users[uid]["persona_profile"]:
+                    invalidate_persona_prefix(room.users[uid]["persona_profile"])
+                room.users[uid]["persona_profile"] = persona
+                await _broadcast(room, {
                     "type": "presence",
                     "event": "persona_updated",
-                    "user": {"user_id": uid, "nickname": USERS[uid]["nickname"]},
+                    "user": {"user_id": uid, "nickname": room.users[uid]["nickname"]},
                     "ts": int(time.time()),
                 })
                 continue
@@ -420,7 +1119,7 @@ async def handler(ws):
                 user_id_from_data = data.get("user_id")
                 if user_num and user_id_from_data:
                     # 更新用户编号映射（用于问卷阶段）
-                    USER_NUMBER_MAP[user_id_from_data] = user_num
+                    room.user_number_map[user_id_from_data] = user_num
                     if WS_LOG:
                         print(f"[log] 用户编号已记录: user_id={user_id_from_data} number={user_num}")
                 continue
@@ -431,9 +1130,9 @@ async def handler(ws):
                 agent_seq = data.get("seq")
                 if agent_num and agent_seq:
                     # 保存Agent编号映射
-                    AGENT_NUMBER_MAP[agent_seq] = agent_num
+                    room.agent_number_map[agent_seq] = agent_num
                     # 记录Agent编号信息到CSV
-                    await write_csv_log([
+                    write_csv_log(room, [
                         datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                         f"{agent_seq}-agent-number",
                         'Agent编号',
@@ -456,33 +1155,35 @@ async def handler(ws):
 
             # ===== 结束实验（主持人操作，需要提供房间ID）=====
             if dtype == "end_experiment":
-                if STATE["experiment_ended"]:
+                if room.state["experiment_ended"]:
                     await _safe_send(ws, {"type": "error", "msg": "实验已经结束，请先重置实验"})
                     continue
                 
-                # 获取房间ID（必填）
+                # 获取房间ID（必填；join 时带了 room_id 的房间可省略）
                 room_id = (data.get("room_id") or "").strip()
+                if not room_id and room.room_id != DEFAULT_ROOM_ID:
+                    room_id = room.room_id
                 if not room_id:
                     await _safe_send(ws, {"type": "error", "msg": "请提供房间ID"})
                     continue
                 
                 # 初始化CSV文件（使用房间ID）
-                init_csv_log(room_id)
+                init_csv_log(room, room_id)
                 
-                STATE["experiment_ended"] = True
-                STATE["end_time"] = int(time.time())
+                room.state["experiment_ended"] = True
+                room.state["end_time"] = int(time.time())
                 
                 # 收集所有参与者的编号映射
-                PARTICIPANT_NUMBERS = {}
-                for uid, user_info in USERS.items():
-                    if uid in USER_NUMBER_MAP:
-                        PARTICIPANT_NUMBERS[uid] = USER_NUMBER_MAP[uid]
+                room.participant_numbers = {}
+                for uid, user_info in room.users.items():
+                    if uid in room.user_number_map:
+                        room.participant_numbers[uid] = room.user_number_map[uid]
                     else:
                         # 如果没有编号，使用默认值
-                        PARTICIPANT_NUMBERS[uid] = "未知"
+                        room.participant_numbers[uid] = "未知"
                 
                 # 记录实验结束到CSV
-                await write_csv_log([
+                write_csv_log(room, [
                     datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     "EXPERIMENT_END",
                     '实验结束',
@@ -498,29 +1199,30 @@ async def handler(ws):
                     "",
                     "",
                 ])
+                await flush_csv_log()
                 
                 # 初始化问卷状态（不显示结果，先显示问卷）
-                STATE["questionnaire_started"] = True
-                QUESTIONNAIRE_ANSWERS = {}
-                QUESTIONNAIRE_COMPLETED = set()
+                room.state["questionnaire_started"] = True
+                room.questionnaire_answers = {}
+                room.questionnaire_completed = set()
                 
                 if WS_LOG:
                     print(f"[experiment] 实验已结束，开始问卷阶段")
-                    print(f"[questionnaire] 参与者编号: {PARTICIPANT_NUMBERS}")
+                    print(f"[questionnaire] 参与者编号: {room.participant_numbers}")
                 
                 # 构建参与者列表（包含编号）
                 participants = []
-                for uid, number in PARTICIPANT_NUMBERS.items():
+                for uid, number in room.participant_numbers.items():
                     participants.append({
                         "user_id": uid,
                         "number": number,
-                        "nickname": USERS[uid]["nickname"]
+                        "nickname": room.users[uid]["nickname"]
                     })
                 
                 # 广播实验结束消息，进入问卷阶段（不显示统计结果）
-                await _broadcast({
+                await _broadcast(room, {
                     "type": "experiment_ended",
-                    "end_time": STATE["end_time"],
+                    "end_time": room.state["end_time"],
                     "questionnaire_started": True,
                     "participants": participants,  # 发送所有参与者列表
                     "stats": None,  # 不发送统计结果，等问卷完成后再发送
@@ -530,11 +1232,11 @@ async def handler(ws):
 
             # ===== 提交问卷答案 =====
             if dtype == "submit_questionnaire":
-                if not STATE.get("questionnaire_started"):
+                if not room.state.get("questionnaire_started"):
                     await _safe_send(ws, {"type": "error", "msg": "问卷尚未开始"})
                     continue
                 
-                if uid in QUESTIONNAIRE_COMPLETED:
+                if uid in room.questionnaire_completed:
                     await _safe_send(ws, {"type": "error", "msg": "你已经提交过问卷"})
                     continue
                 
@@ -554,26 +1256,26 @@ async def handler(ws):
                         pass
                 
                 # 保存问卷答案
-                QUESTIONNAIRE_ANSWERS[uid] = validated_answers
-                QUESTIONNAIRE_COMPLETED.add(uid)
+                room.questionnaire_answers[uid] = validated_answers
+                room.questionnaire_completed.add(uid)
                 
                 if WS_LOG:
                     print(f"[questionnaire] 用户 {uid} 提交问卷: {validated_answers}")
-                    print(f"[questionnaire] 完成进度: {len(QUESTIONNAIRE_COMPLETED)}/{len(USERS)}")
+                    print(f"[questionnaire] 完成进度: {len(room.questionnaire_completed)}/{len(room.users)}")
                 
                 # 检查是否所有用户都已完成问卷
-                all_users_completed = len(QUESTIONNAIRE_COMPLETED) >= len(USERS)
+                all_users_completed = len(room.questionnaire_completed) >= len(room.users)
                 
                 if all_users_completed:
                     # 所有用户完成，生成统计并显示结果
-                    STATE["questionnaire_completed"] = True
-                    stats = generate_experiment_statistics()
+                    room.state["questionnaire_completed"] = True
+                    stats = generate_experiment_statistics(room)
                     
                     # 记录问卷答案到CSV（在实验结束记录之后）
-                    for user_id, answers_dict in QUESTIONNAIRE_ANSWERS.items():
-                        user_number = PARTICIPANT_NUMBERS.get(user_id, "未知")
+                    for user_id, answers_dict in room.questionnaire_answers.items():
+                        user_number = room.participant_numbers.get(user_id, "未知")
                         for target_number, score in answers_dict.items():
-                            await write_csv_log([
+                            write_csv_log(room, [
                                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                                 f"QUESTIONNAIRE-{user_id}",
                                 '问卷答案',
@@ -591,25 +1293,26 @@ async def handler(ws):
                     
                     if WS_LOG:
                         print(f"[questionnaire] 所有用户已完成问卷")
-                        print(f"[questionnaire] 问卷答案: {QUESTIONNAIRE_ANSWERS}")
+                        print(f"[questionnaire] 问卷答案: {room.questionnaire_answers}")
                         print(f"[experiment] 统计数据: {stats}")
-                        print(f"[log] CSV日志已保存到: {LOG_CSV}")
+                        print(f"[log] CSV日志已保存到: {room.log_csv}")
+                    await flush_csv_log()
                     
                     # 广播问卷完成，显示统计结果
-                    await _broadcast({
+                    await _broadcast(room, {
                         "type": "questionnaire_completed",
-                        "room_id": CURRENT_ROOM_ID or "",
+                        "room_id": room.log_room_id or "",
                         "stats": stats,
-                        "csv_file": LOG_CSV,
-                        "questionnaire_answers": QUESTIONNAIRE_ANSWERS,  # 问卷答案（可选，用于前端显示）
+                        "csv_file": room.log_csv,
+                        "questionnaire_answers": room.questionnaire_answers,  # 问卷答案（可选，用于前端显示）
                     })
                 else:
                     # 部分用户完成，告知所有用户进度
-                    remaining_count = len(USERS) - len(QUESTIONNAIRE_COMPLETED)
-                    await _broadcast({
+                    remaining_count = len(room.users) - len(room.questionnaire_completed)
+                    await _broadcast(room, {
                         "type": "questionnaire_progress",
-                        "completed_count": len(QUESTIONNAIRE_COMPLETED),
-                        "total_count": len(USERS),
+                        "completed_count": len(room.questionnaire_completed),
+                        "total_count": len(room.users),
                         "remaining_count": remaining_count,
                     })
                     
@@ -622,8 +1325,11 @@ async def handler(ws):
 
             # ===== 发言：先 ack，再推理，再 update =====
             if dtype == "chat_line":
+                span = {"recv": time.perf_counter()}
+                if closed.is_set():
+                    continue  # 断线前缓冲的发言：不再 ack / 打分
                 # 检查实验是否已结束
-                if STATE["experiment_ended"]:
+                if room.state["experiment_ended"]:
                     await _safe_send(ws, {"type": "error", "msg": "实验已结束，无法继续发言"})
                     continue
                     
@@ -631,28 +1337,29 @@ async def handler(ws):
                 if not text:
                     continue
 
-                nickname = USERS[uid]["nickname"]
-                user_number = data.get("user_number") or USER_NUMBER_MAP.get(uid, "未知")
+                # 每连接同时处理的发言数有上限：满了先等名额再 ack（暂停读取），等的同时盯着连接关闭
+                if not await _acquire_unless_closed(chat_slots, closed):
+                    continue
+
+                nickname = room.users[uid]["nickname"]
+                user_number = data.get("user_number") or room.user_number_map.get(uid, "未知")
 
                 # 更新用户编号映射
                 if data.get("user_number"):
-                    USER_NUMBER_MAP[uid] = data.get("user_number")
+                    room.user_number_map[uid] = data.get("user_number")
 
-                global SEQ
-                async with SEQ_LOCK:
-                    SEQ += 1
-                    seq = SEQ
+                async with room.seq_lock:
+                    room.seq += 1
+                    seq = room.seq
 
                 if WS_LOG:
-                    print(f"[chat] seq={seq} from={nickname} (编号:{user_number}): {text}")
+                    print(f"[chat] room={room.room_id} seq={seq} from={nickname} (编号:{user_number}): {text}")
 
                 # 写入历史（用于后续 history_ctx）
-                HISTORY.append({"seq": seq, "user_id": uid, "nickname": nickname, "text": text, "ts": int(time.time())})
-                if len(HISTORY) > MAX_HISTORY:
-                    del HISTORY[:-MAX_HISTORY]
+                room.history.append({"seq": seq, "user_id": uid, "nickname": nickname, "text": text, "ts": int(time.time())})
 
                 # 先广播 ack：UI 立即显示（queued）
-                await _broadcast({
+                await _broadcast(room, {
                     "type": "chat_ack",
                     "seq": seq,
                     "user": {"user_id": uid, "nickname": nickname},
@@ -660,112 +1367,36 @@ async def handler(ws):
                     "ts": int(time.time()),
                     "status": "queued",
                     "queue_size": GPU_QUEUE.qsize(),
+                    "queue_depth": GPU_QUEUE.depth(room.room_id, uid),  # {total, room, user}
                 })
+                span["ack"] = time.perf_counter()
 
-                history_ctx = _format_history(HISTORY_N)
-                persona_profile = USERS[uid]["persona_profile"]
-
-                # 串行推理（不会抢 GPU）
-                try:
-                    agent_payload = await submit_infer_job({
-                        "seq": seq,
-                        "persona_profile": persona_profile,
-                        "topic_en": STATE["topic_en"],
-                        "scene_system": STATE["scene_system"],
-                        "scene_user": history_ctx,
-                        "utterance": text,
-                    })
-                except Exception as e:
-                    agent_payload = {
-                        "type": "agent_utterance",
-                        "final_willingness": 0.0,
-                        "threshold": 0.60,
-                        "topic_en": STATE["topic_en"],
-                        "strategy": "disabled",
-                        "text": "",
-                        "sub_scores": {"persona": 0.0, "scene": 0.0, "topic": 0.0},
-                        "debug_timing": {"error": repr(e)},
-                        "debug_inputs": None,
-                    }
-
-                final_willingness = agent_payload.get("final_willingness", 0.0)
-                did_trigger = final_willingness > agent_payload.get("threshold", 0.6)
-                
-                # 获取LoRA子分数
-                sub_scores = agent_payload.get("sub_scores", {})
-                persona_score = sub_scores.get("persona", 0.0)
-                scene_score = sub_scores.get("scene", 0.0)
-                topic_score = sub_scores.get("topic", 0.0)
-                agent_strategy = agent_payload.get("strategy", "disabled")
-                agent_text = agent_payload.get("text", "")
-                
-                if WS_LOG:
-                    print(f"[done] seq={seq} final={final_willingness} triggered={did_trigger}")
-                    print(f"[lora_scores] persona={persona_score:.4f} scene={scene_score:.4f} topic={topic_score:.4f}")
+                history_ctx = room.history.window()  # 最近 N 句，按 ChatGPT prompt 预算从旧往新裁
+                persona_profile = room.users[uid]["persona_profile"]
 
-                # 记录Agent响应到统计列表
-                AGENT_RESPONSES.append({
+                infer_job = {
+                    "room_id": room.room_id,
+                    "user_id": uid,
                     "seq": seq,
-                    "final_willingness": final_willingness,
-                    "triggered": did_trigger,
-                    "strategy": agent_strategy,
-                    "text": agent_text,
-                    "sub_scores": sub_scores,
-                    "ts": int(time.time()),
-                })
-                
-                # 只保留最近N条Agent响应记录（避免内存溢出）
-                MAX_AGENT_RESPONSES = 1000
-                if len(AGENT_RESPONSES) > MAX_AGENT_RESPONSES:
-                    AGENT_RESPONSES[:] = AGENT_RESPONSES[-MAX_AGENT_RESPONSES:]
-
-                # 记录用户消息到CSV（包含LoRA子分数）
-                await write_csv_log([
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    seq,
-                    '用户',
-                    str(user_number),
-                    uid,
-                    text,
-                    f"{final_willingness:.4f}",  # 最终Willingness
-                    f"{persona_score:.4f}",  # Persona分数
-                    f"{scene_score:.4f}",  # Scene分数
-                    f"{topic_score:.4f}",  # Topic分数
-                    "是" if did_trigger else "否",  # 是否触发插话
-                    agent_strategy if did_trigger else "",  # Agent策略
-                    agent_text if did_trigger else "",  # Agent插话内容
-                    "",  # Agent编号（待前端补充）
-                ])
+                    "persona_profile": persona_profile,
+                    "topic_en": room.state["topic_en"],
+                    "scene_system": room.state["scene_system"],
+                    "scene_user": history_ctx,
+                    "utterance": text,
+                    "span": span,
+                    "closed": closed,
+                }
 
-                # 推理完成：广播 update（用 seq 对齐 ack）
-                await _broadcast({
-                    "type": "chat_update",
-                    "seq": seq,
-                    "agent": agent_payload,
-                    "status": "done",
-                    "ts": int(time.time()),
-                })
+                # 打分在后台任务里进行：接收循环马上处理这个连接的下一帧（问卷、persona 更新等）
+                task = asyncio.create_task(_score_chat_line(room, seq, uid, user_number, text, infer_job))
+                chat_tasks[task] = infer_job
+                task.add_done_callback(lambda t: chat_tasks.pop(t, None))
+                task.add_done_callback(lambda _t: chat_slots.release())
+                continue
 
-                # 如果Agent有插话，记录Agent消息到CSV
-                # Agent编号可能会稍后由前端通过 agent_number 消息补充
-                agent_number = AGENT_NUMBER_MAP.get(seq, "")
-                if did_trigger and agent_text:
-                    await write_csv_log([
-                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        f"{seq}-agent",
-                        'Agent',
-                        str(agent_number) if agent_number else "",  # Agent编号
-                        "agent",
-                        agent_text,
-                        f"{final_willingness:.4f}",  # 最终Willingness
-                        f"{persona_score:.4f}",  # Persona分数
-                        f"{scene_score:.4f}",  # Scene分数
-                        f"{topic_score:.4f}",  # Topic分数
-                        "是",
-                        agent_strategy,
-                        agent_text,
-                        str(agent_number) if agent_number else "",  # Agent编号
-                    ])
+            # ===== 推理队列指标（每个房间 / 用户的排队与推理中条数）=====
+            if dtype == "queue_stats":
+                await _safe_send(ws, {"type": "queue_stats", "stats": GPU_QUEUE.stats(), "cancel_stats": CANCEL_STATS, "ts": int(time.time())})
                 continue
 
             # 兜底：回显
@@ -775,16 +1406,29 @@ async def handler(ws):
         if WS_LOG:
             print("[handler] error:", repr(e))
     finally:
-        CONNS.discard(ws)
+        # 断线：撤掉本连接还在排队（未出队）的 job 和还没发出的 ChatGPT 请求，各自的任务广播 cancelled / 按未插话收尾；
+        # 已经进入推理批次或正在请求 ChatGPT 的发言照常完成（结果仍对房间其他人可见）
+        closed.set()
+        close_waiter.cancel()
+        for infer_job in list(chat_tasks.values()):
+            fut = infer_job.get("future")
+            if fut is not None and not fut.done() and "dequeue" not in infer_job["span"]:
+                fut.cancel()
+            cf = infer_job.get("llm_future")
+            if cf is not None:
+                cf.cancel()
+        _drop_conn(ws)
+        CONN2ROOM.pop(ws, None)
+        _close_outbox(ws)
         uid = CONN2UID.pop(ws, None)
-        if uid and uid in USERS:
+        if uid and uid in room.users:
             if WS_LOG:
-                print(f"[leave] uid={uid} nickname={USERS[uid]['nickname']}")
-            await _broadcast({
+                print(f"[leave] uid={uid} nickname={room.users[uid]['nickname']}")
+            await _broadcast(room, {
                 "type": "presence",
                 "event": "leave",
-                "user": {"user_id": uid, "nickname": USERS[uid]["nickname"]},
-                "online": _online_users(),
+                "user": {"user_id": uid, "nickname": room.users[uid]["nickname"]},
+                "online": _online_users(room),
                 "ts": int(time.time()),
             })
         if WS_LOG:
@@ -793,16 +1437,24 @@ async def handler(ws):
 # ========= main =========
 async def main():
     print("[server_ws] starting ws://0.0.0.0:8765")
-    print(f"[log] 实验日志将保存到: {LOG_CSV}")
+    print(f"[log] 实验日志将保存到: {LOG_DIR}/（每个房间一个 CSV）")
 
-    # 预热：只加载 7B + 3 个 LoRA adapter（与你当前 Core 的加载一致）
-    init_models()
+    # 预热：只加载 7B + 3 个 LoRA adapter（与你当前 Core 的加载一致），在推理线程里加载
+    await asyncio.get_running_loop().run_in_executor(INFER_EXECUTOR, init_models)
 
-    # 单 worker：GPU 串行
+    # 单 worker：GPU 串行（批内合并）
     asyncio.create_task(gpu_worker())
+    asyncio.create_task(loop_lag_monitor())
+    if METRICS_PORT:
+        Metrics.serve(METRICS_PORT)
+        print(f"[metrics] http://0.0.0.0:{METRICS_PORT}/metrics")
 
-    async with websockets.serve(handler, "0.0.0.0", 8765):
-        await asyncio.Future()
+    try:
+        async with websockets.serve(handler, "0.0.0.0", 8765):
+            await asyncio.Future()
+    finally:
+        # 退出前把后台写线程里剩余的日志行写完
+        stop_csv_writer()
 
 if __name__ == "__main__":
     try:
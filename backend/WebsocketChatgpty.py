@@ -7,8 +7,8 @@
 - 必须先 join（nickname + intro），否则不允许发言
 - 每个用户独立 persona_profile（不共享）
 - chat_line：先广播 chat_ack(queued)，再串行推理，最后广播 chat_update(done)
-- 推理上下文：最近 N 句历史拼成 scene_user
-- 多人并发不抢 GPU：asyncio.Queue + 单 worker 串行 infer_once()
+- 推理上下文：最近 N 句历史拼成 scene_user（ChatHistory 增量维护，按 800 字符预算保留最新的几句）
+- 多人并发：asyncio.Queue + CHATGPT_WORKERS 个 worker 调用 infer_once_async()（AsyncOpenAI 连接池 + 并发上限）
 """
 
 import json
@@ -20,7 +20,8 @@ import csv
 import os
 from datetime import datetime
 
-from CoreChatgpt import infer_once, build_scene_prompt_from_fields, init_models
+from ChatHistory import ChatHistory
+from CoreChatgpt import infer_once_async, build_scene_prompt_from_fields, init_models
 
 # ========= 参数 =========
 WS_LOG = True            # 服务端日志（建议 True，便于你看到 join / enqueue / done）
@@ -50,13 +51,14 @@ USERS = {}        # user_id -> {"nickname": str, "persona_profile": dict}
 CONN2UID = {}     # websocket -> user_id
 CONNS = set()     # all connections
 
-HISTORY = []      # [{seq,user_id,nickname,text,ts}]
+HISTORY = ChatHistory(MAX_HISTORY, HISTORY_N)  # [{seq,user_id,nickname,text,ts}]，缓存最近 N 句上下文
 
 SEQ = 0
 SEQ_LOCK = asyncio.Lock()
 
 # ========= ChatGPT 异步队列（避免并发调用过多） =========
 CHATGPT_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=GPU_QUEUE_MAX)
+CHATGPT_WORKERS = 8  # 同时处理的发言数（各 worker 用 AsyncOpenAI，共享连接池）
 
 # ========= 实验日志 CSV =========
 LOG_DIR = "experiment_logs"
@@ -183,32 +185,29 @@ def generate_experiment_statistics() -> dict:
             print(f"[stats] 生成统计失败: {repr(e)}")
         return {}
 
-async def chatgpt_worker():
-    """ChatGPT 串行处理 worker（避免 API 限流）"""
+async def chatgpt_worker(worker_id: int = 0):
+    """ChatGPT worker：CHATGPT_WORKERS 个并发运行，在途请求总数由 CoreChatgpt 的 semaphore 限制（避免 API 限流）"""
     if WS_LOG:
-        print("[chatgpt_worker] started")
+        print(f"[chatgpt_worker#{worker_id}] started")
     while True:
         job = await CHATGPT_QUEUE.get()
         fut = job["future"]
         try:
             if WS_LOG:
-                print(f"[chatgpt_worker] run seq={job.get('seq')}")
-            # ChatGPT 调用是阻塞的，需要在 executor 中运行
-            loop = asyncio.get_running_loop()
-            result = await loop.run_in_executor(
-                None,
-                infer_once,
+                print(f"[chatgpt_worker#{worker_id}] run seq={job.get('seq')}")
+            result = await infer_once_async(
                 job["persona_profile"],
                 job["topic_en"],
                 job["scene_system"],
                 job["scene_user"],
                 job["utterance"],
+                insert_scene_user=job.get("insert_scene_user"),
             )
             if not fut.cancelled():
                 fut.set_result(result)
         except Exception as e:
             if WS_LOG:
-                print(f"[chatgpt_worker] error: {repr(e)}")
+                print(f"[chatgpt_worker#{worker_id}] error: {repr(e)}")
             if not fut.cancelled():
                 fut.set_exception(e)
         finally:
@@ -274,15 +273,6 @@ def _build_state_payload() -> dict:
 def _online_users():
     return [{"user_id": uid, "nickname": u["nickname"]} for uid, u in USERS.items()]
 
-def _format_history(n: int) -> str:
-    if not HISTORY:
-        return ""
-    tail = HISTORY[-n:]
-    lines = ["[HISTORY]"]
-    for it in tail:
-        lines.append(f'{it.get("nickname","anon")}: {it.get("text","")}')
-    return "\n".join(lines)
-
 # ========= handler =========
 async def handler(ws):
     # 声明全局变量（需要在函数开始处声明，不能在中间声明）
@@ -680,8 +670,6 @@ async def handler(ws):
 
                 # 写入历史（用于后续 history_ctx）
                 HISTORY.append({"seq": seq, "user_id": uid, "nickname": nickname, "text": text, "ts": int(time.time())})
-                if len(HISTORY) > MAX_HISTORY:
-                    del HISTORY[:-MAX_HISTORY]
 
                 # 先广播 ack：UI 立即显示（queued）
                 await _broadcast({
@@ -694,10 +682,11 @@ async def handler(ws):
                     "queue_size": CHATGPT_QUEUE.qsize(),
                 })
 
-                history_ctx = _format_history(HISTORY_N)
+                history_ctx = HISTORY.context()  # 最近 N 句（完整），用于 willingness 打分
+                insert_ctx = HISTORY.window()  # 插话 prompt 用：按 800 字符预算从旧往新裁
                 persona_profile = USERS[uid]["persona_profile"]
 
-                # 串行推理（使用 ChatGPT，避免 API 限流）
+                # 排队推理（使用 ChatGPT，并发上限见 CoreChatgpt.OPENAI_MAX_CONCURRENCY）
                 try:
                     agent_payload = await submit_infer_job({
                         "seq": seq,
@@ -705,6 +694,7 @@ async def handler(ws):
                         "topic_en": STATE["topic_en"],
                         "scene_system": STATE["scene_system"],
                         "scene_user": history_ctx,
+                        "insert_scene_user": insert_ctx,
                         "utterance": text,
                     })
                 except Exception as e:
@@ -805,8 +795,9 @@ async def main():
     # 初始化（ChatGPT 模式不需要加载本地模型）
     init_models()
 
-    # 单 worker：ChatGPT 串行（避免 API 限流）
-    asyncio.create_task(chatgpt_worker())
+    # 多个 worker 并发取任务；真正的并发上限见 CoreChatgpt.OPENAI_MAX_CONCURRENCY
+    for i in range(CHATGPT_WORKERS):
+        asyncio.create_task(chatgpt_worker(i))
 
     async with websockets.serve(handler, "0.0.0.0", WS_PORT):
         await asyncio.Future()